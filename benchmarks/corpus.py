@@ -0,0 +1,201 @@
+"""Synthetic resources in every supported format, and a local HTTP server to download them from.
+
+Each kind of resource has a p-code column (except csv_miss, whose codes are not in the index, so
+matching reads as many rows as allowed) and indicator columns, and is generated deterministically
+from its number of rows, so runs on the same machine can be compared.
+"""
+import gzip
+import re
+from os import makedirs, walk
+from os.path import basename, getsize, isfile, join, relpath
+from http.server import SimpleHTTPRequestHandler, ThreadingHTTPServer
+from random import Random
+from shutil import copyfileobj, rmtree
+from threading import Thread
+from typing import Dict, List, NamedTuple
+from zipfile import ZIP_DEFLATED, ZipFile
+
+from geopandas import GeoDataFrame
+from openpyxl import Workbook as OpenpyxlWorkbook
+from pandas import DataFrame
+from pyogrio import write_dataframe
+from shapely.geometry import Point
+
+from helper.pcodes import PcodeIndex
+
+KINDS = ["csv", "csv_hxl", "csv_miss", "xlsx", "shp", "gpkg", "gdb", "gpkg_gz"]
+INDICATORS = 10
+CHUNK_SIZE = 65536
+
+
+class CorpusResource(NamedTuple):
+    kind: str
+    rows: int
+    path: str  # file served, relative to the corpus folder
+    format: str  # HDX format of the resource
+
+
+def pcode_index() -> PcodeIndex:
+    return PcodeIndex({"AFG": [f"AF{i:04d}" for i in range(1, 401)]}, version="benchmark")
+
+
+def synthetic_frame(rows: int, seed: int, miss: bool = False) -> DataFrame:
+    random = Random(seed)
+    prefix = "XX" if miss else "AF"
+    data = {
+        "adm2_pcode": [f"{prefix}{random.randint(1, 400):04d}" for _ in range(rows)],
+        "adm2_name": [f"District {random.getrandbits(24):x}" for _ in range(rows)],
+    }
+    for j in range(INDICATORS):
+        data[f"ind_{j}"] = [round(random.random() * 1000, 3) for _ in range(rows)]
+    return DataFrame(data)
+
+
+def geo_frame(df: DataFrame, seed: int) -> GeoDataFrame:
+    random = Random(seed)
+    points = [Point(60 + random.random() * 15, 29 + random.random() * 9) for _ in range(len(df))]
+    return GeoDataFrame(df, geometry=points, crs="EPSG:4326")
+
+
+def zip_folder(folder: str, path: str) -> None:
+    with ZipFile(path, "w", ZIP_DEFLATED) as z:
+        for root, _, files in walk(folder):
+            for name in files:
+                z.write(join(root, name), relpath(join(root, name), join(folder, "..")))
+
+
+def write_resource(folder: str, kind: str, rows: int) -> CorpusResource:
+    """Generate one resource of the corpus
+
+    Args:
+        folder (str): corpus folder
+        kind (str): one of KINDS
+        rows (int): number of data rows
+
+    Returns:
+        CorpusResource: the generated resource
+    """
+    name = f"{kind}_{rows}"
+    df = synthetic_frame(rows, seed=rows, miss=kind == "csv_miss")
+    work = join(folder, "work", name)
+    makedirs(work, exist_ok=True)
+    if kind in ["csv", "csv_miss"]:
+        path, file_format = f"{name}.csv", "CSV"
+        df.to_csv(join(folder, path), index=False)
+    elif kind == "csv_hxl":
+        path, file_format = f"{name}.csv", "CSV"
+        tags = ["#adm2+code", "#adm2+name"] + [f"#indicator+i{j}" for j in range(INDICATORS)]
+        with open(join(folder, path), "w") as f:
+            f.write(",".join(df.columns) + "\n")
+            f.write(",".join(tags) + "\n")
+            df.to_csv(f, index=False, header=False)
+    elif kind == "xlsx":
+        path, file_format = f"{name}.xlsx", "XLSX"
+        workbook = OpenpyxlWorkbook(write_only=True)
+        for sheet_number in range(3):  # a notes sheet, the data and an empty sheet
+            sheet = workbook.create_sheet(f"Sheet{sheet_number}")
+            if sheet_number == 0:
+                sheet.append(["Notes"])
+                sheet.append(["Synthetic data for benchmarks"])
+            elif sheet_number == 1:
+                sheet.append(list(df.columns))
+                for row in df.itertuples(index=False):
+                    sheet.append(list(row))
+        workbook.save(join(folder, path))
+    elif kind == "shp":
+        path, file_format = f"{name}.zip", "SHP"
+        shapes = join(work, name)
+        makedirs(shapes, exist_ok=True)
+        write_dataframe(geo_frame(df, rows), join(shapes, f"{name}.shp"))
+        zip_folder(shapes, join(folder, path))
+    elif kind == "gpkg":
+        path, file_format = f"{name}.gpkg", "GeoPackage"
+        write_dataframe(geo_frame(df, rows), join(folder, path), layer="districts")
+    elif kind == "gdb":
+        path, file_format = f"{name}.gdb.zip", "Geodatabase"
+        write_dataframe(geo_frame(df, rows), join(work, f"{name}.gdb"), layer="districts", driver="OpenFileGDB")
+        zip_folder(join(work, f"{name}.gdb"), join(folder, path))
+    elif kind == "gpkg_gz":
+        path, file_format = f"{name}.gpkg.gz", "GeoPackage"
+        write_dataframe(geo_frame(df, rows), join(work, f"{name}.gpkg"), layer="districts")
+        with open(join(work, f"{name}.gpkg"), "rb") as source, gzip.open(join(folder, path), "wb") as target:
+            copyfileobj(source, target)
+    else:
+        raise ValueError(f"Unknown kind of resource {kind}")
+    rmtree(work, ignore_errors=True)
+    return CorpusResource(kind, rows, path, file_format)
+
+
+def write_corpus(folder: str, kinds: List[str], sizes: List[int]) -> List[CorpusResource]:
+    makedirs(folder, exist_ok=True)
+    return [write_resource(folder, kind, rows) for kind in kinds for rows in sizes]
+
+
+class CorpusRequestHandler(SimpleHTTPRequestHandler):
+    """Serves the corpus with support for single byte ranges, so zipped resources are read remotely"""
+
+    def do_GET(self) -> None:
+        path = self.translate_path(self.path)
+        if not isfile(path):
+            self.send_error(404)
+            return
+        size = getsize(path)
+        start, end, status = 0, size - 1, 200
+        match = re.match(r"bytes=(\d+)-(\d*)$", self.headers.get("Range", ""))
+        if match:
+            start = int(match.group(1))
+            end = min(int(match.group(2)) if match.group(2) else size - 1, size - 1)
+            status = 206
+        self.send_response(status)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", f"bytes {start}-{end}/{size}")
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            remaining = end - start + 1
+            while remaining > 0:
+                chunk = f.read(min(CHUNK_SIZE, remaining))
+                try:
+                    self.wfile.write(chunk)
+                except (BrokenPipeError, ConnectionResetError):  # the client read all it needed
+                    break
+                remaining -= len(chunk)
+
+    def log_message(self, *args) -> None:
+        pass
+
+
+class CorpusServer(ThreadingHTTPServer):
+    """Local stand-in for the hosts of HDX resources"""
+
+    daemon_threads = True
+
+    def __init__(self, folder: str) -> None:
+        super().__init__(("127.0.0.1", 0), lambda *args: CorpusRequestHandler(*args, directory=folder))
+        self._thread = None
+
+    def url(self, resource: CorpusResource) -> str:
+        return f"http://127.0.0.1:{self.server_port}/{resource.path}"
+
+    def __enter__(self) -> "CorpusServer":
+        self._thread = Thread(target=self.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.shutdown()
+        self.server_close()
+
+
+def resource_metadata(resource: CorpusResource, url: str, size: int) -> Dict:
+    return {
+        "id": f"benchmark-{resource.kind}-{resource.rows}",
+        "name": basename(resource.path),
+        "format": resource.format,
+        "url": url,
+        "size": size,
+        "resource_type": "file.upload",
+    }
@@ -0,0 +1,111 @@
+"""Benchmark of reading the top rows of large multi-sheet xlsx workbooks.
+
+Compares the previous path, which opened the workbook with pandas.ExcelFile (loading all shared
+strings) for every read and read every sheet, with Workbook, which streams rows, resolves shared
+strings only as far as needed, stays open across the adaptive matching rounds and skips hidden
+sheets. The openpyxl read-only engine, kept open across the rounds as well, is timed alongside
+as it is the library alternative to the streaming reader of Workbook. Run from the repository
+root:
+
+    python -m benchmarks.excel --sizes 10 50 100
+"""
+import argparse
+from functools import partial
+from os.path import getsize, join
+from random import Random
+from time import perf_counter
+
+from hdx.utilities.path import temp_dir
+from openpyxl import Workbook as OpenpyxlWorkbook, load_workbook
+from pandas import ExcelFile
+
+from check_pcodes import read_downloaded_data, read_tabular
+
+ROUNDS = [20, 80, 320, 1000]  # rows read by each round of adaptive matching
+
+
+def write_workbook(path: str, rows: int, sheets: int, hidden: int, seed: int = 0) -> None:
+    random = Random(seed)
+    workbook = OpenpyxlWorkbook(write_only=True)
+    for i in range(sheets + hidden):
+        sheet = workbook.create_sheet(f"Sheet{i}")
+        if i >= sheets:
+            sheet.sheet_state = "hidden"
+        sheet.append(["adm1_pcode", "adm1_name"] + [f"indicator_{j}" for j in range(20)])
+        for r in range(rows):
+            sheet.append(
+                [f"AF{r % 34 + 1:02d}", f"Province {random.getrandbits(32):x}"]
+                + [random.random() for _ in range(20)]
+            )
+    workbook.save(path)
+
+
+def workbook_of_size(folder: str, megabytes: float, sheets: int, hidden: int) -> str:
+    sample = join(folder, "sample.xlsx")
+    write_workbook(sample, 2000, sheets, hidden)
+    rows = int(2000 * megabytes * 1048576 / getsize(sample))
+    path = join(folder, f"workbook_{megabytes}mb.xlsx")
+    write_workbook(path, rows, sheets, hidden)
+    return path
+
+
+def read_previous(path: str, nrows: int) -> int:
+    tables = 0
+    with ExcelFile(path) as workbook:
+        for sheet_name in workbook.sheet_names:
+            if read_tabular(partial(workbook.parse, sheet_name), "xlsx", nrows, skip_empty=True) is not None:
+                tables += 1
+    return tables
+
+
+def read_openpyxl(path: str, nrows: int, workbooks: dict) -> int:
+    # read-only openpyxl loads all the shared strings when the workbook is opened
+    if path not in workbooks:
+        workbooks[path] = load_workbook(path, read_only=True, data_only=True)
+    tables = 0
+    for sheet in workbooks[path].worksheets:
+        if sheet.sheet_state == "visible":
+            list(sheet.iter_rows(max_row=nrows + 1, values_only=True))
+            tables += 1
+    return tables
+
+
+def read_current(path: str, nrows: int, workbooks: dict) -> int:
+    data, _ = read_downloaded_data([path], "xlsx", nrows, workbooks=workbooks)
+    return len(data)
+
+
+def timed(function, *args) -> float:
+    start = perf_counter()
+    function(*args)
+    return perf_counter() - start
+
+
+def main(sizes, sheets, hidden):
+    with temp_dir(folder="BenchmarkExcel") as folder:
+        print(
+            f"{'size (MB)':>10} {'rounds':>7} {'previous (s)':>13} {'openpyxl (s)':>13} {'workbook (s)':>13} {'speedup':>8}"
+        )
+        for megabytes in sizes:
+            path = workbook_of_size(folder, megabytes, sheets, hidden)
+            actual = getsize(path) / 1048576
+            for rounds in [1, len(ROUNDS)]:
+                previous = sum([timed(read_previous, path, nrows) for nrows in ROUNDS[:rounds]])
+                books, workbooks = dict(), dict()
+                openpyxl = sum([timed(read_openpyxl, path, nrows, books) for nrows in ROUNDS[:rounds]])
+                current = sum([timed(read_current, path, nrows, workbooks) for nrows in ROUNDS[:rounds]])
+                for workbook in [*books.values(), *workbooks.values()]:
+                    workbook.close()
+                print(
+                    f"{actual:>10.1f} {rounds:>7} {previous:>13.3f} {openpyxl:>13.3f} {current:>13.3f}"
+                    f" {previous / current:>7.1f}x"
+                )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark reading of large xlsx workbooks")
+    parser.add_argument("--sizes", type=float, nargs="+", default=[10, 50, 100], help="workbook sizes in MB")
+    parser.add_argument("--sheets", type=int, default=3, help="number of visible sheets")
+    parser.add_argument("--hidden", type=int, default=1, help="number of hidden sheets")
+    args = parser.parse_args()
+    main(args.sizes, args.sheets, args.hidden)
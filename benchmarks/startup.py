@@ -0,0 +1,79 @@
+"""Cold-start time and memory of each mode, each measured in a fresh interpreter.
+
+    idle            import of run.py, as in a container with the worker disabled
+    pipeline        import of check_pcodes, as the listener and batch modes do before their first resource
+    readers/<ext>   pipeline plus the readers of one format, as when its first resource arrives
+
+Only idle leaves out pandas, numpy and the hdx stack. The other modes load them with check_pcodes,
+so what they save is limited to the readers of the formats that have not been seen yet. Run from
+the repository root:
+
+    python -m benchmarks.startup
+"""
+import argparse
+import subprocess
+import sys
+from json import loads
+from statistics import median
+from typing import Dict, List
+
+from helper.startup import HEAVY_MODULES
+
+FORMATS = ["csv", "xlsx", "shp", "gpkg"]
+
+SNIPPET = """
+import json, sys, time
+from resource import RUSAGE_SELF, getrusage
+start = time.perf_counter()
+{code}
+print(json.dumps({{
+    "seconds": time.perf_counter() - start,
+    "peak_rss_mb": getrusage(RUSAGE_SELF).ru_maxrss / 1024,
+    "heavy_modules": [m for m in {heavy} if m in sys.modules],
+}}))
+"""
+
+
+def mode_code(mode: str) -> str:
+    if mode == "idle":
+        return "import run"
+    if mode == "pipeline":
+        return "import check_pcodes"
+    return f"import check_pcodes; check_pcodes.load_readers({mode.split('/')[1]!r})"
+
+
+def measure(mode: str, repeats: int) -> Dict:
+    """Start a fresh interpreter for the mode repeats times
+
+    Args:
+        mode (str): idle, pipeline or readers/<ext>
+        repeats (int): number of runs
+
+    Returns:
+        Dict: median seconds and peak RSS in MB, and the heavy modules loaded
+    """
+    runs = []
+    for _ in range(repeats):
+        code = SNIPPET.format(code=mode_code(mode), heavy=HEAVY_MODULES)
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        runs.append(loads(output.strip().splitlines()[-1]))
+    return {
+        "seconds": median([r["seconds"] for r in runs]),
+        "peak_rss_mb": median([r["peak_rss_mb"] for r in runs]),
+        "heavy_modules": runs[-1]["heavy_modules"],
+    }
+
+
+def main(formats: List[str], repeats: int) -> None:
+    print(f"{'mode':<16} {'seconds':>8} {'peak RSS (MB)':>14}  heavy modules")
+    for mode in ["idle", "pipeline"] + [f"readers/{ext}" for ext in formats]:
+        result = measure(mode, repeats)
+        print(f"{mode:<16} {result['seconds']:>8.3f} {result['peak_rss_mb']:>14.1f}  {' '.join(result['heavy_modules'])}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Measure the cold start of each mode of the p-code detector")
+    parser.add_argument("--formats", nargs="+", default=FORMATS, help="formats whose readers are loaded")
+    parser.add_argument("--repeats", type=int, default=3, help="runs per mode")
+    args = parser.parse_args()
+    main(args.formats, args.repeats)
@@ -0,0 +1,287 @@
+"""Benchmark suite of the detection pipeline on a synthetic corpus, compared against a stored baseline.
+
+Generates resources of every supported format at several sizes (see benchmarks.corpus), serves
+them from a local HTTP server and measures each stage on each resource:
+
+    download        download_resource from the local server, including extraction
+    read            read_downloaded_data of the downloaded files
+    parse           parse_tabular of the raw top rows (csv and xlsx only)
+    check           check_pcoded of the tables read
+    process         process_resource end to end, without result cache
+
+Each measurement runs in a forked process so that its peak RSS growth can be told apart, and
+reports the median wall time of the repeats and the bytes downloaded per repeat. Run from
+the repository root to compare with the baseline:
+
+    python -m benchmarks.suite --threshold 0.25
+
+The run fails with exit status 1 when any measurement is worse than the baseline by more than the
+threshold and by more than a noise floor, or when there is no baseline. benchmarks/baseline.json is
+committed, recorded with the default kinds, sizes and repeats. Wall times depend on the machine, so
+on another machine record a baseline of its own from the base commit before comparing a change:
+
+    python -m benchmarks.suite --save-baseline --baseline saved_data/baseline.json
+    python -m benchmarks.suite --baseline saved_data/baseline.json
+
+Replace the committed baseline with --save-baseline alone when a change is meant to move it.
+"""
+import argparse
+import logging
+import sys
+from functools import partial
+from json import dump, load
+from multiprocessing import get_context
+from os.path import getsize, isfile, join
+from resource import RUSAGE_SELF, getrusage
+from statistics import median
+from time import perf_counter
+from typing import Callable, Dict, List, Optional
+
+from hdx.api.configuration import Configuration
+from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
+from hdx.utilities.downloader import Download
+from hdx.utilities.path import temp_dir
+from hdx.utilities.retriever import Retrieve
+
+from benchmarks.corpus import KINDS, CorpusResource, CorpusServer, pcode_index, resource_metadata, write_corpus
+from check_pcodes import (
+    check_pcoded,
+    download_resource,
+    parse_tabular,
+    process_resource,
+    read_csv_contents,
+    read_downloaded_data,
+)
+from helper.metrics import get_metrics, trace_resource
+from helper.spreadsheets import Workbook
+from helper.storage import DiskQuota, Workspace
+
+OPERATIONS = ["download", "read", "parse", "check", "process"]
+BASELINE = join("benchmarks", "baseline.json")
+NOISE_SECONDS = 0.01
+NOISE_MB = 5
+
+
+def file_ext(resource: CorpusResource) -> str:
+    return {"geopackage": "gpkg", "geodatabase": "gdb"}.get(resource.format.lower(), resource.format.lower())
+
+
+def make_resource(resource: CorpusResource, server: CorpusServer, folder: str) -> Resource:
+    hdx_resource = Resource()
+    hdx_resource.data = resource_metadata(resource, server.url(resource), getsize(join(folder, resource.path)))
+    return hdx_resource
+
+
+def make_dataset(resource: Resource) -> Dataset:
+    dataset = Dataset()
+    dataset.data = {
+        "name": "benchmark",
+        "archived": False,
+        "groups": [{"name": "afg"}],
+        "organization": {"name": "benchmark"},
+        "resources": [resource.data],
+    }
+    dataset.separate_resources()
+    return dataset
+
+
+class Stage:
+    """Setup and operation of one measurement, run in a forked process"""
+
+    def __init__(self, operation: str, resource: CorpusResource, corpus: str, server: CorpusServer,
+                 configuration: Dict, temp_folder: str) -> None:
+        self.operation = operation
+        self.resource = resource
+        self.corpus = corpus
+        self.server = server
+        self.configuration = configuration
+        self.temp_folder = temp_folder
+        self.file_ext = file_ext(resource)
+        self.max_rows = configuration["adaptive_matching"]["max_rows"]
+
+    def applies(self) -> bool:
+        return self.operation != "parse" or self.file_ext in ["csv", "xlsx"]
+
+    def _download(self, workspace: Workspace, retriever: Retrieve) -> List[str]:
+        hdx_resource = make_resource(self.resource, self.server, self.corpus)
+        files, error = download_resource(
+            hdx_resource, self.file_ext, retriever, workspace, self.configuration["resource_size"]
+        )
+        if error:
+            raise RuntimeError(f"{self.resource.path}: {error}")
+        return files
+
+    def setup(self, downloader: Download) -> Callable[[], object]:
+        """Prepare the inputs of the operation
+
+        Args:
+            downloader (Download): downloader of the forked process
+
+        Returns:
+            Callable[[], object]: the operation to time
+        """
+        retriever = Retrieve(downloader, self.temp_folder, self.temp_folder, self.temp_folder, False, False)
+        quota = DiskQuota(self.configuration["temp_storage"]["quota"])
+        storage = self.configuration["temp_storage"]
+
+        def new_workspace() -> Workspace:
+            return Workspace(self.temp_folder, quota, storage["resource_bytes"], storage["max_ratio"])
+
+        if self.operation == "download":
+            def download():
+                with new_workspace() as workspace:
+                    self._download(workspace, retriever)
+            return download
+
+        if self.operation == "process":
+            hdx_resource = make_resource(self.resource, self.server, self.corpus)
+            dataset = make_dataset(hdx_resource)
+            return partial(process_resource, hdx_resource, dataset, pcode_index(), retriever, self.configuration)
+
+        workspace = new_workspace()  # kept until the forked process ends
+        files = self._download(workspace, retriever)
+        if self.operation == "read":
+            return partial(read_downloaded_data, files, self.file_ext, self.max_rows)
+        if self.operation == "parse":
+            if self.file_ext == "csv":
+                raw = read_csv_contents(files[0], self.max_rows)
+            else:
+                with Workbook(files[0]) as workbook:
+                    raw = workbook.parse(workbook.sheet_names[1], nrows=self.max_rows)
+            return partial(parse_tabular, raw, self.file_ext)
+        contents, _ = read_downloaded_data(files, self.file_ext, self.max_rows)
+        pcodes = pcode_index().lookup(["AFG"])
+        cutoff = self.configuration["percent_match"]
+        return lambda: [check_pcoded(df, pcodes, cutoff) for df in contents.values()]
+
+
+def run_stage(stage: Stage, repeats: int, connection) -> None:
+    logging.disable(logging.CRITICAL)
+    with Download(user_agent="benchmark") as downloader:
+        operation = stage.setup(downloader)
+        rss_before = getrusage(RUSAGE_SELF).ru_maxrss
+        downloaded_before = get_metrics().counter("bytes_downloaded")
+        times = []
+        downloaded = 0
+        for _ in range(repeats):
+            start = perf_counter()
+            with trace_resource("benchmark") as trace:  # process_resource records its own trace in the metrics
+                operation()
+            times.append(perf_counter() - start)
+            downloaded += trace.counts["bytes_downloaded"]
+        rss_after = getrusage(RUSAGE_SELF).ru_maxrss
+        downloaded += get_metrics().counter("bytes_downloaded") - downloaded_before
+    result = {"seconds": median(times), "peak_rss_mb": (rss_after - rss_before) / 1024}
+    if stage.operation in ["download", "process"]:
+        result["bytes_read"] = int(downloaded) // repeats
+    connection.send(result)
+    connection.close()
+
+
+def measure(stage: Stage, repeats: int) -> Dict:
+    """Time an operation in a forked process
+
+    Args:
+        stage (Stage): operation and its inputs
+        repeats (int): number of timed runs
+
+    Returns:
+        Dict: median seconds, peak RSS growth in MB and, for downloads, bytes read per run
+    """
+    context = get_context("fork")
+    receiver, sender = context.Pipe(duplex=False)
+    process = context.Process(target=run_stage, args=(stage, repeats, sender))
+    process.start()
+    sender.close()
+    try:
+        result = receiver.recv()
+    except EOFError:
+        raise RuntimeError(f"Measurement of {stage.operation} on {stage.resource.path} failed")
+    finally:
+        process.join()
+    return result
+
+
+def compare(results: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """Measurements worse than the baseline by more than the threshold and the noise floor
+
+    Args:
+        results (Dict): measurements by key
+        baseline (Dict): baseline measurements by key
+        threshold (float): allowed relative increase, such as 0.25
+
+    Returns:
+        List[str]: description of each regression
+    """
+    floors = {"seconds": NOISE_SECONDS, "peak_rss_mb": NOISE_MB, "bytes_read": 0}
+    regressions = []
+    for key, result in results.items():
+        if key not in baseline:
+            continue
+        for metric, floor in floors.items():
+            if metric not in result or metric not in baseline[key]:
+                continue
+            before, after = baseline[key][metric], result[metric]
+            if after > before * (1 + threshold) and after - before > floor:
+                regressions.append(f"{key} {metric}: {before:.4g} -> {after:.4g}")
+    return regressions
+
+
+def main(kinds: List[str], sizes: List[int], repeats: int, baseline_path: str, save_baseline: bool,
+         threshold: float, operations: Optional[List[str]] = None) -> int:
+    Configuration._create(  # no request is made to HDX
+        hdx_read_only=True,
+        hdx_site="prod",
+        user_agent="PCodesDetectorBenchmark",
+        project_config_yaml=join("config", "project_configuration.yml"),
+    )
+    configuration = Configuration.read()
+    results = dict()
+    with temp_dir(folder="BenchmarkSuite") as folder:
+        corpus = join(folder, "corpus")
+        resources = write_corpus(corpus, kinds, sizes)
+        with CorpusServer(corpus) as server:
+            print(f"{'operation':<10} {'resource':<18} {'seconds':>9} {'peak RSS (MB)':>14} {'bytes read':>11}")
+            for operation in operations or OPERATIONS:
+                for resource in resources:
+                    stage = Stage(operation, resource, corpus, server, configuration, folder)
+                    if not stage.applies():
+                        continue
+                    key = f"{operation}/{resource.kind}/{resource.rows}"
+                    results[key] = measure(stage, repeats)
+                    result = results[key]
+                    print(
+                        f"{operation:<10} {resource.kind + '/' + str(resource.rows):<18} {result['seconds']:>9.4f} "
+                        f"{result['peak_rss_mb']:>14.1f} {result.get('bytes_read', ''):>11}"
+                    )
+
+    if save_baseline:
+        with open(baseline_path, "w") as f:
+            dump(results, f, indent=2, sort_keys=True)
+        print(f"Saved baseline to {baseline_path}")
+        return 0
+    if not isfile(baseline_path):
+        print(f"No baseline at {baseline_path}, run with --save-baseline first")
+        return 1
+    with open(baseline_path) as f:
+        baseline = load(f)
+    regressions = compare(results, baseline, threshold)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    print(f"{len(regressions)} regressions against {baseline_path} with threshold {threshold:.0%}")
+    return 1 if regressions else 0
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark the p-code detection pipeline on a synthetic corpus")
+    parser.add_argument("--kinds", nargs="+", default=KINDS, choices=KINDS, help="kinds of resources")
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 50000], help="numbers of rows")
+    parser.add_argument("--operations", nargs="+", choices=OPERATIONS, help="operations to measure, all by default")
+    parser.add_argument("--repeats", type=int, default=5, help="timed runs per measurement")
+    parser.add_argument("--baseline", default=BASELINE, help="baseline file")
+    parser.add_argument("--save-baseline", action="store_true", help="store the results as the new baseline")
+    parser.add_argument("--threshold", type=float, default=0.25, help="allowed relative increase over the baseline")
+    args = parser.parse_args()
+    sys.exit(main(args.kinds, args.sizes, args.repeats, args.baseline, args.save_baseline, args.threshold,
+                  args.operations))
@@ -0,0 +1,91 @@
+"""Microbenchmark of header and HXL row detection on wide frames.
+
+Compares tabular_layout and pcode_header_positions with the previous implementation, which ran
+re.match on every cell of the top rows and merged headers with per-column Python loops, kept here
+for reference. Both must give the same layout. Run from the repository root:
+
+    python -m benchmarks.tabular --columns 500 1000 2000
+"""
+import argparse
+import re
+from random import Random
+from timeit import repeat
+
+from pandas import DataFrame, isna
+
+from check_pcodes import TabularLayout, is_pcode_header, pcode_header_positions, tabular_layout
+
+
+def previous_layout(df: DataFrame, file_ext: str) -> TabularLayout:
+    sample_rows = len(df)
+    df = df.dropna(how="all", axis=0)
+    labels = list(df.index)
+    columns = [i for i, filled in enumerate(df.notna().any(axis=0)) if filled]
+    df = df.iloc[:, columns].reset_index(drop=True)
+    names = [str(c) for c in df.columns]
+    start = 0
+    if all([bool(re.match("Unnamed.*", c)) for c in names]):
+        names = [str(c) if not isna(c) else f"Unnamed: {i}" for i, c in enumerate(df.loc[0])]
+        df = df.drop(index=0).reset_index(drop=True)
+        start = 1
+    if not all(df.dtypes == "object") or len(df) == 1:
+        return TabularLayout(columns, names, labels[start:], sample_rows)
+    hxlrow = None
+    i = 0
+    while i < 10 and i < len(df) and hxlrow is None:
+        hxltags = [bool(re.match("#.*", t)) if t else True for t in df.loc[i].astype(str)]
+        if all(hxltags):
+            hxlrow = i
+        i += 1
+    if hxlrow is not None:
+        datarow = hxlrow + 1
+    elif file_ext == "csv":
+        return TabularLayout(columns, names, labels[start:], sample_rows)
+    else:
+        datarow = min(3, len(df))
+    headers = []
+    for j, c in enumerate(names):
+        cols = [str(col) for col in df.iloc[:datarow, j] if col]
+        if "Unnamed" not in c:
+            cols = [c] + cols
+        headers.append("||".join(cols))
+    return TabularLayout(columns, headers, labels[start + datarow:], sample_rows)
+
+
+def wide_frame(columns: int, rows: int = 200, seed: int = 0) -> DataFrame:
+    random = Random(seed)
+    data = {}
+    for j in range(columns):
+        name = "adm1_pcode" if j % 50 == 0 else f"Unnamed: {j}" if j % 7 == 0 else f"indicator {j}"
+        tag = "#adm1+code" if j % 50 == 0 else f"#indicator+i{j}"
+        values = [f"AF{random.randint(1, 34):02d}" if j % 50 == 0 else str(random.random()) for _ in range(rows)]
+        data[name] = ["description", tag] + values
+    return DataFrame(data, dtype=object)
+
+
+def main(column_counts, number):
+    print(f"{'columns':>8} {'previous (ms)':>14} {'vectorized (ms)':>16} {'speedup':>8}")
+    for columns in column_counts:
+        df = wide_frame(columns)
+        expected = previous_layout(df, "xlsx")
+        assert tabular_layout(df, "xlsx") == expected
+
+        def previous():
+            layout = previous_layout(df, "xlsx")
+            return [i for i, name in enumerate(layout.names) if is_pcode_header(name)]
+
+        def vectorized():
+            return pcode_header_positions(tabular_layout(df, "xlsx").names)
+
+        assert previous() == vectorized()
+        before = min(repeat(previous, number=number, repeat=3)) / number * 1000
+        after = min(repeat(vectorized, number=number, repeat=3)) / number * 1000
+        print(f"{columns:>8} {before:>14.1f} {after:>16.1f} {before / after:>7.1f}x")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmark header detection on wide frames")
+    parser.add_argument("--columns", type=int, nargs="+", default=[500, 1000, 2000], help="frame widths")
+    parser.add_argument("--number", type=int, default=5, help="runs per measurement")
+    args = parser.parse_args()
+    main(args.columns, args.number)
@@ -2,275 +2,829 @@ from email import message
 import gzip
 import logging
 import re
-from fiona import listlayers
-from geopandas import read_file
 from glob import glob
-from os import mkdir, remove
+from importlib import import_module
+from io import BytesIO
+from math import sqrt
+from resource import RUSAGE_SELF, getrusage
 from os.path import basename, dirname, join
-from pandas import DataFrame, isna, read_csv, read_excel
+from numpy import array, bincount, char, flatnonzero, full, ndarray, where
+from pandas import DataFrame, Index, Series, isna, read_csv
 from requests import head
-from shutil import copyfileobj, rmtree
-from typing import Dict, List, Optional, Tuple
+from statistics import NormalDist
+from threading import Event, Thread
+from time import perf_counter
+from functools import partial
+from typing import TYPE_CHECKING, Callable, Dict, List, NamedTuple, Optional, Tuple
 from zipfile import ZipFile, is_zipfile
 
 from hdx.data.dataset import Dataset
 from hdx.data.resource import Resource
-from hdx.utilities.dictandlist import dict_of_lists_add
+from hdx.utilities.base_downloader import DownloadError
+from hdx.utilities.downloader import Download
+from hdx.utilities.path import temp_dir
 from hdx.utilities.retriever import Retrieve
 from hdx.utilities.uuid import get_uuid
-from helper.ckan import patch_resource_with_pcode_value
-from slack import get_slack_client
+from helper.archives import HttpRangeFile, RangeNotSupported, extract_members
+from helper.ckan import PcodeUpdateClient, get_pcode_update_client
+from helper.isolation import MemoryLimitExceeded, get_isolation_pool, get_shared
+from helper.metrics import count, set_format, timed, trace_resource
+from helper.pcodes import PcodeIndex, PcodeSnapshot
+from helper.result_cache import ResultCache, content_digest, file_digest, scoped_key
+from helper.storage import DiskQuota, SizeLimitExceeded, Workspace
+from helper.streaming import ArchiveContent, StreamedText
+from slack import get_slack_notifier
+
+if TYPE_CHECKING:
+    from helper.spreadsheets import Workbook
 
 logger = logging.getLogger(__name__)
 
-
-def get_global_pcodes(dataset_info: Dict, retriever: Retrieve, locations: Optional[List[str]] = None) -> Dict:
+HEADER_ROWS = 20
+HEADER_EXP = re.compile(r"((adm)?.*p?.?cod.*)|(#\s?adm\s?\d?\+?\s?p?(code)?)", re.IGNORECASE)
+# HEADER_EXP matched against each || separated part of a header, as a single search of the whole header
+HEADER_SEARCH_EXP = re.compile(r"cod|(?:^|\|\|)#\s?adm", re.IGNORECASE)
+
+# GDAL and the Excel engines are only imported when the first resource of a format that needs them arrives
+FORMAT_MODULES = {
+    "xls": ["helper.spreadsheets"],
+    "xlsx": ["helper.spreadsheets"],
+    "geojson": ["pyogrio"],
+    "json": ["pyogrio"],
+    "shp": ["pyogrio"],
+    "topojson": ["pyogrio"],
+    "gdb": ["pyogrio", "fiona"],
+    "gpkg": ["pyogrio", "fiona"],
+}
+_loaded_formats = set()
+
+
+def get_global_pcodes_resource(dataset_info: Dict) -> Resource:
     dataset = Dataset.read_from_hdx(dataset_info["dataset"])
     resource = [r for r in dataset.get_resources() if r["name"] == dataset_info["name"]]
-    headers, iterator = retriever.get_tabular_rows(resource[0]["url"], dict_form=True)
+    return resource[0]
+
+
+def get_global_pcodes_version(resource: Resource) -> str:
+    return "|".join([str(resource.get(key) or "") for key in ["id", "last_modified", "hash"]])
 
-    pcodes = {"WORLD": []}
+
+def read_global_pcodes(dataset_info: Dict, resource: Resource, retriever: Retrieve) -> List[Tuple]:
+    headers, iterator = retriever.get_tabular_rows(resource["url"], dict_form=True)
     next(iterator)
-    for row in iterator:
-        pcode = row[dataset_info["p-code"]]
-        iso3_code = row[dataset_info["admin"]]
-        if locations and iso3_code not in locations and "WORLD" not in locations:
-            continue
-        dict_of_lists_add(pcodes, iso3_code, pcode)
-        pcodes["WORLD"].append(pcode)
+    level = dataset_info.get("level")
+    if level in headers:
+        return [(row[dataset_info["admin"]], row[dataset_info["p-code"]], row[level]) for row in iterator]
+    return [(row[dataset_info["admin"]], row[dataset_info["p-code"]]) for row in iterator]
+
+
+def get_global_pcodes(dataset_info: Dict, retriever: Retrieve, locations: Optional[List[str]] = None) -> PcodeIndex:
+    resource = get_global_pcodes_resource(dataset_info)
+    rows = read_global_pcodes(dataset_info, resource, retriever)
+    return PcodeIndex.from_rows(rows, locations, get_global_pcodes_version(resource))
+
+
+class GlobalPcodes:
+    """Holder for the current global p-code index that is backed by an on-disk snapshot.
+
+    load() returns the snapshot straight away when there is one and only goes to HDX otherwise.
+    start() keeps checking the upstream resource in a background thread and swaps in a new index
+    when its version changes, so long-running listeners pick up a new table without restarting.
+    """
+
+    def __init__(self, dataset_info: Dict) -> None:
+        self.dataset_info = dataset_info
+        self.snapshot = PcodeSnapshot(dataset_info["snapshot_folder"], dataset_info.get("level"))
+        self.refresh_interval = dataset_info["refresh_interval"]
+        self.index = None
+        self._stop = Event()
+        self._thread = None
+
+    def load(self) -> PcodeIndex:
+        start_time = perf_counter()
+        self.index = self.snapshot.load()
+        if self.index is not None:
+            logger.info(f"Loaded p-code snapshot {self.snapshot.version()} in {perf_counter() - start_time:.3f}s")
+            return self.index
+        self.refresh()
+        return self.index
+
+    def refresh(self) -> bool:
+        resource = get_global_pcodes_resource(self.dataset_info)
+        version = get_global_pcodes_version(resource)
+        if self.index is not None and version == self.snapshot.version():
+            return False
+        with temp_dir(folder="TempPCodeDetector") as temp_folder:
+            with Download(rate_limit={"calls": 1, "period": 0.1}) as downloader:
+                retriever = Retrieve(
+                    downloader, temp_folder, "saved_data", temp_folder, save=False, use_saved=False
+                )
+                rows = read_global_pcodes(self.dataset_info, resource, retriever)
+        self.snapshot.save(version, rows)
+        self.index = PcodeIndex.from_rows(rows, version=version)
+        logger.info(f"Refreshed global p-codes to version {version}")
+        return True
+
+    def start(self) -> None:
+        if self._thread is not None or not self.refresh_interval:
+            return
+        self._thread = Thread(target=self._run, name="GlobalPcodesRefresh", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run(self) -> None:
+        while not self._stop.is_set():
+            try:
+                self.refresh()
+            except Exception:
+                logger.exception("Unable to refresh global p-codes")
+            self._stop.wait(self.refresh_interval)
+
+
+def load_readers(file_ext: str) -> None:
+    """Import the modules needed to read a format, logging what the first import costs
+
+    Args:
+        file_ext (str): format of the resource
+
+    Returns:
+        None
+    """
+    if file_ext in _loaded_formats:
+        return
+    start_time, start_rss = perf_counter(), getrusage(RUSAGE_SELF).ru_maxrss
+    for module in FORMAT_MODULES.get(file_ext, []):
+        import_module(module)
+    _loaded_formats.add(file_ext)
+    seconds, rss_mb = perf_counter() - start_time, (getrusage(RUSAGE_SELF).ru_maxrss - start_rss) / 1024
+    logger.info(
+        f"Loaded readers of {file_ext} in {seconds:.2f}s",
+        extra={"startup": {"format": file_ext, "seconds": round(seconds, 6), "peak_rss_mb": round(rss_mb, 1)}},
+    )
+
+
+def list_layers(path: str) -> List[str]:
+    from fiona import listlayers
+
+    return listlayers(path)
+
+
+def find_resource_files(parent_folder: str, file_ext: str) -> List[str]:
+    resource_files = glob(join(parent_folder, "**", f"*.{file_ext}"), recursive=True)
+    if len(resource_files) > 1:  # make sure to remove directories containing the actual files
+        resource_files = [r for r in resource_files
+                          if sum([r in rs for rs in resource_files if not rs == r]) == 0]
+    return resource_files
+
 
-    return pcodes
+def download_zip_members(
+    url: str, file_ext: str, retriever: Retrieve, workspace: Workspace
+) -> Tuple[List or None, str or None]:
+    try:
+        remote_file = HttpRangeFile(retriever.downloader, url)
+    except (DownloadError, RangeNotSupported):  # fall back to downloading the whole file
+        return None, None
 
+    parent_folder = workspace.subfolder()
+    try:
+        with remote_file as remote:
+            with ZipFile(remote, "r") as z:
+                extract_members(z, file_ext, parent_folder, workspace)
+        logger.info(f"Read {remote_file.bytes_read} of {remote_file.size} bytes of {url}")
+        count("bytes_downloaded", remote_file.bytes_read)
+    except SizeLimitExceeded as exc:
+        logger.warning(str(exc))
+        error = f"Resource is too large"
+        return [], error
+    except:
+        error = f"Unable to unzip resource"
+        return [], error
+    resource_files = find_resource_files(parent_folder, file_ext)
+    if file_ext == "xlsx" and len(resource_files) == 0:  # the workbook itself is served from a .zip url
+        return None, None
+    if file_ext in ["gdb", "gpkg"]:
+        resource_files = [join(r, i) for r in resource_files for i in list_layers(r)]
+    return resource_files, None
+
+
+def download_resource(
+    resource: Resource, file_ext: str, retriever: Retrieve, workspace: Workspace, max_bytes: int
+) -> Tuple[List or None, str or None]:
+    if ".zip" in basename(resource["url"]) and not retriever.use_saved:
+        with timed("download"):
+            resource_files, error = download_zip_members(resource["url"], file_ext, retriever, workspace)
+        if resource_files is not None:  # otherwise the server does not support range requests so download the whole file
+            return resource_files, error
 
-def download_resource(resource: Resource, file_ext: str, retriever: Retrieve) -> Tuple[List or None, str or None, str or None]:
     try:
-        resource_file = retriever.download_file(resource["url"])
+        with timed("download"):
+            resource_file = workspace.download(retriever, resource["url"], max_bytes)
+    except SizeLimitExceeded as exc:
+        logger.warning(str(exc))
+        error = f"Resource is too large"
+        return None, error
     except:
         error = f"Unable to download file"
-        return None, None, error
+        return None, error
 
     if file_ext in ["xls", "xlsx"] and ".zip" not in basename(resource_file):
         resource_files = [resource_file]
-        return resource_files, None, None
+        return resource_files, None
 
     if is_zipfile(resource_file) or ".zip" in basename(resource_file) or ".gz" in basename(resource_file):
-        parent_folder = join(retriever.temp_dir, get_uuid())
-        parent_folders = [parent_folder, resource_file]
-        if ".gz" in basename(resource_file):
-            try:
-                mkdir(parent_folder)
-                with gzip.open(resource_file, "rb") as gz:
-                    with open(join(parent_folder, basename(resource_file.replace(".gz", ".gpkg"))), "wb") as gz_out:
-                        copyfileobj(gz, gz_out)
-            except:
-                error = f"Unable to unzip resource"
-                return None, parent_folders, error
-        else:
-            try:
-                with ZipFile(resource_file, "r") as z:
-                    z.extractall(parent_folder)
-            except:
-                error = f"Unable to unzip resource"
-                return None, parent_folders, error
-        resource_files = glob(join(parent_folder, "**", f"*.{file_ext}"), recursive=True)
-        if len(resource_files) > 1:  # make sure to remove directories containing the actual files
-            resource_files = [r for r in resource_files
-                              if sum([r in rs for rs in resource_files if not rs == r]) == 0]
+        parent_folder = workspace.subfolder()
+        try:
+            with timed("unzip"):
+                if ".gz" in basename(resource_file):
+                    with gzip.open(resource_file, "rb") as gz:
+                        workspace.copy(gz, join(parent_folder, basename(resource_file.replace(".gz", ".gpkg"))))
+                else:
+                    with ZipFile(resource_file, "r") as z:
+                        extract_members(z, file_ext, parent_folder, workspace)
+        except SizeLimitExceeded as exc:
+            logger.warning(str(exc))
+            error = f"Resource is too large"
+            return None, error
+        except:
+            error = f"Unable to unzip resource"
+            return None, error
+        resource_files = find_resource_files(parent_folder, file_ext)
         if file_ext == "xlsx" and len(resource_files) == 0:
             resource_files = [resource_file]
         if file_ext in ["gdb", "gpkg"]:
-            resource_files = [join(r, i) for r in resource_files for i in listlayers(r)]
+            resource_files = [join(r, i) for r in resource_files for i in list_layers(r)]
 
     elif file_ext in ["gdb", "gpkg"] and ".zip" not in basename(resource_file) and ".gz" not in basename(resource_file):
-        resource_files = [join(resource_file, r) for r in listlayers(resource_file)]
-        parent_folders = [resource_file]
+        resource_files = [join(resource_file, r) for r in list_layers(resource_file)]
 
     else:
         resource_files = [resource_file]
-        parent_folders = None
 
-    return resource_files, parent_folders, None
+    return resource_files, None
+
+
+def read_csv_contents(contents: bytes or str, nrows: int, usecols: Optional[List[int]] = None) -> DataFrame or None:
+    try:
+        return read_csv(
+            BytesIO(contents) if isinstance(contents, bytes) else contents,
+            nrows=nrows, usecols=usecols, skip_blank_lines=True, on_bad_lines="skip",
+        )
+    except:
+        try:
+            return read_csv(
+                BytesIO(contents) if isinstance(contents, bytes) else contents,
+                nrows=nrows, usecols=usecols, skip_blank_lines=True, on_bad_lines="skip", encoding="latin-1",
+            )
+        except:
+            return None
+
+
+def stream_csv_text(
+    url: str, retriever: Retrieve, nrows: int, max_bytes: Optional[int] = None
+) -> Tuple[bytes or None, str or None]:
+    if retriever.use_saved:
+        url = retriever.download_file(url)
+    try:
+        with StreamedText(retriever.downloader, url, max_bytes=max_bytes) as stream:
+            nlines = nrows + 1
+            while True:
+                text = stream.read_lines(nlines)
+                counted = read_csv_contents(text, nrows, usecols=[0])
+                if stream.exhausted or (counted is not None and len(counted) >= nrows):
+                    break
+                nlines *= 2
+            logger.info(f"Read {stream.bytes_read} bytes of {url}")
+            count("bytes_downloaded", stream.bytes_read)
+    except ArchiveContent:  # mislabelled archive, let download_resource extract it
+        return None, None
+    except SizeLimitExceeded as exc:
+        logger.warning(str(exc))
+        error = f"Resource is too large"
+        return None, error
+    except:
+        error = f"Unable to download file"
+        return None, error
+    return text, None
+
+
+def read_csv_text(text: bytes, nrows: int) -> Tuple[Dict, str or None]:
+    contents = read_tabular(partial(read_csv_contents, text), "csv", nrows)
+    if contents is None:
+        error = f"Unable to read resource"
+        return dict(), error
+    return {get_uuid(): contents}, None
+
+
+def read_attributes(path: str, nrows: int, layer: Optional[str] = None, header_filter: bool = True) -> DataFrame:
+    from pyogrio import read_dataframe, read_info
+
+    columns = None
+    if header_filter:  # only read attribute columns that could hold p-codes
+        fields = read_info(path, layer=layer)["fields"]
+        columns = [fields[i] for i in pcode_header_positions(list(fields))]
+        if len(columns) == 0:
+            return DataFrame()
+    return read_dataframe(path, layer=layer, columns=columns, read_geometry=False, max_features=nrows)
+
+
+def read_tabular(
+    read_frame: Callable[..., DataFrame or None], file_ext: str, nrows: int, skip_empty: bool = False
+) -> DataFrame or None:
+    if nrows <= HEADER_ROWS:
+        contents = read_frame(nrows=nrows)
+        if contents is None or (skip_empty and contents.empty):
+            return None
+        with timed("parse"):
+            return parse_tabular(contents, file_ext)
+
+    sample = read_frame(nrows=HEADER_ROWS)  # work out the header from the top rows only
+    if sample is None or (skip_empty and sample.empty):
+        return None
+    with timed("parse"):
+        layout = tabular_layout(sample, file_ext)
+        if len(sample) < HEADER_ROWS:  # the sample already holds all the data
+            return apply_layout(sample, layout)
+        # columns that are empty in the sample are left out of the layout, but a p-code column may only be
+        # filled further down, so those with a p-code header are read too and dropped if they stay empty
+        blank = [
+            (i, str(sample.columns[i])) for i in pcode_header_positions([str(c) for c in sample.columns])
+            if i not in layout.columns
+        ]
+        if blank:
+            columns = sorted(list(zip(layout.columns, layout.names)) + blank)
+            layout = layout._replace(columns=[i for i, _ in columns], names=[name for _, name in columns])
+    candidates = pcode_header_positions(layout.names)
+    if len(candidates) == 0:
+        return DataFrame()
+    contents = read_frame(nrows=nrows, usecols=[layout.columns[i] for i in candidates])
+    if contents is None:
+        return None
+    with timed("parse"):
+        contents = apply_layout(contents, layout, candidates)
+        return contents.dropna(how="all", axis=1) if blank else contents
+
+
+def read_workbook(workbook: "Workbook", file_ext: str, nrows: int) -> Dict:
+    data = dict()
+    for sheet_name in workbook.sheet_names:
+        contents = read_tabular(partial(workbook.parse, sheet_name), file_ext, nrows, skip_empty=True)
+        if contents is None:
+            continue
+        data[get_uuid()] = contents
+    return data
+
+
+def read_csv_file(resource_file: str, file_ext: str, nrows: int, workbooks: Optional[Dict] = None) -> Dict or None:
+    contents = read_tabular(partial(read_csv_contents, resource_file), file_ext, nrows)
+    if contents is None:
+        return None
+    return {get_uuid(): contents}
+
+
+def read_excel_file(resource_file: str, file_ext: str, nrows: int, workbooks: Optional[Dict] = None) -> Dict:
+    from helper.spreadsheets import Workbook
+
+    if workbooks is None:  # only this read, otherwise keep workbooks open for the next ones
+        with Workbook(resource_file) as workbook:
+            return read_workbook(workbook, file_ext, nrows)
+    if resource_file not in workbooks:
+        workbooks[resource_file] = Workbook(resource_file)
+    return read_workbook(workbooks[resource_file], file_ext, nrows)
+
+
+def read_vector_file(resource_file: str, file_ext: str, nrows: int, workbooks: Optional[Dict] = None) -> Dict:
+    return {get_uuid(): read_attributes(resource_file, nrows)}
+
 
+def read_layer_file(resource_file: str, file_ext: str, nrows: int, workbooks: Optional[Dict] = None) -> Dict:
+    # resource_file is the path of a layer inside a geodatabase or geopackage
+    return {get_uuid(): read_attributes(dirname(resource_file), nrows, layer=basename(resource_file))}
 
-def read_downloaded_data(resource_files: List[str], file_ext: str, nrows: int) -> Tuple[Dict, str]:
+
+READERS = {
+    "csv": read_csv_file,
+    "xls": read_excel_file,
+    "xlsx": read_excel_file,
+    "geojson": read_vector_file,
+    "json": read_vector_file,
+    "shp": read_vector_file,
+    "topojson": read_vector_file,
+    "gdb": read_layer_file,
+    "gpkg": read_layer_file,
+}
+
+
+def read_downloaded_data(
+    resource_files: List[str], file_ext: str, nrows: int, workbooks: Optional[Dict[str, "Workbook"]] = None
+) -> Tuple[Dict, str]:
     data = dict()
     error = None
+    reader = READERS[file_ext]
     for resource_file in resource_files:
-        if file_ext in ["xlsx", "xls"]:
-            try:
-                contents = read_excel(
-                    resource_file, sheet_name=None, nrows=nrows
-                )
-            except:
-                error = f"Unable to read resource"
-                continue
-            for key in contents:
-                if contents[key].empty:
-                    continue
-                data[get_uuid()] = parse_tabular(contents[key], file_ext)
-        if file_ext == "csv":
-            try:
-                contents = read_csv(resource_file, nrows=nrows, skip_blank_lines=True, on_bad_lines="skip")
-            except:
-                try:
-                    contents = read_csv(
-                        resource_file, nrows=nrows, skip_blank_lines=True, on_bad_lines="skip", encoding="latin-1"
-                    )
-                except:
-                    error = f"Unable to read resource"
-                    continue
-            data[get_uuid()] = parse_tabular(contents, file_ext)
-        if file_ext in ["geojson", "json", "shp", "topojson"]:
-            try:
-                data = {
-                    get_uuid(): read_file(resource_file, rows=nrows)
-                }
-            except:
-                error = f"Unable to read resource"
-                continue
-        if file_ext in ["gdb", "gpkg"]:
-            try:
-                data = {
-                    get_uuid(): read_file(dirname(resource_file), layer=basename(resource_file), rows=nrows)
-                }
-            except:
-                error = f"Unable to read resource"
-                continue
+        try:
+            contents = reader(resource_file, file_ext, nrows, workbooks)
+        except:
+            contents = None
+        if contents is None:
+            error = f"Unable to read resource"
+            continue
+        data.update(contents)
 
     return data, error
 
 
-def parse_tabular(df: DataFrame, file_ext: str) -> DataFrame:
-    df = df.dropna(how="all", axis=0).dropna(how="all", axis=1).reset_index(drop=True)
-    df.columns = [str(c) for c in df.columns]
-    if all([bool(re.match("Unnamed.*", c)) for c in df.columns]):  # if all columns are unnamed, move down a row
-        df.columns = [str(c) if not isna(c) else f"Unnamed: {i}" for i, c in enumerate(df.loc[0])]
+class TabularLayout(NamedTuple):
+    columns: List[int]  # positions of the kept columns in the frame as read
+    names: List[str]  # header of each kept column, including merged HXL and header rows
+    rows: List  # index labels of the data rows in the frame the layout was built from
+    sample_rows: int  # number of rows in the frame the layout was built from
+
+
+def tabular_layout(df: DataFrame, file_ext: str) -> TabularLayout:
+    sample_rows = len(df)
+    filled = df.notna().to_numpy()
+    rows = filled.any(axis=1)
+    labels = list(df.index[rows])
+    columns = flatnonzero(filled[rows].any(axis=0)).tolist()
+    df = df.iloc[rows, columns].reset_index(drop=True)
+    names = [str(c) for c in df.columns]
+    start = 0
+    if char.startswith(array(names, dtype=str), "Unnamed").all():  # if all columns are unnamed, move down a row
+        names = [str(c) if not isna(c) else f"Unnamed: {i}" for i, c in enumerate(df.iloc[0])]
         df = df.drop(index=0).reset_index(drop=True)
+        start = 1
     if not all(df.dtypes == "object"):  # if there are mixed types, probably read correctly
-        return df
+        return TabularLayout(columns, names, labels[start:], sample_rows)
     if len(df) == 1:  # if there is only one row, return
-        return df
-    hxlrow = None  # find hxl row and incorporate into header
-    i = 0
-    while i < 10 and i < len(df) and hxlrow is None:
-        hxltags = [bool(re.match("#.*", t)) if t else True for t in df.loc[i].astype(str)]
-        if all(hxltags):
-            hxlrow = i
-        i += 1
-    if hxlrow is not None:
-        columns = []
-        for c in df.columns:
-            cols = [str(col) for col in df[c][:hxlrow + 1] if col]
-            if "Unnamed" not in c:
-                cols = [c] + cols
-            columns.append("||".join(cols))
-        df.columns = columns
-        df = df.drop(index=range(hxlrow + 1)).reset_index(drop=True)
-        return df
-    if file_ext == "csv" and not hxlrow:  # assume first row of csv is header if there are no hxl tags
-        return df
-    columns = []
-    datarow = 3
-    if hxlrow:
-        datarow = hxlrow + 1
-    if len(df) < 3:
-        datarow = len(df)
-    for c in df.columns:
-        cols = [str(col) for col in df[c][:datarow] if col]
-        if "Unnamed" not in c:
-            cols = [c] + cols
-        columns.append("||".join(cols))
-    df.columns = columns
-    df = df.drop(index=range(datarow)).reset_index(drop=True)
+        return TabularLayout(columns, names, labels[start:], sample_rows)
+    top = df.iloc[:10].to_numpy(dtype=object)
+    text = top.astype(str)
+    hxlrows = flatnonzero((char.startswith(text, "#") | (text == "")).all(axis=1))  # find hxl row
+    if len(hxlrows) > 0:
+        datarow = int(hxlrows[0]) + 1
+    elif file_ext == "csv":  # assume first row of csv is header if there are no hxl tags
+        return TabularLayout(columns, names, labels[start:], sample_rows)
+    else:
+        datarow = min(3, len(df))
+    # merge the header rows and the hxl row into the column names, skipping empty cells
+    headers = array(names, dtype=object)
+    started = char.find(array(names, dtype=str), "Unnamed") < 0
+    headers[~started] = ""
+    for row, row_filled in zip(text[:datarow].astype(object), top[:datarow].astype(bool)):
+        merged = where(started, headers + "||" + row, row)
+        headers = where(row_filled, merged, headers)
+        started = started | row_filled
+    return TabularLayout(columns, headers.tolist(), labels[start + datarow:], sample_rows)
+
+
+def apply_layout(df: DataFrame, layout: TabularLayout, keep: Optional[List[int]] = None) -> DataFrame:
+    if keep is None:  # df was read with all columns, otherwise only with the columns in keep
+        keep = list(range(len(layout.columns)))
+        df = df.iloc[:, layout.columns]
+    rows = df.index.isin(layout.rows) | (df.index >= layout.sample_rows)
+    df = df.iloc[rows].dropna(how="all", axis=0).reset_index(drop=True)
+    df.columns = [layout.names[i] for i in keep]
     return df
 
 
-def check_pcoded(df: DataFrame, pcodes: List[str], match_cutoff: float) -> bool:
-    pcoded = None
-    header_exp = "((adm)?.*p?.?cod.*)|(#\s?adm\s?\d?\+?\s?p?(code)?)"
-
-    for h in df.columns:
-        if pcoded:
-            break
-        headers = h.split("||")
-        pcoded_header = any([bool(re.match(header_exp, hh, re.IGNORECASE)) for hh in headers])
-        if not pcoded_header:
-            continue
-        column = df[h].dropna().astype("string").str.upper()
-        column = column[~column.isin(["NA", "NAN", "NONE", "NULL", ""])]
-        if len(column) == 0:
+def parse_tabular(df: DataFrame, file_ext: str) -> DataFrame:
+    return apply_layout(df, tabular_layout(df, file_ext))
+
+
+def is_pcode_header(header: str) -> bool:
+    return any([bool(HEADER_EXP.match(h)) for h in header.split("||")])
+
+
+def pcode_header_positions(headers: List[str]) -> List[int]:
+    return flatnonzero(Series(headers, dtype=object).str.contains(HEADER_SEARCH_EXP).to_numpy(dtype=bool)).tolist()
+
+
+class ColumnMatch(NamedTuple):
+    matches: int  # number of values that are p-codes
+    total: int  # number of values that are not empty
+    level: int or None  # admin level of most of the matching p-codes, None if unknown
+
+
+def column_match_counts(df: DataFrame, pcodes: Index, levels: Optional[ndarray] = None) -> Dict[str, ColumnMatch]:
+    """Matches of every candidate p-code column of a table, found in a single pass over all of them
+
+    Args:
+        df (DataFrame): table
+        pcodes (Index): p-codes of the locations of the dataset
+        levels (Optional[ndarray]): admin level of each of the p-codes, as from PcodeIndex.lookup_levels
+
+    Returns:
+        Dict[str, ColumnMatch]: matches of each candidate column that is not empty
+    """
+    counts = dict()
+    positions = pcode_header_positions([str(h) for h in df.columns])
+    if not positions or len(df) == 0:
+        count("columns_tested", 0)
+        return counts
+    # candidate columns are stacked one after the other, normalised and looked up at once
+    values = df.iloc[:, positions].to_numpy(dtype=object).ravel(order="F")
+    present = flatnonzero(~isna(values))
+    text = Series(values[present], dtype=object).astype("string").str.upper()
+    valid = ~text.isin(["NA", "NAN", "NONE", "NULL", ""]).to_numpy(dtype=bool)
+    found = full(len(values), -2)  # -2 for empty values, -1 for values that are not p-codes
+    found[present[valid]] = pcodes.get_indexer(text[valid].to_numpy(dtype=object))
+    found = found.reshape(len(positions), len(df))
+    totals = (found >= -1).sum(axis=1)
+    matches = (found >= 0).sum(axis=1)
+    for row, i in enumerate(positions):
+        if totals[row] == 0:
             continue
-        matches = sum(column.isin(pcodes))
-        pcnt_match = matches / len(column)
+        level = None
+        if levels is not None and matches[row]:
+            column_levels = levels[found[row][found[row] >= 0]]
+            column_levels = column_levels[column_levels >= 0]
+            if len(column_levels):
+                level = int(bincount(column_levels).argmax())
+        counts[df.columns[i]] = ColumnMatch(int(matches[row]), int(totals[row]), level)
+    count("columns_tested", len(counts))
+    return counts
+
+
+def find_pcoded_column(
+    df: DataFrame, pcodes: Index, match_cutoff: float, levels: Optional[ndarray] = None
+) -> str or None:
+    return first_pcoded_column(column_match_counts(df, pcodes, levels), match_cutoff)
+
+
+def first_pcoded_column(counts: Dict[str, ColumnMatch], match_cutoff: float) -> str or None:
+    for h, match in counts.items():
+        pcnt_match = match.matches / match.total
         if pcnt_match >= match_cutoff:
-            pcoded = True
+            return h
+
+    return None
+
+
+def match_ratios(counts: Dict[str, ColumnMatch]) -> Dict[str, float]:
+    return {str(h): round(match.matches / match.total, 4) for h, match in counts.items()}
+
+
+def match_bounds(matches: int, total: int, z: float) -> Tuple[float, float]:
+    # Wilson score interval of the proportion of values that are p-codes
+    ratio = matches / total
+    denominator = 1 + z * z / total
+    centre = (ratio + z * z / (2 * total)) / denominator
+    margin = z * sqrt(ratio * (1 - ratio) / total + z * z / (4 * total * total)) / denominator
+    return centre - margin, centre + margin
+
+
+class MatchResult(NamedTuple):
+    column: str or None  # header of the p-coded column, None if there is none
+    contents: int  # number of tables read
+    rows: int  # number of rows requested from each table when the decision was made
+    error: str or None
+    level: int or None = None  # admin level of the p-coded column, None if unknown
+    ratios: Optional[Dict[str, float]] = None  # share of p-codes in each candidate column of the last tables read
+
+
+def match_incrementally(
+    read_contents: Callable[[int], Tuple[Dict, str or None]],
+    pcodes: Index,
+    match_cutoff: float,
+    first_rows: int,
+    max_rows: int,
+    confidence: float,
+    levels: Optional[ndarray] = None,
+) -> MatchResult:
+    z = NormalDist().inv_cdf((1 + confidence) / 2)
+    nrows = first_rows
+    total_rows = None
+    while True:
+        with timed("read"):
+            contents, error = read_contents(nrows)
+        read_rows = sum([len(df) for df in contents.values()])
+        count("rows_parsed", max(read_rows - (total_rows or 0), 0))  # only the rows this read added
+        undecided = False
+        table_counts = list()
+        ratios = dict()
+        for df in contents.values():
+            with timed("match"):
+                counts = column_match_counts(df, pcodes, levels)
+            table_counts.append(counts)
+            ratios.update(match_ratios(counts))
+            for h, match in counts.items():
+                lower, upper = match_bounds(match.matches, match.total, z)
+                if lower >= match_cutoff:
+                    return MatchResult(h, len(contents), nrows, error, match.level, ratios)
+                if upper >= match_cutoff:
+                    undecided = True
+        if not undecided:  # every candidate column is clearly below the cutoff
+            return MatchResult(None, len(contents), nrows, error, None, ratios)
+        if nrows >= max_rows or read_rows == total_rows:  # no more rows to read, decide on the ratios
+            for counts in table_counts:
+                column = first_pcoded_column(counts, match_cutoff)
+                if column is not None:
+                    return MatchResult(column, len(contents), nrows, error, counts[column].level, ratios)
+            return MatchResult(None, len(contents), nrows, error, None, ratios)
+        total_rows = read_rows
+        nrows = min(nrows * 4, max_rows)
+
+
+def match_in_worker(
+    read_contents: Callable[[int], Tuple[Dict, str or None]],
+    locations: Tuple[str, ...],
+    match_cutoff: float,
+    first_rows: int,
+    max_rows: int,
+    confidence: float,
+) -> MatchResult:
+    # runs in an isolated worker process, where the workbooks opened by read_contents are its own and
+    # the p-codes of the locations come from the global p-codes the worker was sent once
+    global_pcodes = get_shared("pcodes")
+    pcodes, levels = global_pcodes.lookup(locations), global_pcodes.lookup_levels(locations)
+    try:
+        return match_incrementally(read_contents, pcodes, match_cutoff, first_rows, max_rows, confidence, levels)
+    finally:
+        for workbook in read_contents.keywords.get("workbooks", dict()).values():
+            workbook.close()
 
-    return pcoded
 
+def check_pcoded(df: DataFrame, pcodes: Index, match_cutoff: float) -> bool:
+    if find_pcoded_column(df, pcodes, match_cutoff) is not None:
+        return True
+    return None
 
-def remove_files(files: List[str] = None, folders: List[str] = None) -> None:
-    if files:
-        to_delete = files
-        if folders:
-            to_delete = files + folders
-    elif folders:
-        to_delete = folders
-    for f in to_delete:
-        try:
-            remove(f)
-        except (FileNotFoundError, NotADirectoryError, PermissionError, TypeError):
-            pass
-        try:
-            rmtree(f)
-        except (FileNotFoundError, NotADirectoryError, PermissionError, TypeError):
-            pass
 
+OUTCOMES = {True: "pcoded", False: "not_pcoded", None: "undetermined"}
 
-def send_to_slack(message: str) -> None:
-    get_slack_client().post_to_slack_channel(message)
 
+class DatasetGates(NamedTuple):
+    eligible: bool  # whether the resources of the dataset are checked at all
+    result: bool or None  # p-coded value of every resource of a dataset that is not eligible
+    reason: str or None  # why the dataset is not eligible
+    pcodes: Index  # p-codes of the locations of the dataset
+    levels: Optional[ndarray] = None  # admin level of each of the p-codes, None if unknown
+    locations: Tuple[str, ...] = tuple()  # location key the p-codes were looked up for
 
-def process_resource(
-    resource: Resource,
-    dataset: Dataset,
-    global_pcodes: Dict,
-    retriever: Retrieve,
-    configuration: Dict,
-    update: Optional[bool] = False,
-    flag: Optional[bool] = False,
-    cleanup: Optional[bool] = False,
-) -> bool or None:
-    pcoded = None
 
+def check_dataset(dataset: Dataset, global_pcodes: PcodeIndex, configuration: Dict) -> DatasetGates:
+    """Checks that are the same for all resources of a dataset, done once per dataset
+
+    Args:
+        dataset (Dataset): HDX dataset
+        global_pcodes (PcodeIndex): global p-codes
+        configuration (Dict): HDX configuration
+
+    Returns:
+        DatasetGates: whether the resources are checked and the p-codes to match them against
+    """
+    no_pcodes = Index([])
     if dataset["archived"]:
-        return None
+        return DatasetGates(False, None, "archived", no_pcodes)
 
     updated_by_script = dataset.get("updated_by_script", "").lower()
     package_creator = dataset.get("package_creator", "").lower()
     if package_creator == "hdx data systems team" or "hdx scraper" in updated_by_script:
-        return None
+        return DatasetGates(False, None, "maintained by a script", no_pcodes)
 
     locations = [loc["name"].upper() for loc in dataset.data.get("groups", [])]
-    pcodes = [pcode for iso in global_pcodes for pcode in global_pcodes[iso] if iso in locations]
+    pcodes = global_pcodes.lookup(locations)
     if len(pcodes) == 0:
-        return None
+        return DatasetGates(False, None, "no p-codes for its locations", no_pcodes)
+
+    organization = dataset.get("organization") or dataset.get_organization()
+    if organization["name"] in configuration["org_exceptions"]:
+        return DatasetGates(False, False, f"organization {organization['name']} is excepted", no_pcodes)
+
+    return DatasetGates(
+        True, None, None, pcodes, global_pcodes.lookup_levels(locations), global_pcodes.location_key(locations)
+    )
+
 
+def resource_file_ext(resource: Resource) -> str:
     file_ext = resource.get_format()
     if file_ext == "geodatabase":
         file_ext = "gdb"
     if file_ext == "geopackage":
         file_ext = "gpkg"
+    return file_ext
+
+
+def process_dataset(
+    dataset: Dataset,
+    global_pcodes: PcodeIndex,
+    retriever: Retrieve,
+    configuration: Dict,
+    resources: Optional[List[Resource]] = None,
+    update: Optional[bool] = False,
+    flag: Optional[bool] = False,
+    result_cache: Optional[ResultCache] = None,
+    hdx_client: Optional[PcodeUpdateClient] = None,
+    quota: Optional[DiskQuota] = None,
+    gates: Optional[DatasetGates] = None,
+) -> List[Tuple[Resource, bool or None]]:
+    """Check resources of a dataset, evaluating the dataset gates once for all of them
+
+    Args:
+        dataset (Dataset): HDX dataset
+        global_pcodes (PcodeIndex): global p-codes
+        retriever (Retrieve): retriever
+        configuration (Dict): HDX configuration
+        resources (Optional[List[Resource]]): resources to check, all those of the dataset if None
+        update (Optional[bool]): write p_coded values to HDX. Defaults to False.
+        flag (Optional[bool]): send errors to Slack. Defaults to False.
+        result_cache (Optional[ResultCache]): cache of results
+        hdx_client (Optional[PcodeUpdateClient]): client writing p_coded values
+        quota (Optional[DiskQuota]): temporary storage quota
+        gates (Optional[DatasetGates]): gates already evaluated for the dataset
+
+    Returns:
+        List[Tuple[Resource, bool or None]]: each resource and its p-coded value, None if it raised
+    """
+    if resources is None:
+        resources = dataset.get_resources()
+    if gates is None:
+        gates = check_dataset(dataset, global_pcodes, configuration)
+    if not gates.eligible:
+        logger.info(f"Skipping {len(resources)} resources of dataset {dataset['name']}: {gates.reason}")
+        return [(resource, gates.result) for resource in resources]
+    eligible = [r for r in resources if resource_file_ext(r).lower() in configuration["allowed_filetypes"]]
+    results = {resource["id"]: None for resource in resources}
+
+    for resource in eligible:
+        try:
+            results[resource["id"]] = process_resource(
+                resource, dataset, global_pcodes, retriever, configuration, update, flag, result_cache, hdx_client,
+                quota, gates,
+            )
+        except Exception as exc:
+            logger.error(f"Exception of type {type(exc).__name__} while processing resource {resource['id']}: {str(exc)}")
+    return [(resource, results[resource["id"]]) for resource in resources]
+
+
+def send_to_slack(message: str, error: Optional[str] = None) -> None:
+    get_slack_notifier().notify(message, error)
+
+
+def process_resource(
+    resource: Resource,
+    dataset: Dataset,
+    global_pcodes: PcodeIndex,
+    retriever: Retrieve,
+    configuration: Dict,
+    update: Optional[bool] = False,
+    flag: Optional[bool] = False,
+    result_cache: Optional[ResultCache] = None,
+    hdx_client: Optional[PcodeUpdateClient] = None,
+    quota: Optional[DiskQuota] = None,
+    gates: Optional[DatasetGates] = None,
+) -> bool or None:
+    with trace_resource(resource["id"]) as trace:
+        try:
+            pcoded = check_resource(
+                resource, dataset, global_pcodes, retriever, configuration, update, flag, result_cache, hdx_client,
+                quota, gates,
+            )
+        except MemoryLimitExceeded:
+            trace.finish("memory_limit")
+            return None
+        except Exception:
+            trace.finish("error")
+            raise
+        trace.finish(OUTCOMES[pcoded])
+    return pcoded
+
+
+def check_resource(
+    resource: Resource,
+    dataset: Dataset,
+    global_pcodes: PcodeIndex,
+    retriever: Retrieve,
+    configuration: Dict,
+    update: Optional[bool] = False,
+    flag: Optional[bool] = False,
+    result_cache: Optional[ResultCache] = None,
+    hdx_client: Optional[PcodeUpdateClient] = None,
+    quota: Optional[DiskQuota] = None,
+    gates: Optional[DatasetGates] = None,
+) -> bool or None:
+    pcoded = None
+
+    if gates is None:
+        gates = check_dataset(dataset, global_pcodes, configuration)
+    if not gates.eligible:
+        return gates.result
+    pcodes = gates.pcodes
 
-    if dataset.get_organization()["name"] in configuration["org_exceptions"]:
-        return False
+    file_ext = resource_file_ext(resource)
+    set_format(file_ext)
 
     if file_ext.lower() not in configuration["allowed_filetypes"]:
         return None
+    load_readers(file_ext)
 
     size = resource["size"]
     if (size is None or size == 0) and resource["resource_type"] == "api":
         try:
-            resource_info = head(resource["url"])
+            with timed("head"):
+                resource_info = head(resource["url"])
             # if size cannot be determined, set to the limit set in configuration so the resource is excluded
             size = int(resource_info.headers.get("Content-Length", configuration["resource_size"]))
         except:
@@ -279,55 +833,130 @@ def process_resource(
     if size >= configuration["resource_size"]:
         return None
 
-    resource_files, parent_folders, error = download_resource(resource, file_ext, retriever)
-    if not resource_files:
-        if cleanup and parent_folders:
-            remove_files(folders=parent_folders)
-        if error:
-            error_message = f"{dataset['name']}: {resource['name']}: {error}"
-            logger.error(error_message)
-            if flag:
-                send_to_slack(error_message)
-        return None
-
-    contents, error = read_downloaded_data(resource_files, file_ext, configuration["number_of_rows"])
-    if len(contents) == 0:
-        if cleanup:
-            remove_files(resource_files, parent_folders)
-        if error:
-            error_message = f"{dataset['name']}: {resource['name']}: {error}"
-            logger.error(error_message)
-            if flag:
-                send_to_slack(error_message)
-        return None
-
-    for key in contents:
-        if not pcoded:
-            pcoded = check_pcoded(contents[key], pcodes, configuration["percent_match"])
-
-    if not error and pcoded is None:
-        pcoded = False
-
-    if error:
-        error_message = f"{dataset['name']}: {resource['name']}: {error}"
-        logger.error(error_message)
-        if flag and pcoded is None:  # Only flag errors if pcoded status could not be determined
-            send_to_slack(error_message)
-
-    if cleanup:
-        remove_files(resource_files, parent_folders)
+    matching = configuration["adaptive_matching"]
+    if matching["enabled"]:
+        first_rows, max_rows, confidence = matching["first_rows"], matching["max_rows"], matching["confidence"]
+    else:  # a single read of number_of_rows rows and a plain comparison of the ratio with the cutoff
+        first_rows, max_rows, confidence = configuration["number_of_rows"], configuration["number_of_rows"], 0
+
+    start_time = perf_counter()
+    cache_version, cache_key, cached = None, None, None
+    if result_cache:
+        cache_version = f"{global_pcodes.version}|{configuration['percent_match']}|{first_rows}|{max_rows}|{confidence}"
+        # the decision depends on the p-codes of the locations of the dataset as much as on the file
+        cache_key = scoped_key(result_cache.metadata_key(resource), gates.locations)
+        cached = result_cache.get(cache_key, cache_version)
+
+    storage = configuration["temp_storage"]
+    if quota is None:
+        quota = DiskQuota(storage["quota"])
+    workspace = Workspace(retriever.temp_dir, quota, storage["resource_bytes"], storage["max_ratio"])
+    workbooks = dict()
+    try:
+        read_contents, digest, error = None, None, None
+        if cached is None and file_ext == "csv" and ".zip" not in basename(resource["url"]):
+            with timed("stream"):
+                text, error = stream_csv_text(resource["url"], retriever, max_rows, configuration["resource_size"])
+            if text is not None:
+                read_contents = partial(read_csv_text, text)
+                digest = scoped_key(content_digest(text), gates.locations)
+                if result_cache:
+                    cached = result_cache.get(digest, cache_version)
+
+        if cached is None and read_contents is None and error is None:
+            resource_files, error = download_resource(
+                resource, file_ext, retriever, workspace, configuration["resource_size"]
+            )
+            if not resource_files:
+                if error:
+                    error_message = f"{dataset['name']}: {resource['name']}: {error}"
+                    logger.error(error_message)
+                    if flag:
+                        send_to_slack(error_message, error)
+                return None
+
+            if result_cache and file_ext not in ["gdb", "shp"]:  # these formats are spread over several files
+                digest = scoped_key(file_digest(resource_files), gates.locations)
+                cached = result_cache.get(digest, cache_version)
+            read_contents = partial(read_downloaded_data, resource_files, file_ext, workbooks=workbooks)
+
+        if cached is not None:
+            count("cache_hits")
+            pcoded, pcoded_column = cached
+            logger.info(f"Using cached result for resource {resource['id']}: {pcoded} ({pcoded_column})")
+            if cache_key and digest:  # the same file was seen under another url or version of the metadata
+                result_cache.put([cache_key], cache_version, pcoded, pcoded_column, perf_counter() - start_time)
+        else:
+            match = MatchResult(None, 0, 0, error, None, dict())
+            if read_contents is not None:
+                match_cutoff = configuration["percent_match"]
+                isolation = get_isolation_pool(configuration["isolation"])
+                if isolation is None:
+                    match = match_incrementally(
+                        read_contents, pcodes, match_cutoff, first_rows, max_rows, confidence, gates.levels
+                    )
+                else:
+                    # the global p-codes are sent to a worker once per version, not with every resource
+                    version = global_pcodes.version or id(global_pcodes)
+                    try:
+                        match = isolation.run(
+                            match_in_worker, read_contents, gates.locations, match_cutoff, first_rows, max_rows,
+                            confidence, shared={"pcodes": (version, global_pcodes)},
+                        )
+                    except MemoryLimitExceeded as exc:
+                        error_message = f"{dataset['name']}: {resource['name']}: Resource exceeded the memory limit"
+                        logger.error(f"{error_message}: {str(exc)}")
+                        if flag:
+                            send_to_slack(error_message, "Resource exceeded the memory limit")
+                        raise
+                logger.info(f"Read up to {match.rows} rows per table of resource {resource['id']}")
+                if match.ratios:
+                    logger.info(f"Share of p-codes in the columns of resource {resource['id']}: {match.ratios}")
+                if match.level is not None:
+                    logger.info(f"P-coded column {match.column} of resource {resource['id']} is at admin level {match.level}")
+            error = match.error
+
+            if match.contents == 0:
+                if error:
+                    error_message = f"{dataset['name']}: {resource['name']}: {error}"
+                    logger.error(error_message)
+                    if flag:
+                        send_to_slack(error_message, error)
+                return None
+
+            pcoded_column = match.column
+            if pcoded_column is not None:
+                pcoded = True
+
+            if not error and pcoded is None:
+                pcoded = False
+
+            if error:
+                error_message = f"{dataset['name']}: {resource['name']}: {error}"
+                logger.error(error_message)
+                if flag and pcoded is None:  # Only flag errors if pcoded status could not be determined
+                    send_to_slack(error_message, error)
+
+            if result_cache and not error:
+                result_cache.put([cache_key, digest], cache_version, pcoded, pcoded_column, perf_counter() - start_time)
+    finally:
+        for workbook in workbooks.values():
+            workbook.close()
+        workspace.close()
 
     upd_message = f'Updating ? {update}. Pcoded ? {pcoded}. For resource {resource["id"]}, {resource["name"]}.'
     logger.warning(upd_message)
     send_to_slack(upd_message)
     if update:
         try:
-            patch_resource_with_pcode_value(resource["id"], pcoded)
+            client = hdx_client or get_pcode_update_client()
+            with timed("patch"):
+                client.update(resource["id"], pcoded, resource.get("p_coded"))
         except Exception:
             error_message = f"{dataset['name']}: {resource['name']}: Could not update resource"
             logger.exception(error_message)
             if flag:
-                send_to_slack(error_message)
+                send_to_slack(error_message, "Could not update resource")
                 raise
 
     return pcoded
@@ -0,0 +1,399 @@
+"""Sharded, resumable batch crawl of all HDX datasets using a pool of worker processes"""
+import logging
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from datetime import datetime, timezone
+from hashlib import sha1
+from json import dump, load
+from multiprocessing import get_context
+from multiprocessing.util import Finalize
+from os import getpid, makedirs, remove, replace
+from os.path import dirname, isfile
+from shutil import rmtree
+from typing import Callable, Deque, Dict, Iterable, Iterator, List, Optional, Tuple
+
+from hdx.api.configuration import Configuration
+from hdx.data.dataset import Dataset
+from hdx.utilities.downloader import Download
+from hdx.utilities.path import get_temp_dir
+from hdx.utilities.retriever import Retrieve
+
+from check_pcodes import DatasetGates, check_dataset, process_dataset
+from helper.ckan import PcodeUpdateClient
+from helper.isolation import get_isolation_pool
+from helper.metrics import MetricsWriter
+from helper.pcodes import PcodeIndex
+from helper.result_cache import ResultCache
+from helper.scheduler import FAST, SLOW, LaneScheduler, get_lane_scheduler
+from helper.storage import DiskQuota
+from slack import get_slack_notifier
+
+logger = logging.getLogger(__name__)
+
+DATASET_FIELDS = ["id", "name", "archived", "updated_by_script", "package_creator", "groups", "owner_org", "organization"]
+RESOURCE_FIELDS = [
+    "id", "name", "format", "url", "size", "resource_type", "last_modified", "hash", "package_id", "p_coded"
+]
+
+_worker = dict()
+
+
+def parse_shard(shard: Optional[str]) -> Tuple[int, int]:
+    """Parse a shard given as i/N, shards being numbered from 0
+
+    Args:
+        shard (Optional[str]): shard such as "0/4", None for a single shard
+
+    Returns:
+        Tuple[int, int]: shard index and number of shards
+    """
+    if not shard:
+        return 0, 1
+    try:
+        index, count = [int(part) for part in shard.split("/")]
+    except ValueError:
+        raise ValueError(f"Shard must be given as i/N, not {shard}")
+    if count < 1 or not 0 <= index < count:
+        raise ValueError(f"Shard index must be between 0 and {count - 1}, not {index}")
+    return index, count
+
+
+def in_shard(dataset_id: str, index: int, count: int) -> bool:
+    """Whether a dataset belongs to a shard. Assignment only depends on the dataset id so it is
+    stable across runs and machines
+
+    Args:
+        dataset_id (str): HDX dataset id
+        index (int): shard index
+        count (int): number of shards
+
+    Returns:
+        bool: True if the dataset is processed by the shard
+    """
+    return int(sha1(dataset_id.encode()).hexdigest()[:8], 16) % count == index
+
+
+def iter_dataset_pages(page_size: int, start: int = 0, **kwargs) -> Iterator[Tuple[int, List[Dataset]]]:
+    """Page through all datasets in creation order, requesting each page only when it is needed
+
+    Args:
+        page_size (int): number of datasets per page
+        start (int): offset of the first page
+        **kwargs: other parameters passed to Dataset.search_in_hdx
+
+    Returns:
+        Iterator[Tuple[int, List[Dataset]]]: offset of the page and its datasets
+    """
+    while True:
+        datasets = Dataset.search_in_hdx(
+            rows=page_size, start=start, sort="metadata_created asc", page_size=page_size, **kwargs
+        )
+        if datasets:
+            yield start, datasets
+        if len(datasets) < page_size:
+            return
+        start += page_size
+
+
+def catalogue_filter(configuration: Configuration, locations: Iterable[str]) -> str:
+    """Solr filter query that excludes datasets process_resource would reject anyway: archived
+    datasets, excepted organisations, datasets without p-coded locations and datasets without any
+    resource in an allowed format
+
+    Args:
+        configuration (Configuration): HDX configuration
+        locations (Iterable[str]): ISO3 codes of locations with p-codes
+
+    Returns:
+        str: filter query
+    """
+    filters = ["-archived:true"]
+    if configuration["org_exceptions"]:
+        filters.append(f"-organization:({' OR '.join(configuration['org_exceptions'])})")
+    groups = sorted(loc.lower() for loc in locations)  # including world, matched against every p-code
+    filters.append(f"groups:({' OR '.join(groups)})")
+    formats = configuration["crawl"]["res_formats"]
+    if formats:
+        quoted = [f'"{f}"' for f in formats]
+        filters.append(f"res_format:({' OR '.join(quoted)})")
+    return " AND ".join(filters)
+
+
+def slim_dataset(dataset: Dataset) -> Dict:
+    """Metadata of a dataset and its resources reduced to the fields used by process_resource.
+
+    The search cannot be limited to these fields with fl: CKAN then returns the fields of the Solr
+    document, which has no resource ids, sizes, hashes or modification dates, so the full package
+    dicts are fetched and reduced here before they are sent to the workers.
+
+    Args:
+        dataset (Dataset): dataset from the search results
+
+    Returns:
+        Dict: dataset metadata including its resources
+    """
+    data = {k: dataset.data[k] for k in DATASET_FIELDS if k in dataset.data}
+    if data.get("organization"):
+        data["organization"] = {"name": data["organization"]["name"]}
+    data["resources"] = [
+        {k: resource.data.get(k) for k in RESOURCE_FIELDS} for resource in dataset.get_resources()
+    ]
+    return data
+
+
+def split_dataset(dataset_data: Dict, scheduler: LaneScheduler) -> Dict[str, Dict]:
+    """Split a dataset between the lanes of its resources, so its small resources are not queued
+    behind its large ones
+
+    Args:
+        dataset_data (Dict): metadata of the dataset including its resources
+        scheduler (LaneScheduler): scheduler classifying the resources
+
+    Returns:
+        Dict[str, Dict]: metadata of the dataset with the resources of each lane
+    """
+    return {
+        lane: {**dataset_data, "resources": resources}
+        for lane, resources in scheduler.split(dataset_data["resources"]).items()
+    }
+
+
+class CrawlCheckpoint:
+    """Progress of a crawl stored in a local JSON file so an interrupted crawl resumes from the last
+    completed page. Pages are in creation order, so datasets created during the crawl come last.
+    Offsets only make sense for the same search, so a checkpoint saved with another filter query
+    is ignored.
+    """
+
+    def __init__(self, path: str, query: str = "") -> None:
+        self.path = path
+        self.query = query
+
+    def load(self) -> int:
+        """Offset of the first page not yet completed
+
+        Returns:
+            int: offset, 0 if there is no checkpoint
+        """
+        if not isfile(self.path):
+            return 0
+        with open(self.path) as f:
+            state = load(f)
+        if state.get("query", "") != self.query:
+            logger.info("Ignoring crawl checkpoint saved with a different filter query")
+            return 0
+        logger.info(f"Resuming crawl at dataset {state['start']} from checkpoint updated {state['updated']}")
+        return state["start"]
+
+    def save(self, start: int) -> None:
+        """Record that all pages before an offset are completed
+
+        Args:
+            start (int): offset of the next page
+
+        Returns:
+            None
+        """
+        if dirname(self.path):
+            makedirs(dirname(self.path), exist_ok=True)
+        temp_path = f"{self.path}.tmp"
+        with open(temp_path, "w") as f:
+            dump({"start": start, "query": self.query, "updated": datetime.now(timezone.utc).isoformat()}, f)
+        replace(temp_path, self.path)
+
+    def clear(self) -> None:
+        if isfile(self.path):
+            remove(self.path)
+
+
+def init_worker(pcodes: PcodeIndex, update: bool = False, workers: int = 1) -> None:
+    """Set up the downloader, temporary folder, disk quota, result cache, HDX client and metrics file of a worker process
+
+    Args:
+        pcodes (PcodeIndex): global p-codes
+        update (bool): write p_coded values to HDX. Defaults to False.
+        workers (int): number of worker processes sharing the temporary storage quota. Defaults to 1.
+
+    Returns:
+        None
+    """
+    configuration = Configuration.read()
+    temp_folder = get_temp_dir(f"TempPCodeDetector-{getpid()}", delete_if_exists=True)
+    downloader = Download(rate_limit=configuration["rate_limit"])
+    result_cache = ResultCache(**configuration["result_cache"])
+    hdx_client = PcodeUpdateClient(**configuration["hdx_updates"]) if update else None
+    metrics_writer = MetricsWriter(
+        configuration["metrics"]["path"].format(process=f"crawl-{getpid()}"), configuration["metrics"]["interval"]
+    )
+    metrics_writer.start()
+    _worker.update(
+        configuration=configuration,
+        pcodes=pcodes,
+        downloader=downloader,
+        retriever=Retrieve(downloader, temp_folder, "saved_data", temp_folder, save=False, use_saved=False),
+        result_cache=result_cache,
+        quota=DiskQuota(configuration["temp_storage"]["quota"] // workers),
+        update=update,
+        hdx_client=hdx_client,
+    )
+
+    def close_worker():
+        if hdx_client is not None:
+            hdx_client.close()
+        isolation = get_isolation_pool(configuration["isolation"])
+        if isolation is not None:
+            isolation.close()
+        metrics_writer.stop()
+        get_slack_notifier().stop()
+        result_cache.close()
+        downloader.close()
+        rmtree(temp_folder, ignore_errors=True)
+
+    # unlike atexit handlers, finalizers with an exit priority also run when pool processes exit
+    Finalize(None, close_worker, exitpriority=10)
+
+
+def process_dataset_resources(dataset_data: Dict, locations: Tuple[str, ...]) -> List[Tuple[str, str, Optional[bool]]]:
+    """Check the resources of an eligible dataset in a worker process
+
+    Args:
+        dataset_data (Dict): metadata of the dataset including its resources
+        locations (Tuple[str, ...]): location key of the dataset gates, so the p-codes are looked up in the
+            worker instead of being sent with every dataset
+
+    Returns:
+        List[Tuple[str, str, Optional[bool]]]: dataset name, resource name and p-coded value of each resource
+    """
+    dataset = Dataset()
+    dataset.data = dataset_data
+    dataset.separate_resources()
+    pcodes = _worker["pcodes"]
+    gates = DatasetGates(True, None, None, pcodes.lookup(locations), pcodes.lookup_levels(locations), locations)
+    results = process_dataset(
+        dataset,
+        _worker["pcodes"],
+        _worker["retriever"],
+        _worker["configuration"],
+        update=_worker["update"],
+        result_cache=_worker["result_cache"],
+        hdx_client=_worker["hdx_client"],
+        quota=_worker["quota"],
+        gates=gates,
+    )
+    return [(dataset["name"], resource["name"], pcoded) for resource, pcoded in results]
+
+
+def run_now(function: Callable, *args) -> Future:
+    """Run a function in this process, returning its result as a completed future
+
+    Args:
+        function (Callable): function to run
+        *args: arguments of the function
+
+    Returns:
+        Future: the result of the function
+    """
+    future = Future()
+    future.set_result(function(*args))
+    return future
+
+
+def crawl(
+    pcodes: PcodeIndex,
+    configuration: Configuration,
+    shard: Optional[str] = None,
+    workers: Optional[int] = None,
+    restart: bool = False,
+    update: bool = False,
+) -> int:
+    """Check the resources of all datasets in a shard, checkpointing after every page
+
+    Pages are not waited for before the next one is read, so the fast lane keeps working while
+    large resources of earlier pages are still checked. The checkpoint is the end of the last page
+    whose datasets are all completed along with those of every page before it, and reading stops
+    while more than pages_in_flight pages are incomplete.
+
+    Args:
+        pcodes (PcodeIndex): global p-codes
+        configuration (Configuration): HDX configuration
+        shard (Optional[str]): shard such as "0/4", None to crawl everything
+        workers (Optional[int]): number of worker processes, defaults to the configured number
+        restart (bool): ignore an existing checkpoint. Defaults to False.
+        update (bool): write changed p_coded values to HDX in batches. Defaults to False.
+
+    Returns:
+        int: number of datasets processed
+    """
+    settings = configuration["crawl"]
+    index, count = parse_shard(shard)
+    if workers is None:
+        workers = settings["workers"]
+    fq = catalogue_filter(configuration, pcodes.keys())
+    checkpoint = CrawlCheckpoint(settings["checkpoint"].format(index=index, count=count), fq)
+    if restart:
+        checkpoint.clear()
+    start = checkpoint.load()
+
+    scheduler = get_lane_scheduler(configuration)
+    if workers > 1:
+        # Workers are forked so they inherit the HDX configuration and the p-code index without copying.
+        # Large resources have workers of their own so they never hold up the small ones.
+        slow_workers = min(scheduler.lanes[SLOW], workers - 1)
+        lane_workers = {FAST: workers - slow_workers, SLOW: slow_workers}
+        executors = {
+            lane: ProcessPoolExecutor(
+                lane_workers[lane], mp_context=get_context("fork"), initializer=init_worker, initargs=(pcodes, update, workers)
+            )
+            for lane in [FAST, SLOW]
+        }
+        submit = {lane: executor.submit for lane, executor in executors.items()}
+    else:
+        init_worker(pcodes, update)
+        executors = dict()
+        submit = {FAST: run_now, SLOW: run_now}
+
+    processed = 0
+    pending: Deque[Tuple[int, int, List[Future]]] = deque()  # next page, datasets and futures of incomplete pages
+
+    def complete_page() -> None:
+        nonlocal processed
+        next_start, datasets, futures = pending.popleft()
+        for future in futures:
+            for dataset_name, resource_name, pcoded in future.result():
+                logger.info(f"{dataset_name}: {resource_name}: {pcoded}")
+        processed += datasets
+        checkpoint.save(next_start)
+        logger.info(f"Shard {index}/{count}: {processed} datasets processed, next page at {next_start}")
+
+    try:
+        for page_start, datasets in iter_dataset_pages(settings["page_size"], start, fq=fq):
+            selected = [d for d in datasets if in_shard(d["id"], index, count)]
+            lanes = {FAST: list(), SLOW: list()}
+            for dataset in selected:
+                # the gates are evaluated once here, not again for each lane the dataset is split into
+                gates = check_dataset(dataset, pcodes, configuration)
+                dataset_data = slim_dataset(dataset)
+                if not gates.eligible:
+                    resources = dataset_data["resources"]
+                    logger.info(f"Skipping {len(resources)} resources of dataset {dataset['name']}: {gates.reason}")
+                    for resource in resources:
+                        logger.info(f"{dataset['name']}: {resource['name']}: {gates.result}")
+                    continue
+                for lane, lane_data in split_dataset(dataset_data, scheduler).items():
+                    lanes[lane].append((lane_data, gates.locations))
+            # fast first when in process
+            futures = [submit[lane](process_dataset_resources, *work) for lane in [FAST, SLOW] for work in lanes[lane]]
+            pending.append((page_start + len(datasets), len(selected), futures))
+            while pending and (
+                len(pending) > settings["pages_in_flight"] or all(future.done() for future in pending[0][2])
+            ):
+                complete_page()
+        while pending:
+            complete_page()
+    finally:
+        for executor in executors.values():
+            executor.shutdown(cancel_futures=True)
+        if not executors and _worker["hdx_client"] is not None:
+            _worker["hdx_client"].flush()
+    checkpoint.clear()
+    return processed
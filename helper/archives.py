@@ -0,0 +1,136 @@
+"""Selective extraction of zipped resources, reading remote archives through HTTP range requests"""
+from io import BufferedReader, RawIOBase
+from os import SEEK_CUR, SEEK_END, SEEK_SET
+from os.path import splitext
+from typing import List, Optional
+from zipfile import ZipFile
+
+from hdx.utilities.downloader import Download
+
+from helper.storage import Workspace
+
+CHUNK_SIZE = 262144
+SHAPEFILE_PARTS = [".shp", ".shx", ".dbf", ".prj", ".cpg"]
+
+
+class RangeNotSupported(Exception):
+    """Raised when a server does not honour HTTP range requests"""
+
+
+class HttpRangeFile(RawIOBase):
+    """Seekable, read-only file over a remote resource that fetches only the byte ranges that are read.
+
+    Sequential reads share one open-ended range request; a seek elsewhere closes it and starts a new
+    one. This lets ZipFile read the central directory and individual members without downloading
+    the whole archive.
+    """
+
+    def __init__(self, downloader: Download, url: str) -> None:
+        super().__init__()
+        self.downloader = downloader
+        self.url = url
+        self.bytes_read = 0
+        self._pos = 0
+        self._response = None
+        self._response_pos = None
+
+        response = self.downloader.setup(url, stream=True, headers={"Range": "bytes=0-0"})
+        content_range = response.headers.get("Content-Range", "")
+        self.downloader.close_response()
+        if response.status_code != 206 or "/" not in content_range or content_range.endswith("*"):
+            raise RangeNotSupported(f"{url} does not support range requests")
+        self.size = int(content_range.split("/")[-1])
+
+    def __enter__(self) -> BufferedReader:
+        return BufferedReader(self, buffer_size=CHUNK_SIZE)
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self._close_response()
+        super().close()
+
+    def _close_response(self) -> None:
+        if self._response is not None:
+            self.downloader.close_response()
+        self._response = None
+        self._response_pos = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self._pos
+
+    def seek(self, offset: int, whence: int = SEEK_SET) -> int:
+        if whence == SEEK_CUR:
+            offset += self._pos
+        elif whence == SEEK_END:
+            offset += self.size
+        self._pos = max(0, min(offset, self.size))
+        return self._pos
+
+    def readinto(self, buffer) -> int:
+        if self._pos >= self.size:
+            return 0
+        if self._response is None or self._response_pos != self._pos:
+            self._close_response()
+            self._response = self.downloader.setup(
+                self.url, stream=True, headers={"Range": f"bytes={self._pos}-"}
+            )
+            if self._response.status_code != 206:
+                self._close_response()
+                raise RangeNotSupported(f"{self.url} ignored range request")
+            self._response_pos = self._pos
+        data = self._response.raw.read(min(len(buffer), self.size - self._pos))
+        if not data:
+            return 0
+        buffer[:len(data)] = data
+        self._pos += len(data)
+        self._response_pos = self._pos
+        self.bytes_read += len(data)
+        return len(data)
+
+
+def select_members(names: List[str], file_ext: str) -> List[str]:
+    """Archive members needed to read files of the given format, including shapefile parts and geodatabase folders
+
+    Args:
+        names (List[str]): member names of the archive
+        file_ext (str): format of the resource
+
+    Returns:
+        List[str]: members to extract
+    """
+    names = [n for n in names if not n.startswith("__MACOSX/") and not n.endswith("/")]
+    extension = f".{file_ext.lower()}"
+    if file_ext == "gdb":
+        roots = {n[:n.lower().index(".gdb/") + 5] for n in names if ".gdb/" in n.lower()}
+        return [n for n in names if any(n.startswith(r) for r in roots)]
+    members = [n for n in names if n.lower().endswith(extension)]
+    if file_ext == "shp":
+        stems = {splitext(n)[0] for n in members}
+        members = [n for n in names if splitext(n)[0] in stems and splitext(n)[1].lower() in SHAPEFILE_PARTS]
+    return members
+
+
+def extract_members(archive: ZipFile, file_ext: str, folder: str, workspace: Optional[Workspace] = None) -> List[str]:
+    """Extract only the members of an archive that match the resource format
+
+    Args:
+        archive (ZipFile): open archive, local or over HttpRangeFile
+        file_ext (str): format of the resource
+        folder (str): folder to extract into
+        workspace (Optional[Workspace]): workspace charged with the extracted bytes before extracting
+
+    Returns:
+        List[str]: extracted paths
+    """
+    members = select_members(archive.namelist(), file_ext)
+    if workspace is not None:
+        workspace.charge_members([archive.getinfo(member) for member in members])
+    return [archive.extract(member, folder) for member in members]
@@ -1,7 +1,13 @@
 import logging
 import os
 import json
+from threading import Event, Lock, Thread
+from time import monotonic
+from typing import Any, Dict, Optional
+
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 logger = logging.getLogger(__name__)
 
@@ -14,14 +20,164 @@ HEADERS = {
     'Authorization': os.getenv('HDX_KEY')
 }
 
-def patch_resource_with_pcode_value(resource_id: str, pcode_value: bool) -> None:
-    if pcode_value is not None:
+RETRY_STATUSES = [429, 500, 502, 503, 504]
+
+PCODE_UPDATE_CLIENT: 'PcodeUpdateClient' = None
+
+
+def current_pcode_value(value: Any) -> Optional[bool]:
+    """p_coded value of a resource as a boolean, CKAN may return extras as strings
+
+    Args:
+        value (Any): p_coded field of the resource
+
+    Returns:
+        Optional[bool]: the value or None if the resource has none
+    """
+    if isinstance(value, bool) or value is None:
+        return value
+    if str(value).lower() in ('true', 'false'):
+        return str(value).lower() == 'true'
+    return None
+
+
+class PcodeUpdateClient:
+    """Writes p_coded values to HDX over a pooled session.
+
+    Requests are retried with exponential backoff on 429 and 5xx responses, waiting as long as
+    Retry-After asks. Updates that would not change the current p_coded value of the resource are
+    skipped. With batch_size 1 every update is written straight away and errors are raised. Larger
+    batch sizes queue updates, the last one per resource winning, and write them when batch_size
+    are pending, when the oldest has waited flush_interval seconds or on flush. A background
+    thread writes them once flush_interval is up even when no other update comes. Errors are then
+    logged and counted in failed.
+    """
+
+    def __init__(self, url: str = HDX_PCODE_PATCH_URL, headers: Optional[Dict] = None, timeout: float = 30,
+                 retries: int = 5, backoff: float = 0.5, pool_size: int = 10, batch_size: int = 1,
+                 flush_interval: float = 30) -> None:
+        self.url = url
+        self.timeout = timeout
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self.patched = 0
+        self.skipped = 0
+        self.failed = 0
+        self._pending = dict()
+        self._oldest = None
+        self._lock = Lock()
+        self._stop = Event()
+        self._thread = None
+        retry = Retry(
+            total=retries,
+            backoff_factor=backoff,
+            status_forcelist=RETRY_STATUSES,
+            allowed_methods=['POST'],  # setting p_coded is idempotent
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=pool_size, max_retries=retry)
+        self.session = requests.Session()
+        self.session.headers.update(HEADERS if headers is None else headers)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def patch(self, resource_id: str, pcode_value: bool) -> None:
         body = {
             'id': resource_id,
             'p_coded': pcode_value,
             'batch_mode': 'KEEP_OLD',
         }
-        r = requests.post(HDX_PCODE_PATCH_URL, data=json.dumps(body), headers=HEADERS)
+        r = self.session.post(self.url, data=json.dumps(body), timeout=self.timeout)
         r.raise_for_status()
-    else:
-        logger.warning(f'Did not update resource {resource_id} because calculated value would be None')
+
+    def update(self, resource_id: str, pcode_value: Optional[bool], current: Any = None) -> bool:
+        """Set the p_coded value of a resource unless it already has it
+
+        Args:
+            resource_id (str): HDX resource id
+            pcode_value (Optional[bool]): value to set, None is never written
+            current (Any): p_coded value the resource has now
+
+        Returns:
+            bool: True if the update is written or queued, False if it is skipped
+        """
+        if pcode_value is None:
+            logger.warning(f'Did not update resource {resource_id} because calculated value would be None')
+            return False
+        if current_pcode_value(current) == pcode_value:
+            logger.info(f'Did not update resource {resource_id} because p_coded is already {pcode_value}')
+            with self._lock:
+                self.skipped += 1
+            return False
+        if self.batch_size <= 1:
+            self.patch(resource_id, pcode_value)
+            with self._lock:
+                self.patched += 1
+            return True
+        with self._lock:
+            self._pending[resource_id] = pcode_value
+            if self._oldest is None:
+                self._oldest = monotonic()
+            due = len(self._pending) >= self.batch_size or monotonic() - self._oldest >= self.flush_interval
+            if self._thread is None:
+                self._thread = Thread(target=self._run, name='PcodeUpdateFlush', daemon=True)
+                self._thread.start()
+        if due:
+            self.flush()
+        return True
+
+    def _run(self) -> None:
+        # writes queued updates once the oldest has waited flush_interval, as updates may stop coming
+        while True:
+            with self._lock:
+                waited = 0 if self._oldest is None else monotonic() - self._oldest
+            if self._stop.wait(max(self.flush_interval - waited, 0.01)):
+                return
+            with self._lock:
+                due = self._oldest is not None and monotonic() - self._oldest >= self.flush_interval
+            if due:
+                try:
+                    self.flush()
+                except Exception:
+                    logger.exception('Unable to write queued p_coded updates')
+
+    def flush(self) -> int:
+        """Write all queued updates
+
+        Returns:
+            int: number of updates written
+        """
+        with self._lock:
+            pending, self._pending, self._oldest = self._pending, dict(), None
+        written = 0
+        for resource_id, pcode_value in pending.items():
+            try:
+                self.patch(resource_id, pcode_value)
+                written += 1
+            except Exception as exc:
+                logger.error(f'Could not update resource {resource_id}: {str(exc)}')
+                with self._lock:
+                    self.failed += 1
+        with self._lock:
+            self.patched += written
+        if pending:
+            logger.info(f'Updated {written} of {len(pending)} resources, {self.skipped} unchanged updates skipped so far')
+        return written
+
+    def close(self) -> None:
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        self.flush()
+        self.session.close()
+
+
+def get_pcode_update_client() -> PcodeUpdateClient:
+    global PCODE_UPDATE_CLIENT
+    if not PCODE_UPDATE_CLIENT:
+        PCODE_UPDATE_CLIENT = PcodeUpdateClient()
+    return PCODE_UPDATE_CLIENT
+
+
+def patch_resource_with_pcode_value(resource_id: str, pcode_value: bool) -> None:
+    get_pcode_update_client().update(resource_id, pcode_value)
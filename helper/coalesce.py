@@ -0,0 +1,177 @@
+"""Coalescing of bursts of events for the same resource"""
+import logging
+from collections import OrderedDict
+from datetime import datetime, timezone
+from threading import Condition, Lock
+from time import monotonic, sleep, time
+from typing import Any, Callable, Dict, Optional
+
+logger = logging.getLogger(__name__)
+
+
+def get_event_timestamp(event: Dict) -> Optional[float]:
+    """Time an event was emitted as a unix timestamp, naive times being UTC
+
+    Args:
+        event (Dict): event from the HDX event bus
+
+    Returns:
+        Optional[float]: timestamp or None if the event has no usable event_time
+    """
+    try:
+        event_time = datetime.fromisoformat(event["event_time"])
+    except (KeyError, TypeError, ValueError):
+        return None
+    if event_time.tzinfo is None:
+        event_time = event_time.replace(tzinfo=timezone.utc)
+    return event_time.timestamp()
+
+
+class EventCoalescer:
+    """Drops events for a resource that are covered by another event of the same resource.
+
+    Processing always reads the current resource from HDX, so an event brings nothing new once an
+    event of the same resource emitted at the same time or later has been processed successfully.
+    The first event of a resource is processed at once. An event arriving within window seconds of
+    the previous one of its resource is part of a burst: it is held until window seconds after it
+    arrived, letting the rest of the burst arrive, and skipped when a later one has arrived in the
+    meantime. A burst therefore costs two analyses, the first event and the last. Holding parks the
+    consumer thread that took the event, which only happens for repeats of a resource, and the
+    caller leaves the hold out of its latency. Only one event of a resource is processed at a time,
+    the others waiting for it to finish. Holds are measured from arrival on the container's own
+    clock and events are only compared by their own event times, so neither depends on the clocks
+    of the event bus and the container agreeing. An event whose processing failed covers nothing,
+    so it is processed again when it is redelivered.
+    """
+
+    def __init__(self, window: float, max_resources: int = 100_000) -> None:
+        self.window = window
+        self.max_resources = max_resources
+        self.processed = 0
+        self.skipped = 0
+        self._latest = OrderedDict()  # resource id -> emitted time of the latest event that arrived
+        self._done = OrderedDict()  # resource id -> emitted time of the latest event processed successfully
+        self._arrivals = OrderedDict()  # resource id -> monotonic time the latest event arrived
+        self._in_flight = set()  # resource ids with an event being processed
+        self._lock = Lock()
+        self._finished = Condition(self._lock)
+
+    def _remember(self, times: OrderedDict, resource_id: str, value: float) -> None:
+        times[resource_id] = max(value, times.get(resource_id, value))
+        times.move_to_end(resource_id)
+        while len(times) > self.max_resources:
+            times.popitem(last=False)
+
+    def claim(self, event: Dict) -> bool:
+        """Decide whether an event should be processed, holding it while its burst arrives
+
+        An event claimed with True must be passed to finished once processed, whether or not that succeeded.
+
+        Args:
+            event (Dict): event from the HDX event bus
+
+        Returns:
+            bool: True if the event should be processed, False if it is covered by another event
+        """
+        resource_id = event.get("resource_id")
+        emitted = get_event_timestamp(event)
+        arrived = monotonic()
+        with self._lock:
+            previous = self._arrivals.get(resource_id)
+            self._remember(self._arrivals, resource_id, arrived)
+            if emitted is not None:
+                self._remember(self._latest, resource_id, emitted)
+        if emitted is not None and previous is not None and arrived - previous < self.window:
+            sleep(self.window)
+
+        with self._finished:
+            while resource_id in self._in_flight:
+                self._finished.wait()
+            if emitted is not None:
+                done = self._done.get(resource_id)
+                if done is not None and done >= emitted:
+                    self.skipped += 1
+                    logger.info(f"Skipping event for resource {resource_id}, already analysed for a later event")
+                    return False
+                if self._latest.get(resource_id, emitted) > emitted:
+                    self.skipped += 1
+                    logger.info(f"Skipping event for resource {resource_id}, a later event will be analysed")
+                    return False
+            self._in_flight.add(resource_id)
+            self.processed += 1
+        return True
+
+    def finished(self, event: Dict, succeeded: bool = True) -> None:
+        """Release a claimed event, recording a success so the events it covers are skipped
+
+        Args:
+            event (Dict): event from the HDX event bus
+            succeeded (bool): whether the resource was processed successfully. Defaults to True.
+
+        Returns:
+            None
+        """
+        resource_id = event.get("resource_id")
+        emitted = get_event_timestamp(event)
+        with self._finished:
+            self._in_flight.discard(resource_id)
+            if succeeded and emitted is not None:
+                self._remember(self._done, resource_id, emitted)
+            self._finished.notify_all()
+
+
+class SharedDatasets:
+    """Dataset metadata shared by the events of the resources of a dataset touched in the same publish.
+
+    The first event of a dataset loads it, while sibling events arriving at the same time wait for
+    that load instead of repeating it. A loaded dataset is reused by an event emitted before it was
+    loaded, as it then reflects that event, and is dropped once older than max_age seconds.
+    """
+
+    def __init__(self, max_age: float, max_datasets: int = 1000) -> None:
+        self.max_age = max_age
+        self.max_datasets = max_datasets
+        self.loads = 0
+        self.reuses = 0
+        self._datasets = OrderedDict()  # dataset id -> (loaded time, value)
+        self._loading = dict()  # dataset id -> lock held while it loads
+        self._lock = Lock()
+
+    def get(self, dataset_id: str, load: Callable[[], Any], emitted: Optional[float] = None) -> Any:
+        """Dataset loaded for a sibling event or loaded now
+
+        Args:
+            dataset_id (str): HDX dataset id
+            load (Callable[[], Any]): loads the dataset and anything derived from it
+            emitted (Optional[float]): time the event was emitted as a unix timestamp, None if unknown
+
+        Returns:
+            Any: value returned by load
+        """
+        with self._lock:
+            dataset_lock = self._loading.setdefault(dataset_id, Lock())
+        with dataset_lock:  # siblings wait for a load in progress rather than starting their own
+            with self._lock:
+                now = time()
+                while self._datasets:
+                    oldest_id, (loaded, _) = next(iter(self._datasets.items()))
+                    if now - loaded <= self.max_age and len(self._datasets) <= self.max_datasets:
+                        break
+                    del self._datasets[oldest_id]
+                    self._loading.pop(oldest_id, None)
+                entry = self._datasets.get(dataset_id)
+                if entry is not None and emitted is not None and entry[0] >= emitted:
+                    self.reuses += 1
+                    return entry[1]
+            loaded = time()
+            try:
+                value = load()
+            except Exception:
+                with self._lock:
+                    self._loading.pop(dataset_id, None)
+                raise
+            with self._lock:
+                self._datasets[dataset_id] = loaded, value
+                self._datasets.move_to_end(dataset_id)
+                self.loads += 1
+            return value
@@ -0,0 +1,234 @@
+"""Worker processes that run one stage of a resource at a time under a memory ceiling, recycled as they age"""
+import logging
+from multiprocessing import get_context
+from os import getpid
+from threading import Lock
+from time import monotonic
+from typing import Any, Callable, Dict, Hashable, List, Optional, Tuple
+
+from helper.metrics import add_to_trace, get_metrics, trace_resource
+
+logger = logging.getLogger(__name__)
+
+ISOLATION_POOL: "IsolationPool" = None
+_pool_pid = None
+_shared: Dict[str, Any] = dict()  # values sent once to a worker process and kept for its tasks
+
+
+class MemoryLimitExceeded(Exception):
+    """Raised when the worker process running a task goes over its memory ceiling and is killed"""
+
+
+class WorkerDied(Exception):
+    """Raised when the worker process running a task exits without a result, such as when killed by the kernel"""
+
+
+def process_rss_mb(pid: str or int = "self") -> Optional[float]:
+    """Resident set size of a process from /proc
+
+    Args:
+        pid (str or int): process id, the current process by default
+
+    Returns:
+        Optional[float]: RSS in MB, None where /proc is not available
+    """
+    try:
+        with open(f"/proc/{pid}/status") as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    return int(line.split()[1]) / 1024
+    except (OSError, ValueError):
+        return None
+    return None
+
+
+def get_shared(name: str) -> Any:
+    """Value shared with the tasks of the current worker process
+
+    Args:
+        name (str): name the value was shared under
+
+    Returns:
+        Any: the value last sent to this worker under the name
+    """
+    return _shared[name]
+
+
+def serve(connection) -> None:
+    """Loop of a worker process: run each task received and send back its result, the timings and
+    counts of its trace and the RSS of the worker once done
+    """
+    while True:
+        try:
+            task = connection.recv()
+        except EOFError:
+            return
+        if task is None:
+            return
+        function, args, kwargs, shared = task
+        _shared.update(shared)
+        with trace_resource("isolated") as trace:
+            try:
+                result = "ok", function(*args, **kwargs)
+            except Exception as exc:
+                result = "error", exc
+        try:
+            connection.send((*result, dict(trace.stages), dict(trace.counts), process_rss_mb()))
+        except Exception as exc:  # the result or exception cannot be pickled
+            connection.send(("error", RuntimeError(f"{type(exc).__name__}: {exc}"), dict(), dict(), process_rss_mb()))
+
+
+class IsolatedWorker:
+    """One worker process and what it has done so far"""
+
+    def __init__(self, start_method: str) -> None:
+        context = get_context(start_method)
+        self.connection, child_connection = context.Pipe()
+        self.process = context.Process(target=serve, args=(child_connection,), name="PCodeIsolatedWorker", daemon=True)
+        self.process.start()
+        child_connection.close()
+        self.tasks = 0
+        self.baseline_mb = None  # RSS after the first task, once imports are done
+        self.shared: Dict[str, Hashable] = dict()  # version of each shared value the process holds
+
+    def stop(self, timeout: float = 5) -> None:
+        try:
+            self.connection.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout)
+        if self.process.is_alive():
+            self.process.kill()
+            self.process.join()
+        self.connection.close()
+
+    def kill(self) -> None:
+        self.process.kill()
+        self.process.join()
+        self.connection.close()
+
+
+class IsolationPool:
+    """Runs tasks in worker processes, one task per worker at a time, so the memory a resource needs
+    is bounded and returned to the system when the worker goes.
+
+    While a task runs, the RSS of its worker is checked every poll_interval seconds and the worker
+    is killed if it goes over max_rss_mb, raising MemoryLimitExceeded. A worker is replaced after
+    max_tasks tasks or once its RSS has grown by more than max_growth_mb since its first task, which
+    stops fragmentation from building up. Workers are started when needed, as many as there are
+    tasks running at once.
+
+    Values that many tasks need, such as the global p-codes, are passed as shared with a version.
+    Each worker receives a value once and again only when its version changes, and its tasks read
+    it with get_shared.
+    """
+
+    def __init__(self, max_rss_mb: float, max_tasks: int = 100, max_growth_mb: float = 512,
+                 start_method: str = "spawn", poll_interval: float = 0.1) -> None:
+        self.max_rss_mb = max_rss_mb
+        self.max_tasks = max_tasks
+        self.max_growth_mb = max_growth_mb
+        self.start_method = start_method
+        self.poll_interval = poll_interval
+        self._idle: List[IsolatedWorker] = list()
+        self._lock = Lock()
+
+    def run(self, function: Callable[..., Any], *args, shared: Optional[Dict[str, Tuple[Hashable, Any]]] = None,
+            **kwargs) -> Any:
+        """Run a function in a worker process. The function, arguments and result must be picklable.
+
+        Args:
+            function (Callable[..., Any]): module level function
+            *args: positional arguments of the function
+            shared (Optional[Dict[str, Tuple[Hashable, Any]]]): version and value of each value the function
+                reads with get_shared, only sent to workers that do not hold that version yet
+            **kwargs: keyword arguments of the function
+
+        Returns:
+            Any: the result of the function, whose exceptions are raised again here
+        """
+        with self._lock:
+            worker = self._idle.pop() if self._idle else None
+        if worker is None:
+            worker = IsolatedWorker(self.start_method)
+        metrics = get_metrics()
+        start = monotonic()
+        updates = {name: item for name, item in (shared or dict()).items() if worker.shared.get(name) != item[0]}
+        try:
+            worker.connection.send((function, args, kwargs, {name: value for name, (_, value) in updates.items()}))
+        except Exception:  # such as an argument that cannot be pickled, after which the pipe cannot be trusted
+            worker.kill()
+            metrics.increment("isolated_workers_replaced", reason="send")
+            raise
+        worker.shared.update({name: version for name, (version, _) in updates.items()})
+        peak_mb = 0
+        while not worker.connection.poll(self.poll_interval):
+            if not worker.process.is_alive():
+                worker.kill()
+                metrics.increment("isolated_workers_replaced", reason="died")
+                raise WorkerDied(f"Worker process exited with code {worker.process.exitcode}")
+            rss_mb = process_rss_mb(worker.process.pid)
+            if rss_mb is not None:
+                peak_mb = max(peak_mb, rss_mb)
+            if rss_mb is not None and rss_mb > self.max_rss_mb:
+                worker.kill()
+                metrics.increment("isolated_workers_replaced", reason="memory_limit")
+                raise MemoryLimitExceeded(
+                    f"Worker used {rss_mb:.0f} MB after {monotonic() - start:.1f}s, over the limit of {self.max_rss_mb} MB"
+                )
+        try:
+            status, result, stages, counts, rss_mb = worker.connection.recv()
+        except EOFError:
+            worker.kill()
+            metrics.increment("isolated_workers_replaced", reason="died")
+            raise WorkerDied(f"Worker process exited with code {worker.process.exitcode}")
+        add_to_trace(stages, counts)
+        if rss_mb is not None:
+            metrics.set("isolated_worker_rss_mb", max(peak_mb, rss_mb))
+        self._release(worker, rss_mb)
+        if status == "error":
+            raise result
+        return result
+
+    def _release(self, worker: IsolatedWorker, rss_mb: Optional[float]) -> None:
+        worker.tasks += 1
+        if worker.baseline_mb is None:
+            worker.baseline_mb = rss_mb
+        reason = None
+        if worker.tasks >= self.max_tasks:
+            reason = "tasks"
+        elif rss_mb is not None and worker.baseline_mb is not None and rss_mb - worker.baseline_mb > self.max_growth_mb:
+            reason = "growth"
+        if reason:
+            logger.info(f"Replacing worker process {worker.process.pid} after {worker.tasks} tasks, RSS {rss_mb} MB")
+            get_metrics().increment("isolated_workers_replaced", reason=reason)
+            worker.stop()
+            return
+        with self._lock:
+            self._idle.append(worker)
+
+    def close(self) -> None:
+        with self._lock:
+            workers, self._idle = self._idle, list()
+        for worker in workers:
+            worker.stop()
+
+
+def get_isolation_pool(settings: Dict) -> Optional[IsolationPool]:
+    """Isolation pool of the current process, None if isolation is disabled
+
+    Args:
+        settings (Dict): isolation section of the configuration
+
+    Returns:
+        Optional[IsolationPool]: pool, created in each process that asks for it
+    """
+    global ISOLATION_POOL, _pool_pid
+    if not settings.get("enabled"):
+        return None
+    if ISOLATION_POOL is None or _pool_pid != getpid():  # a forked process does not own its parent's workers
+        ISOLATION_POOL = IsolationPool(
+            settings["max_rss_mb"], settings["max_tasks"], settings["max_growth_mb"], settings["start_method"]
+        )
+        _pool_pid = getpid()
+    return ISOLATION_POOL
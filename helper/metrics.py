@@ -0,0 +1,233 @@
+"""Per-stage timings and counters of the detection pipeline, logged as JSON fields and written as Prometheus text"""
+import logging
+from collections import defaultdict
+from contextlib import contextmanager
+from contextvars import ContextVar
+from os import makedirs, replace
+from os.path import dirname
+from threading import Event, Lock, Thread
+from time import monotonic, perf_counter
+from typing import Dict, Iterator, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+PREFIX = "pcode"
+
+METRICS: "Metrics" = None
+
+_current_trace: ContextVar[Optional["ResourceTrace"]] = ContextVar("resource_trace", default=None)
+
+
+def label_text(labels: Tuple) -> str:
+    if not labels:
+        return ""
+    pairs = [f'{k}="{v}"' for k, v in labels]
+    return f"{{{','.join(pairs)}}}"
+
+
+class Metrics:
+    """Counters, gauges and stage timers of one process, keyed by name and labels"""
+
+    def __init__(self) -> None:
+        self.counters = defaultdict(float)
+        self.gauges = dict()
+        self.timers = dict()  # count, total and maximum seconds
+        self._lock = Lock()
+
+    def increment(self, name: str, value: float = 1, **labels) -> None:
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            self.counters[key] += value
+
+    def set(self, name: str, value: float, **labels) -> None:
+        key = name, tuple(sorted(labels.items()))
+        with self._lock:
+            self.gauges[key] = value
+
+    def observe(self, stage: str, seconds: float, **labels) -> None:
+        key = stage, tuple(sorted(labels.items()))
+        with self._lock:
+            count, total, maximum = self.timers.get(key, (0, 0.0, 0.0))
+            self.timers[key] = count + 1, total + seconds, max(maximum, seconds)
+
+    def counter(self, name: str) -> float:
+        """Total of a counter over all its labels
+
+        Args:
+            name (str): counter name
+
+        Returns:
+            float: total
+        """
+        with self._lock:
+            return sum([v for (n, _), v in self.counters.items() if n == name])
+
+    def prometheus(self) -> str:
+        """Metrics in the Prometheus text exposition format
+
+        Returns:
+            str: one line per metric and label set
+        """
+        lines = []
+        with self._lock:
+            for (name, labels), value in sorted(self.counters.items()):
+                lines.append(f"{PREFIX}_{name}_total{label_text(labels)} {value:g}")
+            for (name, labels), value in sorted(self.gauges.items()):
+                lines.append(f"{PREFIX}_{name}{label_text(labels)} {value:g}")
+            for (stage, labels), (count, total, maximum) in sorted(self.timers.items()):
+                labels = label_text((("stage", stage),) + labels)
+                lines.append(f"{PREFIX}_stage_seconds_count{labels} {count}")
+                lines.append(f"{PREFIX}_stage_seconds_sum{labels} {total:.6f}")
+                lines.append(f"{PREFIX}_stage_seconds_max{labels} {maximum:.6f}")
+        return "\n".join(lines) + "\n"
+
+    def write(self, path: str) -> None:
+        if dirname(path):
+            makedirs(dirname(path), exist_ok=True)
+        temp_path = f"{path}.tmp"
+        with open(temp_path, "w") as f:
+            f.write(self.prometheus())
+        replace(temp_path, path)  # scrapers never see a partial file
+
+
+def get_metrics() -> Metrics:
+    global METRICS
+    if not METRICS:
+        METRICS = Metrics()
+    return METRICS
+
+
+class ResourceTrace:
+    """Timings and counts of the processing of one resource.
+
+    Stages are timed wherever the work happens with timed() and counted with count(), which add to
+    the trace of the current thread. Stages can nest: read includes parse. When the resource is
+    done the trace is logged as a single JSON record and added to the process metrics, labelled
+    by file format.
+    """
+
+    def __init__(self, resource_id: str) -> None:
+        self.resource_id = resource_id
+        self.file_ext = "unknown"
+        self.stages = defaultdict(float)
+        self.counts = defaultdict(int)
+        self._start = perf_counter()
+
+    def finish(self, outcome: str, metrics: Optional[Metrics] = None) -> Dict:
+        """Log the trace and add it to the metrics
+
+        Args:
+            outcome (str): result of the processing, such as pcoded or skipped
+            metrics (Optional[Metrics]): metrics to add to, those of the process if None
+
+        Returns:
+            Dict: fields of the log record
+        """
+        metrics = metrics or get_metrics()
+        seconds = perf_counter() - self._start
+        metrics.increment("resources", format=self.file_ext, outcome=outcome)
+        metrics.observe("total", seconds, format=self.file_ext)
+        for stage, stage_seconds in self.stages.items():
+            metrics.observe(stage, stage_seconds, format=self.file_ext)
+        for name, value in self.counts.items():
+            metrics.increment(name, value, format=self.file_ext)
+        fields = {
+            "resource_id": self.resource_id,
+            "format": self.file_ext,
+            "outcome": outcome,
+            "seconds": round(seconds, 6),
+            **{f"{stage}_seconds": round(s, 6) for stage, s in self.stages.items()},
+            **self.counts,
+        }
+        logger.info(f"Processed resource {self.resource_id} in {seconds:.2f}s: {outcome}", extra={"metrics": fields})
+        return fields
+
+
+@contextmanager
+def trace_resource(resource_id: str) -> Iterator[ResourceTrace]:
+    trace = ResourceTrace(resource_id)
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+def set_format(file_ext: str) -> None:
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.file_ext = file_ext
+
+
+@contextmanager
+def timed(stage: str) -> Iterator[None]:
+    start = perf_counter()
+    try:
+        yield
+    finally:
+        trace = _current_trace.get()
+        if trace is not None:
+            trace.stages[stage] += perf_counter() - start
+
+
+def count(name: str, value: int = 1) -> None:
+    trace = _current_trace.get()
+    if trace is not None:
+        trace.counts[name] += value
+
+
+def add_to_trace(stages: Dict[str, float], counts: Dict[str, int]) -> None:
+    """Add timings and counts recorded elsewhere, such as in a worker process, to the current trace"""
+    trace = _current_trace.get()
+    if trace is not None:
+        for stage, seconds in stages.items():
+            trace.stages[stage] += seconds
+        for name, value in counts.items():
+            trace.counts[name] += value
+
+
+class MetricsWriter:
+    """Writes the metrics of the process to a file every interval seconds and logs the rate at which
+    events or resources are processed, so the file can be scraped and the log charted
+    """
+
+    def __init__(self, path: str, interval: float = 30, rate_counter: str = "resources",
+                 metrics: Optional[Metrics] = None) -> None:
+        self.path = path
+        self.interval = interval
+        self.rate_counter = rate_counter
+        self.metrics = metrics or get_metrics()
+        self._stop = Event()
+        self._thread = None
+        self._last = None
+
+    def start(self) -> None:
+        self._last = monotonic(), self.metrics.counter(self.rate_counter)
+        self._thread = Thread(target=self._run, name="MetricsWriter", daemon=True)
+        self._thread.start()
+
+    def stop(self) -> None:
+        if self._thread is not None:
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.write()
+        self.write()
+
+    def write(self) -> None:
+        now, total = monotonic(), self.metrics.counter(self.rate_counter)
+        if self._last is not None and now > self._last[0]:
+            rate = (total - self._last[1]) / (now - self._last[0])
+            self.metrics.set(f"{self.rate_counter}_per_second", rate)
+            logger.info(
+                f"Processing {rate:.2f} {self.rate_counter} per second",
+                extra={"metrics": {f"{self.rate_counter}_per_second": round(rate, 6), self.rate_counter: total}},
+            )
+        self._last = now, total
+        try:
+            self.metrics.write(self.path)
+        except OSError:
+            logger.exception(f"Unable to write metrics to {self.path}")
@@ -0,0 +1,321 @@
+"""Immutable, pre-hashed index of the global p-code table and its on-disk snapshot"""
+import logging
+from collections.abc import Mapping
+from glob import glob
+from hashlib import sha1
+from json import dump, load
+from os import makedirs, remove, replace
+from os.path import basename, join
+from threading import Lock
+from types import MappingProxyType
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from numpy import array, concatenate, empty, load as load_array, ndarray, save as save_array
+from pandas import Index, Series
+
+from hdx.utilities.dictandlist import dict_of_lists_add
+
+logger = logging.getLogger(__name__)
+
+
+class PcodeIndex(Mapping):
+    """Read-only lookup of p-codes by country that is built once per run.
+
+    Behaves like a mapping of ISO3 code to a frozenset of p-codes. The p-codes of each country are
+    held as arrays, and the sets and the reverse lookup of countries are only built when asked for.
+    Unions for a combination of locations are built on first use and cached as pandas Index
+    objects, so matching a column is a single vectorized hash lookup instead of rebuilding a hash
+    table for every column. When the admin level of the p-codes is known, an array of levels
+    aligned with each union tells the level of the matches from the same lookup.
+    """
+
+    def __init__(
+        self,
+        pcodes: Dict[str, Iterable[str]],
+        version: Optional[str] = None,
+        levels: Optional[Dict[str, int] or Series] = None,
+    ) -> None:
+        self.version = version
+        self._arrays = MappingProxyType({
+            iso: codes if isinstance(codes, ndarray) else array(list(codes), dtype=object)
+            for iso, codes in pcodes.items()
+        })
+        if not isinstance(levels, Series):
+            levels = Series(levels or dict(), dtype="int8")
+        self._raw_levels = levels  # cleaned up on first use
+        self._levels: Optional[Series] = None
+        self._sets: Dict[str, frozenset] = dict()
+        self._countries: Optional[Dict[str, Tuple[str, ...]]] = None
+        self._unions: Dict[Tuple[str, ...], Index] = dict()
+        self._union_levels: Dict[Tuple[str, ...], ndarray] = dict()
+        self._lock = Lock()
+
+    @classmethod
+    def from_rows(
+        cls, rows: Iterable[Tuple], locations: Optional[List[str]] = None, version: Optional[str] = None
+    ) -> "PcodeIndex":
+        """Build the index from (ISO3, p-code) or (ISO3, p-code, admin level) rows of the global p-code table
+
+        Args:
+            rows (Iterable[Tuple]): location, p-code and optionally admin level of each row
+            locations (Optional[List[str]]): only keep these ISO3 codes. Defaults to all.
+            version (Optional[str]): upstream version of the table. Defaults to None.
+
+        Returns:
+            PcodeIndex: index of the rows, including a WORLD entry holding every p-code
+        """
+        pcodes = {"WORLD": []}
+        levels = dict()
+        for row in rows:
+            iso3_code, pcode = row[0], row[1]
+            if locations and iso3_code not in locations and "WORLD" not in locations:
+                continue
+            dict_of_lists_add(pcodes, iso3_code, pcode)
+            pcodes["WORLD"].append(pcode)
+            level = admin_level(row[2]) if len(row) > 2 else None
+            if level is not None:
+                levels[pcode] = level
+        return cls(pcodes, version, levels)
+
+    def __reduce__(self):
+        # the arrays and levels are sent, the sets, unions and lock are built again on the other side
+        return self.__class__, (dict(self._arrays), self.version, self._raw_levels)
+
+    def __getitem__(self, iso3: str) -> frozenset:
+        codes = self._sets.get(iso3)
+        if codes is None:
+            codes = frozenset(self._arrays[iso3])
+            self._sets[iso3] = codes
+        return codes
+
+    def __contains__(self, iso3: object) -> bool:
+        return iso3 in self._arrays
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self._arrays)
+
+    def __len__(self) -> int:
+        return len(self._arrays)
+
+    def countries(self, pcode: str) -> Tuple[str, ...]:
+        """Countries a p-code belongs to
+
+        Args:
+            pcode (str): p-code to look up
+
+        Returns:
+            Tuple[str, ...]: ISO3 codes containing the p-code, empty if it is unknown
+        """
+        if self._countries is None:
+            countries = dict()
+            for iso, codes in self._arrays.items():
+                if iso == "WORLD":
+                    continue
+                for code in codes:
+                    countries.setdefault(code, []).append(iso)
+            with self._lock:
+                self._countries = {code: tuple(isos) for code, isos in countries.items()}
+        return self._countries.get(pcode, tuple())
+
+    def _known_levels(self) -> Series:
+        if self._levels is None:
+            levels = self._raw_levels[self._raw_levels >= 0]
+            with self._lock:
+                self._levels = levels[~levels.index.duplicated(keep="last")]
+        return self._levels
+
+    def level(self, pcode: str) -> Optional[int]:
+        level = self._known_levels().get(pcode)
+        return None if level is None else int(level)
+
+    def lookup_levels(self, locations: Iterable[str]) -> Optional[ndarray]:
+        """Admin levels of the p-codes returned by lookup for the same locations, in the same order
+
+        Args:
+            locations (Iterable[str]): ISO3 codes (or WORLD) of a dataset
+
+        Returns:
+            Optional[ndarray]: level of each p-code, -1 where unknown, None if no level is known at all
+        """
+        if self._known_levels().empty:
+            return None
+        locations = list(locations)
+        union = self.lookup(locations)
+        key = self.location_key(locations)
+        levels = self._union_levels.get(key)
+        if levels is None:
+            levels = self._known_levels().reindex(union).fillna(-1).to_numpy(dtype="int8")
+            with self._lock:
+                self._union_levels[key] = levels
+        return levels
+
+    def location_key(self, locations: Iterable[str]) -> Tuple[str, ...]:
+        """Known locations of a dataset in a canonical order, which identifies the p-codes looked up for them
+
+        Args:
+            locations (Iterable[str]): ISO3 codes (or WORLD) of a dataset
+
+        Returns:
+            Tuple[str, ...]: sorted ISO3 codes that have p-codes
+        """
+        return tuple(sorted({loc for loc in locations if loc in self._arrays}))
+
+    def lookup(self, locations: Iterable[str]) -> Index:
+        """Union of the p-codes of the given locations as a hashed Index, cached per location combination
+
+        Args:
+            locations (Iterable[str]): ISO3 codes (or WORLD) of a dataset
+
+        Returns:
+            Index: unique p-codes of all known locations, empty if none are known
+        """
+        key = self.location_key(locations)
+        union = self._unions.get(key)
+        if union is not None:
+            return union
+        with self._lock:
+            union = self._unions.get(key)
+            if union is None:
+                codes = concatenate([self._arrays[iso] for iso in key]) if key else array([], dtype=object)
+                union = Index(codes, dtype=object).unique().sort_values()
+                self._unions[key] = union
+        return union
+
+    def to_dict(self) -> Dict[str, List[str]]:
+        """Plain dictionary of p-code lists per country in the order they were read, the WORLD
+        list of a snapshot being grouped by country
+
+        Returns:
+            Dict[str, List[str]]: p-codes per ISO3 code
+        """
+        return {iso: codes.tolist() for iso, codes in self._arrays.items()}
+
+
+def admin_level(value: object) -> Optional[int]:
+    """Admin level of a row of the global p-code table, such as 2 or "2"
+
+    Args:
+        value (object): value of the admin level column
+
+    Returns:
+        Optional[int]: level or None if it is not a number, or is negative as unknown levels are in snapshots
+    """
+    try:
+        level = int(float(value))
+    except (TypeError, ValueError):
+        return None
+    return level if level >= 0 else None
+
+
+class PcodeSnapshot:
+    """Versioned copy of the global p-code table stored as a memory-mappable numpy array.
+
+    Rows are stored grouped by country, and the pointer file records where each country starts
+    and ends, so loading slices the array instead of going through it row by row. The pointer
+    also records the upstream version (resource id, last modified and hash), the array file it
+    belongs to and the schema the table was read with. A snapshot of another schema, such as one
+    read before the admin level column was configured, is ignored. The array and the pointer are
+    replaced atomically so a reader never sees a partial write.
+    """
+
+    pointer_name = "global_pcodes.json"
+    layout = 2  # rows grouped by country
+
+    def __init__(self, folder: str, level: Optional[str] = None) -> None:
+        self.folder = folder
+        self.schema = {"layout": self.layout, "level": level}
+
+    def _pointer(self) -> Optional[Dict]:
+        try:
+            with open(join(self.folder, self.pointer_name)) as f:
+                pointer = load(f)
+        except (FileNotFoundError, ValueError):
+            return None
+        if pointer.get("schema") != self.schema:
+            logger.info(f"Ignoring p-code snapshot saved with schema {pointer.get('schema')}")
+            return None
+        return pointer
+
+    def version(self) -> Optional[str]:
+        """Upstream version of the stored snapshot
+
+        Returns:
+            Optional[str]: version string or None if there is no snapshot
+        """
+        pointer = self._pointer()
+        if not pointer:
+            return None
+        return pointer["version"]
+
+    def load(self, locations: Optional[List[str]] = None) -> Optional[PcodeIndex]:
+        """Read the snapshot into a PcodeIndex
+
+        Args:
+            locations (Optional[List[str]]): only keep these ISO3 codes. Defaults to all.
+
+        Returns:
+            Optional[PcodeIndex]: index or None if there is no usable snapshot
+        """
+        pointer = self._pointer()
+        if not pointer:
+            return None
+        try:
+            rows = load_array(join(self.folder, pointer["file"]), mmap_mode="r")
+        except (FileNotFoundError, ValueError) as exc:
+            logger.warning(f"Unable to read p-code snapshot {pointer['file']}: {exc}")
+            return None
+        groups = pointer["groups"]
+        if locations and "WORLD" not in locations:
+            groups = {iso: bounds for iso, bounds in groups.items() if iso in locations}
+        pcodes = {iso: rows["pcode"][start:stop].astype(object) for iso, (start, stop) in groups.items()}
+        pcodes["WORLD"] = concatenate(list(pcodes.values())) if pcodes else array([], dtype=object)
+        levels = None
+        if "level" in rows.dtype.names:
+            levels = Series(
+                concatenate([rows["level"][start:stop] for start, stop in groups.values()] or [array([], "int8")]),
+                index=pcodes["WORLD"],
+            )
+        return PcodeIndex(pcodes, pointer["version"], levels)
+
+    def save(self, version: str, rows: List[Tuple[str, str]]) -> None:
+        """Store rows of the global p-code table under the given upstream version
+
+        Args:
+            version (str): upstream version of the table
+            rows (List[Tuple[str, str]]): location, p-code and optionally admin level of each row
+
+        Returns:
+            None
+        """
+        makedirs(self.folder, exist_ok=True)
+        rows = sorted(rows, key=lambda r: r[0])  # stable, so each country keeps the order of its rows
+        groups = dict()
+        for i, row in enumerate(rows):
+            groups.setdefault(row[0], [i, i])[1] = i + 1
+        width_location = max([len(r[0]) for r in rows], default=1)
+        width_pcode = max([len(r[1]) for r in rows], default=1)
+        dtype = [("location", f"U{width_location}"), ("pcode", f"U{width_pcode}")]
+        with_levels = any(len(r) > 2 for r in rows)
+        if with_levels:
+            dtype.append(("level", "int8"))
+        array = empty(len(rows), dtype=dtype)
+        array["location"] = [r[0] for r in rows]
+        array["pcode"] = [r[1] for r in rows]
+        if with_levels:
+            levels = [admin_level(r[2]) if len(r) > 2 else None for r in rows]
+            array["level"] = [-1 if level is None else level for level in levels]
+
+        file_name = f"global_pcodes_{sha1(version.encode()).hexdigest()[:12]}.npy"
+        with open(join(self.folder, f"{file_name}.tmp"), "wb") as f:
+            save_array(f, array)
+        replace(join(self.folder, f"{file_name}.tmp"), join(self.folder, file_name))
+        with open(join(self.folder, f"{self.pointer_name}.tmp"), "w") as f:
+            dump({"version": version, "file": file_name, "rows": len(rows), "schema": self.schema, "groups": groups}, f)
+        replace(join(self.folder, f"{self.pointer_name}.tmp"), join(self.folder, self.pointer_name))
+
+        for old_file in glob(join(self.folder, "global_pcodes_*.npy")):
+            if basename(old_file) != file_name:
+                try:
+                    remove(old_file)
+                except OSError:
+                    pass
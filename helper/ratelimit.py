@@ -0,0 +1,47 @@
+"""Rate limiting of downloads per host that is shared between workers"""
+from threading import Lock
+from time import monotonic, sleep
+from urllib.parse import urlsplit
+
+from hdx.utilities.downloader import Download
+
+
+class HostRateLimiter:
+    """Spaces out requests to the same host across all threads that share the limiter.
+
+    Download(rate_limit=...) only limits a single Download object, so with several workers the
+    combined rate would grow with the number of workers. Wrapping each worker's downloader with
+    the same HostRateLimiter keeps the configured rate per host.
+    """
+
+    def __init__(self, calls: int, period: float) -> None:
+        self.interval = period / calls
+        self._next_slot = dict()
+        self._lock = Lock()
+
+    def wait(self, url: str) -> None:
+        host = urlsplit(url).netloc
+        with self._lock:
+            now = monotonic()
+            slot = max(now, self._next_slot.get(host, now))
+            self._next_slot[host] = slot + self.interval
+        if slot > now:
+            sleep(slot - now)
+
+    def wrap(self, downloader: Download) -> Download:
+        """Make every request of the downloader wait for its slot on the host
+
+        Args:
+            downloader (Download): downloader to limit
+
+        Returns:
+            Download: the same downloader
+        """
+        setup = downloader.setup
+
+        def limited_setup(url: str, *args, **kwargs):
+            self.wait(url)
+            return setup(url, *args, **kwargs)
+
+        downloader.setup = limited_setup
+        return downloader
@@ -0,0 +1,177 @@
+"""Persistent cache of p-code detection results"""
+import logging
+import sqlite3
+from hashlib import sha256
+from os import makedirs
+from os.path import dirname, isfile
+from threading import Lock
+from time import time
+from typing import List, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DIGEST_CHUNK_SIZE = 1048576
+
+
+def content_digest(contents: bytes) -> str:
+    """Cache key of the bytes a decision was made from
+
+    Args:
+        contents (bytes): contents read from the resource
+
+    Returns:
+        str: key based on the sha256 digest
+    """
+    return f"content:{sha256(contents).hexdigest()}"
+
+
+def file_digest(paths: List[str]) -> Optional[str]:
+    """Cache key of downloaded files based on their contents
+
+    Args:
+        paths (List[str]): files to hash
+
+    Returns:
+        Optional[str]: key based on the sha256 digest or None if any path is not a plain file
+    """
+    if not paths or not all([isfile(p) for p in paths]):
+        return None
+    digest = sha256()
+    for path in sorted(paths):
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(DIGEST_CHUNK_SIZE), b""):
+                digest.update(chunk)
+    return f"content:{digest.hexdigest()}"
+
+
+def scoped_key(key: Optional[str], locations: Tuple[str, ...]) -> Optional[str]:
+    """Key of a decision made against the p-codes of some locations, as the same file can be
+    p-coded for the locations of one dataset and not for those of another
+
+    Args:
+        key (Optional[str]): metadata key or content digest
+        locations (Tuple[str, ...]): location key of the p-codes, as from PcodeIndex.location_key
+
+    Returns:
+        Optional[str]: key including the locations or None if key is None
+    """
+    if key is None:
+        return None
+    return f"{key}|{','.join(locations)}"
+
+
+class ResultCache:
+    """SQLite store of p-coded decisions keyed by resource metadata or content digest.
+
+    Each entry records the version of the inputs it was computed with (global p-code table and
+    matching settings). When the version changes, entries from other versions are dropped. Entries
+    are also evicted when older than max_age_days or beyond max_entries, least recently used first.
+    """
+
+    def __init__(self, path: str, max_entries: int = 200_000, max_age_days: float = 30) -> None:
+        if dirname(path):
+            makedirs(dirname(path), exist_ok=True)
+        self.max_entries = max_entries
+        self.max_age = max_age_days * 86400
+        self.hits = 0
+        self.misses = 0
+        self._puts = 0
+        self._version = None
+        self._lock = Lock()
+        self._connection = sqlite3.connect(path, timeout=30, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS results ("
+                "key TEXT PRIMARY KEY, version TEXT, pcoded INTEGER, column_name TEXT, "
+                "seconds REAL, created REAL, accessed REAL)"
+            )
+        self.evict()
+
+    @staticmethod
+    def metadata_key(resource: dict) -> Optional[str]:
+        """Key of a resource from its url, last modified date, hash and size
+
+        Args:
+            resource (dict): HDX resource
+
+        Returns:
+            Optional[str]: key or None if the resource has neither last_modified nor hash
+        """
+        if not resource.get("last_modified") and not resource.get("hash"):
+            return None
+        parts = [str(resource.get(k) or "") for k in ["url", "last_modified", "hash", "size"]]
+        return f"metadata:{sha256('|'.join(parts).encode()).hexdigest()}"
+
+    def _check_version(self, version: str) -> None:
+        if version == self._version:
+            return
+        with self._connection:
+            deleted = self._connection.execute("DELETE FROM results WHERE version != ?", (version,)).rowcount
+        if deleted:
+            logger.info(f"Invalidated {deleted} cached results of other versions")
+        self._version = version
+
+    def get(self, key: Optional[str], version: str) -> Optional[Tuple[bool, Optional[str]]]:
+        """Cached decision for a key
+
+        Args:
+            key (Optional[str]): metadata key or content digest
+            version (str): version of the inputs the decision must have been made with
+
+        Returns:
+            Optional[Tuple[bool, Optional[str]]]: (pcoded, matching column) or None if not cached
+        """
+        if key is None:
+            return None
+        with self._lock:
+            self._check_version(version)
+            row = self._connection.execute(
+                "SELECT pcoded, column_name FROM results WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            with self._connection:
+                self._connection.execute("UPDATE results SET accessed = ? WHERE key = ?", (time(), key))
+            self.hits += 1
+        return bool(row[0]), row[1]
+
+    def put(self, keys: List[Optional[str]], version: str, pcoded: bool, column: Optional[str], seconds: float) -> None:
+        """Store a decision under all the keys it is known by
+
+        Args:
+            keys (List[Optional[str]]): metadata key and/or content digest, None values are ignored
+            version (str): version of the inputs the decision was made with
+            pcoded (bool): decision
+            column (Optional[str]): header of the matching column
+            seconds (float): time taken to make the decision
+
+        Returns:
+            None
+        """
+        now = time()
+        rows = [(key, version, int(pcoded), column, seconds, now, now) for key in keys if key]
+        with self._lock:
+            self._check_version(version)
+            with self._connection:
+                self._connection.executemany("INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+            self._puts += 1
+        if self._puts % 1000 == 0:
+            self.evict()
+
+    def evict(self) -> None:
+        """Remove entries that are too old or beyond max_entries
+
+        Returns:
+            None
+        """
+        with self._lock:
+            with self._connection:
+                self._connection.execute("DELETE FROM results WHERE created < ?", (time() - self.max_age,))
+                self._connection.execute(
+                    "DELETE FROM results WHERE key NOT IN (SELECT key FROM results ORDER BY accessed DESC LIMIT ?)",
+                    (self.max_entries,),
+                )
+
+    def close(self) -> None:
+        self._connection.close()
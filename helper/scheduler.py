@@ -0,0 +1,105 @@
+"""Lanes with their own concurrency limits for resources of different sizes and formats, so small
+resources are not held up behind large ones"""
+import logging
+from threading import BoundedSemaphore
+from time import monotonic
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+from helper.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+FAST = "fast"
+SLOW = "slow"
+
+FORMAT_EXTENSIONS = {"geodatabase": "gdb", "geopackage": "gpkg"}
+
+
+class LaneScheduler:
+    """Routes resources to a fast or a slow lane from their declared size and format.
+
+    A resource goes to the fast lane when its format is one of fast_formats and its declared size
+    is at most fast_max_bytes. Newly created resources go to the fast lane whatever their format as
+    long as they are not declared larger than fast_max_bytes, so a fresh upload is checked quickly.
+    Everything else, including resources of unknown size, goes to the slow lane. Each lane runs at
+    most as many resources at once as its limit, and resources of the fast lane that take longer
+    than latency_budget seconds from arrival to result are logged and counted.
+    """
+
+    def __init__(self, lanes: Dict[str, int], fast_max_bytes: int, fast_formats: Iterable[str],
+                 latency_budget: float) -> None:
+        self.lanes = lanes
+        self.fast_max_bytes = fast_max_bytes
+        self.fast_formats = set(f.lower() for f in fast_formats)
+        self.latency_budget = latency_budget
+        self._semaphores = {lane: BoundedSemaphore(limit) for lane, limit in lanes.items()}
+
+    def classify(self, resource: Dict, created: bool = False) -> str:
+        """Lane of a resource
+
+        Args:
+            resource (Dict): resource metadata with at least format and size
+            created (bool): the resource was just created. Defaults to False.
+
+        Returns:
+            str: FAST or SLOW
+        """
+        file_ext = (resource.get("format") or "").lower()
+        file_ext = FORMAT_EXTENSIONS.get(file_ext, file_ext)
+        size = resource.get("size") or None
+        if size is not None and size > self.fast_max_bytes:
+            return SLOW
+        if created:
+            return FAST
+        if size is None or file_ext not in self.fast_formats:
+            return SLOW
+        return FAST
+
+    def split(self, resources: List[Dict], created: bool = False) -> Dict[str, List[Dict]]:
+        """Group resources by lane, keeping their order within each lane
+
+        Args:
+            resources (List[Dict]): resource metadata
+            created (bool): the resources were just created. Defaults to False.
+
+        Returns:
+            Dict[str, List[Dict]]: resources of each lane that has any
+        """
+        lanes = dict()
+        for resource in resources:
+            lanes.setdefault(self.classify(resource, created), list()).append(resource)
+        return lanes
+
+    def run(self, lane: str, function: Callable[..., Any], *args, arrived: Optional[float] = None, **kwargs) -> Any:
+        """Call a function once the lane has room for it
+
+        Args:
+            lane (str): lane of the work
+            function (Callable[..., Any]): work to do
+            *args: positional arguments of the function
+            arrived (Optional[float]): monotonic time the work arrived, defaults to now
+            **kwargs: keyword arguments of the function
+
+        Returns:
+            Any: the result of the function
+        """
+        if arrived is None:
+            arrived = monotonic()
+        metrics = get_metrics()
+        with self._semaphores[lane]:
+            metrics.observe("lane_wait", monotonic() - arrived, lane=lane)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                latency = monotonic() - arrived
+                metrics.observe("lane_latency", latency, lane=lane)
+                if lane == FAST and latency > self.latency_budget:
+                    metrics.increment("latency_budget_exceeded", lane=lane)
+                    logger.warning(f"Resource of the {lane} lane took {latency:.1f}s, over its budget of {self.latency_budget}s")
+
+
+def get_lane_scheduler(configuration: Dict) -> LaneScheduler:
+    settings = configuration["scheduler"]
+    return LaneScheduler(
+        settings["lanes"], settings["fast_max_bytes"], settings["fast_formats"], settings["latency_budget"]
+    )
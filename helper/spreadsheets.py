@@ -0,0 +1,290 @@
+"""Reading the top rows of the visible sheets of xls and xlsx workbooks"""
+import logging
+from datetime import datetime
+from posixpath import dirname, join, normpath
+from typing import Dict, Iterator, List, Optional
+from xml.etree.ElementTree import iterparse
+from zipfile import ZipFile, is_zipfile
+
+from numpy import nan
+from openpyxl.styles.numbers import BUILTIN_FORMATS, is_date_format
+from openpyxl.utils import column_index_from_string
+from openpyxl.utils.datetime import CALENDAR_MAC_1904, CALENDAR_WINDOWS_1900, from_excel
+from pandas import DataFrame, ExcelFile
+from pandas.errors import EmptyDataError
+from pandas.io.parsers import TextParser
+from xlrd import open_workbook
+
+logger = logging.getLogger(__name__)
+
+# relationship ids of transitional and of strict OOXML workbooks
+RELATIONSHIP_IDS = [
+    "{http://schemas.openxmlformats.org/officeDocument/2006/relationships}id",
+    "{http://purl.oclc.org/ooxml/officeDocument/relationships}id",
+]
+
+
+def local_name(tag: str) -> str:
+    return tag.rsplit("}", 1)[-1]
+
+
+def relationship_id(element) -> Optional[str]:
+    for attribute in RELATIONSHIP_IDS:
+        value = element.get(attribute)
+        if value is not None:
+            return value
+    return None
+
+
+def xls_visibility(book) -> List[int]:
+    # the visibility of all sheets is read from the sheet records on opening, but xlrd only exposes
+    # it per sheet, loading the sheet, so the loaded list is used where this version of xlrd has it
+    visibility = getattr(book, "_sheet_visibility", None)
+    if isinstance(visibility, list) and len(visibility) == book.nsheets:
+        return visibility
+    visibility = list()
+    for index in range(book.nsheets):
+        visibility.append(book.sheet_by_index(index).visibility)
+        book.unload_sheet(index)
+    return visibility
+
+
+def element_text(element) -> str:
+    # text of a shared or inline string, leaving out phonetic runs
+    parts = []
+    for child in element:
+        name = local_name(child.tag)
+        if name == "t":
+            parts.append(child.text or "")
+        elif name == "r":
+            parts.extend([t.text or "" for t in child if local_name(t.tag) == "t"])
+    return "".join(parts)
+
+
+class SharedStrings:
+    """Shared strings of an xlsx workbook, parsed only as far as the highest index asked for.
+
+    Strings are usually stored in order of first use, so reading the top rows of each sheet only
+    needs the start of the table, which can be most of the file in text-heavy workbooks.
+    """
+
+    def __init__(self, archive: ZipFile, path: Optional[str]) -> None:
+        self._strings = []
+        self._file = None
+        self._elements = iter(())
+        if path:
+            self._file = archive.open(path)
+            self._elements = iterparse(self._file, events=("end",))
+
+    def __getitem__(self, index: int) -> str:
+        while len(self._strings) <= index:
+            _, element = next(self._elements)
+            if local_name(element.tag) == "si":
+                self._strings.append(element_text(element))
+                element.clear()
+        return self._strings[index]
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+
+
+class XlsxBook:
+    """Minimal streaming reader of xlsx workbooks that yields cell values the way pandas converts
+    them from openpyxl, without loading the shared strings or whole sheets up front.
+
+    openpyxl in read-only mode also streams sheets but reads all the shared strings and styles
+    when the workbook is opened, which dominates reading the top rows of large text-heavy
+    workbooks: in benchmarks/excel.py it is 5 to 17 times slower than this reader for 10 to
+    50 MB workbooks. test_workbook checks the values read against pandas with openpyxl.
+    """
+
+    def __init__(self, path: str) -> None:
+        self.archive = ZipFile(path)
+        workbook = {kind: target for target, kind in self._relationships("").values()}["officeDocument"]
+        relationships = self._relationships(workbook)
+        self.sheets = dict()
+        self.hidden = set()
+        epoch = CALENDAR_WINDOWS_1900
+        with self.archive.open(workbook) as f:
+            for _, element in iterparse(f):
+                name = local_name(element.tag)
+                if name == "workbookPr" and element.get("date1904") in ("1", "true"):
+                    epoch = CALENDAR_MAC_1904
+                elif name == "sheet":
+                    target, kind = relationships[relationship_id(element)]
+                    if kind != "worksheet":  # chartsheets have no cells
+                        continue
+                    self.sheets[element.get("name")] = target
+                    if element.get("state", "visible") != "visible":
+                        self.hidden.add(element.get("name"))
+        self.epoch = epoch
+        targets = {kind: target for target, kind in relationships.values()}
+        self.shared_strings = SharedStrings(self.archive, targets.get("sharedStrings"))
+        self.date_styles = self._date_styles(targets.get("styles"))
+
+    def _relationships(self, part: str) -> Dict:
+        path = join(dirname(part), "_rels", f"{part.rsplit('/', 1)[-1]}.rels")
+        relationships = dict()
+        with self.archive.open(path) as f:
+            for _, element in iterparse(f):
+                if local_name(element.tag) != "Relationship":
+                    continue
+                target = element.get("Target")
+                target = target.lstrip("/") if target.startswith("/") else normpath(join(dirname(part), target))
+                relationships[element.get("Id")] = target, element.get("Type").rsplit("/", 1)[-1]
+        return relationships
+
+    def _date_styles(self, path: Optional[str]) -> List[bool]:
+        if not path:
+            return []
+        formats = dict()
+        styles = []
+        in_cell_xfs = False
+        with self.archive.open(path) as f:
+            for event, element in iterparse(f, events=("start", "end")):
+                name = local_name(element.tag)
+                if name == "cellXfs":
+                    in_cell_xfs = event == "start"
+                elif event == "end" and name == "numFmt":
+                    formats[int(element.get("numFmtId"))] = element.get("formatCode")
+                elif event == "end" and name == "xf" and in_cell_xfs:
+                    number_format = int(element.get("numFmtId", 0))
+                    code = formats.get(number_format, BUILTIN_FORMATS.get(number_format))
+                    styles.append(code is not None and is_date_format(code))
+        return styles
+
+    def _value(self, cell):
+        cell_type = cell.get("t", "n")
+        value = None
+        for child in cell:
+            name = local_name(child.tag)
+            if name == "v":
+                value = child.text
+            elif name == "is":
+                return element_text(child)
+        if cell_type == "inlineStr" or value is None:
+            return ""
+        if cell_type == "s":
+            return self.shared_strings[int(value)]
+        if cell_type == "b":
+            return bool(int(value))
+        if cell_type == "e":
+            return nan
+        if cell_type == "str":
+            return value
+        if cell_type == "d":
+            try:
+                return datetime.fromisoformat(value.rstrip("Z"))
+            except ValueError:
+                return value
+        number = float(value) if any(c in value for c in ".eE") else int(value)
+        style = int(cell.get("s", 0))
+        if style < len(self.date_styles) and self.date_styles[style]:
+            return from_excel(number, self.epoch)
+        if isinstance(number, float) and number.is_integer():
+            return int(number)
+        return number
+
+    def rows(self, sheet_name: str) -> Iterator[List]:
+        """Rows of a sheet as lists of values, empty cells being empty strings
+
+        Args:
+            sheet_name (str): name of the sheet
+
+        Returns:
+            Iterator[List]: rows from the top of the sheet
+        """
+        row_number = 0
+        with self.archive.open(self.sheets[sheet_name]) as f:
+            for _, element in iterparse(f, events=("end",)):
+                if local_name(element.tag) != "row":
+                    continue
+                number = int(element.get("r", row_number + 1))
+                while row_number < number - 1:  # rows without any cell are left out of the file
+                    row_number += 1
+                    yield []
+                row_number = number
+                row = []
+                for cell in element:
+                    if local_name(cell.tag) != "c":
+                        continue
+                    reference = cell.get("r")
+                    if reference:
+                        column = column_index_from_string(reference.rstrip("0123456789"))
+                        row.extend([""] * (column - 1 - len(row)))
+                    row.append(self._value(cell))
+                element.clear()
+                yield row
+
+    def close(self) -> None:
+        self.shared_strings.close()
+        self.archive.close()
+
+
+class Workbook:
+    """Workbook opened once and read sheet by sheet, only as far down as asked.
+
+    xlsx files are read with XlsxBook, which streams the rows of a sheet and stops after nrows
+    rows. xls files are opened on demand with xlrd so a sheet is only loaded when it is read. Hidden
+    sheets are left out of sheet_names, which for xls comes from the sheet records of the workbook
+    without loading any sheet, so empty sheets are only found out when they are read. Frames are
+    built by the pandas parser used by ExcelFile.parse so they have the same shape.
+    """
+
+    def __init__(self, path: str) -> None:
+        self._xlsx, self._excel = None, None
+        if is_zipfile(path):  # xlsx whatever the extension says
+            self._xlsx = XlsxBook(path)
+            self.sheet_names = [name for name in self._xlsx.sheets if name not in self._xlsx.hidden]
+        else:
+            book = open_workbook(path, on_demand=True)
+            self._excel = ExcelFile(book, engine="xlrd")
+            visibility = xls_visibility(book)
+            self.sheet_names = [name for name, hidden in zip(book.sheet_names(), visibility) if hidden == 0]
+
+    def __enter__(self) -> "Workbook":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def parse(self, sheet_name: str, nrows: Optional[int] = None, usecols: Optional[List[int]] = None) -> DataFrame:
+        """Read the top of a sheet
+
+        Args:
+            sheet_name (str): name of the sheet
+            nrows (Optional[int]): number of data rows to read, all if None
+            usecols (Optional[List[int]]): positions of the columns to keep, all if None
+
+        Returns:
+            DataFrame: the rows read with the first row as header
+        """
+        if self._excel is not None:
+            return self._excel.parse(sheet_name, nrows=nrows, usecols=usecols)
+
+        data = []
+        last_row_with_data = -1
+        for row in self._xlsx.rows(sheet_name):
+            while row and row[-1] == "":
+                row.pop()
+            if row:
+                last_row_with_data = len(data)
+            data.append(row)
+            if nrows is not None and len(data) > nrows:  # header and nrows rows
+                break
+        data = data[: last_row_with_data + 1]
+        if not data:
+            return DataFrame()
+        width = max([len(row) for row in data])
+        data = [row + [""] * (width - len(row)) for row in data]
+        try:
+            return TextParser(data, header=0, nrows=nrows, usecols=usecols, skip_blank_lines=False).read(nrows=nrows)
+        except EmptyDataError:
+            return DataFrame()
+
+    def close(self) -> None:
+        if self._xlsx is not None:
+            self._xlsx.close()
+        if self._excel is not None:
+            self._excel.close()
@@ -0,0 +1,38 @@
+"""Startup time and memory of each mode, to check that idle and light paths stay free of the heavy dependencies"""
+import logging
+import sys
+from resource import RUSAGE_SELF, getrusage
+from time import monotonic
+from typing import Dict
+
+from helper.metrics import get_metrics
+
+logger = logging.getLogger(__name__)
+
+HEAVY_MODULES = ["pandas", "numpy", "hdx.data.dataset", "pyogrio", "fiona", "geopandas", "openpyxl", "xlrd"]
+
+
+def startup_report(mode: str, started: float) -> Dict:
+    """Log how long the process took to get ready and how much memory it holds
+
+    Args:
+        mode (str): mode of the process, such as idle, listener or batch
+        started (float): monotonic time at which the process started
+
+    Returns:
+        Dict: fields of the log record
+    """
+    seconds = monotonic() - started
+    rss_mb = getrusage(RUSAGE_SELF).ru_maxrss / 1024
+    fields = {
+        "mode": mode,
+        "seconds": round(seconds, 6),
+        "peak_rss_mb": round(rss_mb, 1),
+        "modules": len(sys.modules),
+        "heavy_modules": [m for m in HEAVY_MODULES if m in sys.modules],
+    }
+    metrics = get_metrics()
+    metrics.set("startup_seconds", seconds, mode=mode)
+    metrics.set("startup_rss_mb", rss_mb, mode=mode)
+    logger.info(f"Started {mode} mode in {seconds:.2f}s with {rss_mb:.0f} MB", extra={"startup": fields})
+    return fields
@@ -0,0 +1,156 @@
+"""Byte ceilings on downloads and decompression, and temporary folders charged against a disk quota"""
+import logging
+from os import makedirs
+from os.path import dirname, join
+from shutil import rmtree
+from threading import Lock
+from typing import IO, List, Optional
+from zipfile import ZipInfo
+
+from hdx.utilities.retriever import Retrieve
+from hdx.utilities.uuid import get_uuid
+
+from helper.metrics import count
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1048576
+
+
+class SizeLimitExceeded(Exception):
+    """Raised when a resource, once downloaded or decompressed, would be larger than allowed"""
+
+
+class DiskQuota:
+    """Bytes of temporary storage used by all work sharing the quota, such as the threads of the
+    listener or the resources processed by a crawl worker
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.used = 0
+        self.peak = 0
+        self._lock = Lock()
+
+    def reserve(self, nbytes: int) -> None:
+        with self._lock:
+            if self.used + nbytes > self.limit:
+                raise SizeLimitExceeded(f"Temporary storage quota of {self.limit} bytes used up")
+            self.used += nbytes
+            self.peak = max(self.peak, self.used)
+
+    def release(self, nbytes: int) -> None:
+        with self._lock:
+            self.used -= nbytes
+
+
+class Workspace:
+    """Temporary folder for the files of one resource.
+
+    Every byte written through the workspace is counted before it is written, against the ceiling of
+    the resource and against the shared quota, so an oversized download or archive is abandoned as
+    soon as it goes over. Closing removes the folder and returns its bytes to the quota.
+    """
+
+    def __init__(self, parent_folder: str, quota: DiskQuota, max_bytes: int, max_ratio: float = 100) -> None:
+        self.folder = join(parent_folder, get_uuid())
+        self.quota = quota
+        self.max_bytes = max_bytes
+        self.max_ratio = max_ratio
+        self.used = 0
+        makedirs(self.folder)
+
+    def __enter__(self) -> "Workspace":
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def subfolder(self) -> str:
+        return join(self.folder, get_uuid())
+
+    def charge(self, nbytes: int) -> None:
+        """Count bytes about to be written
+
+        Args:
+            nbytes (int): number of bytes
+
+        Returns:
+            None
+        """
+        if self.used + nbytes > self.max_bytes:
+            raise SizeLimitExceeded(f"Resource would take more than {self.max_bytes} bytes")
+        self.quota.reserve(nbytes)
+        self.used += nbytes
+
+    def charge_members(self, members: List[ZipInfo]) -> None:
+        """Count the archive members about to be extracted from their declared sizes. ZipFile never
+        extracts more than the declared size of a member, so this bounds what reaches the disk.
+
+        Args:
+            members (List[ZipInfo]): members to extract
+
+        Returns:
+            None
+        """
+        file_size = sum([m.file_size for m in members])
+        compress_size = sum([m.compress_size for m in members])
+        if file_size > CHUNK_SIZE and file_size > compress_size * self.max_ratio:
+            raise SizeLimitExceeded(f"Archive expands {file_size / max(compress_size, 1):.0f} times")
+        self.charge(file_size)
+
+    def copy(self, source: IO, path: str) -> str:
+        """Write a stream to a file in the workspace
+
+        Args:
+            source (IO): binary stream such as a decompressing file object
+            path (str): destination
+
+        Returns:
+            str: the destination
+        """
+        makedirs(dirname(path), exist_ok=True)
+        with open(path, "wb") as f:
+            for chunk in iter(lambda: source.read(CHUNK_SIZE), b""):
+                self.charge(len(chunk))
+                f.write(chunk)
+        return path
+
+    def download(self, retriever: Retrieve, url: str, max_bytes: Optional[int] = None) -> str:
+        """Download a file into the workspace, aborting as soon as it goes over the ceiling
+
+        Args:
+            retriever (Retrieve): retriever whose downloader is used
+            url (str): url of the file
+            max_bytes (Optional[int]): ceiling on the size of the file, on top of the one of the workspace
+
+        Returns:
+            str: path of the downloaded file, or of the saved file when the retriever uses saved data
+        """
+        if retriever.use_saved:  # saved files are read where they are
+            return retriever.download_file(url)
+        filename, _ = retriever.get_filename(url)
+        path = join(self.folder, filename)
+        downloader = retriever.downloader
+        response = downloader.setup(url, stream=True)
+        try:
+            length = response.headers.get("Content-Length")
+            if max_bytes is not None and length and int(length) > max_bytes:
+                raise SizeLimitExceeded(f"{url} is {length} bytes")
+            written = 0
+            with open(path, "wb") as f:
+                for chunk in response.iter_content(chunk_size=CHUNK_SIZE):
+                    written += len(chunk)
+                    if max_bytes is not None and written > max_bytes:
+                        raise SizeLimitExceeded(f"{url} is more than {max_bytes} bytes")
+                    self.charge(len(chunk))
+                    f.write(chunk)
+        finally:
+            downloader.close_response()
+        count("bytes_downloaded", written)
+        return path
+
+    def close(self) -> None:
+        rmtree(self.folder, ignore_errors=True)
+        self.quota.release(self.used)
+        self.used = 0
@@ -0,0 +1,85 @@
+"""Incremental reading of the start of remote text resources"""
+from typing import Optional
+from zlib import MAX_WBITS, decompressobj
+
+from hdx.utilities.downloader import Download
+
+from helper.storage import SizeLimitExceeded
+
+CHUNK_SIZE = 65536
+GZIP_MAGIC = b"\x1f\x8b"
+ZIP_MAGIC = b"PK\x03\x04"
+
+
+class ArchiveContent(Exception):
+    """Raised when a resource declared as text turns out to be a zip archive"""
+
+
+class StreamedText:
+    """Reads a text resource (optionally gzipped) chunk by chunk so only as many lines as needed are fetched.
+
+    The connection is closed as soon as the caller stops asking for lines, which means a large csv
+    only costs the bytes of its first rows rather than the whole file. Buffering more than max_bytes
+    of text, for instance from very long lines or a gzip bomb, raises SizeLimitExceeded.
+    """
+
+    def __init__(self, downloader: Download, url: str, chunk_size: int = CHUNK_SIZE,
+                 max_bytes: Optional[int] = None) -> None:
+        self.downloader = downloader
+        self.url = url
+        self.chunk_size = chunk_size
+        self.max_bytes = max_bytes
+        self.bytes_read = 0
+        self.exhausted = False
+        self._buffer = b""
+        self._newlines = 0
+        self._chunks = None
+        self._decompressor = None
+
+    def __enter__(self) -> "StreamedText":
+        response = self.downloader.setup(self.url, stream=True)
+        self._chunks = response.iter_content(chunk_size=self.chunk_size)
+        return self
+
+    def __exit__(self, *args) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.downloader.close_response()
+
+    def _next_chunk(self) -> bytes:
+        try:
+            chunk = next(self._chunks)
+        except StopIteration:
+            self.exhausted = True
+            if self._decompressor:
+                return self._decompressor.flush()
+            return b""
+        if self.bytes_read == 0:
+            if chunk.startswith(ZIP_MAGIC):
+                raise ArchiveContent(f"{self.url} is a zip archive")
+            if chunk.startswith(GZIP_MAGIC):
+                self._decompressor = decompressobj(16 + MAX_WBITS)
+        self.bytes_read += len(chunk)
+        if self._decompressor:
+            return self._decompressor.decompress(chunk)
+        return chunk
+
+    def read_lines(self, nlines: int) -> bytes:
+        """Read until at least nlines complete lines are buffered or the resource ends
+
+        Args:
+            nlines (int): number of complete lines wanted from the start of the resource
+
+        Returns:
+            bytes: the start of the resource, cut after the last complete line unless the resource ended
+        """
+        while not self.exhausted and self._newlines < nlines:
+            chunk = self._next_chunk()
+            self._newlines += chunk.count(b"\n")
+            self._buffer += chunk
+            if self.max_bytes is not None and len(self._buffer) > self.max_bytes:
+                raise SizeLimitExceeded(f"More than {self.max_bytes} bytes of text read from {self.url}")
+        if self.exhausted:
+            return self._buffer
+        return self._buffer[:self._buffer.rfind(b"\n") + 1]
@@ -0,0 +1,305 @@
+"""Offline replay of recorded HDX events through the event processor of the listener.
+
+Events are read from a JSONL file, one event of the HDX event bus per line, and dispatched to as
+many threads as the listener runs at a fixed rate, at the recorded pace or all at once. Datasets,
+resources and their files come from a fixture folder such as tests/fixtures/input: dataset JSON
+files as saved by Dataset.save_to_json and resource files as saved by a Retrieve with save=True.
+Updates of p_coded and Slack posts are recorded locally instead of being sent. Run from the
+repository root:
+
+    python replay.py events.jsonl --fixtures tests/fixtures/input --rate 5
+
+The report gives the processing rate, the latency percentiles from dispatch to result and the
+peak RSS of the process. As on the event bus, the result of an event is only returned once its
+resource is processed, whatever its lane.
+"""
+import argparse
+import logging
+import sys
+from contextlib import contextmanager
+from datetime import datetime, timezone
+from glob import glob
+from json import dump, load, loads
+from os.path import isfile, join
+from queue import Queue
+from resource import RUSAGE_SELF, getrusage
+from threading import Lock, Thread
+from time import monotonic, sleep
+from typing import Callable, Dict, List, Optional, Tuple
+
+from hdx.api.configuration import Configuration
+from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
+from hdx.utilities.downloader import Download
+from hdx.utilities.path import temp_dir
+from hdx.utilities.retriever import Retrieve
+from hdx.utilities.uuid import get_uuid
+
+import slack
+from helper.ckan import PcodeUpdateClient
+
+logger = logging.getLogger(__name__)
+
+FORMATS_FILE = "resource_formats.json"
+
+
+class FixtureCatalogue:
+    """Datasets and resources of the dataset JSON files of a fixture folder, found by id or name"""
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        self.datasets = dict()  # dataset id or name -> path of its JSON file
+        self.resources = dict()  # resource id -> path of the JSON file of its dataset
+        for path in sorted(glob(join(folder, "*.json"))):
+            with open(path) as f:
+                data = load(f)
+            if not isinstance(data, dict) or "resources" not in data:
+                continue
+            for key in ["id", "name"]:
+                if data.get(key):
+                    self.datasets[data[key]] = path
+            for resource in data["resources"]:
+                self.resources[resource["id"]] = path
+
+    def read_dataset(self, dataset_id: str) -> Optional[Dataset]:
+        path = self.datasets.get(dataset_id)
+        if path is None:
+            return None
+        return Dataset.load_from_json(path)
+
+    def read_resource(self, resource_id: str) -> Optional[Resource]:
+        path = self.resources.get(resource_id)
+        if path is None:
+            return None
+        resources = [r for r in Dataset.load_from_json(path).get_resources() if r["id"] == resource_id]
+        return resources[0]
+
+
+class RecordingUpdateClient(PcodeUpdateClient):
+    """Update client that records p_coded values instead of sending them to HDX"""
+
+    def __init__(self) -> None:
+        super().__init__(url="replay", headers=dict(), batch_size=1)
+        self.updates = list()
+        self._updates_lock = Lock()
+
+    def patch(self, resource_id: str, pcode_value: bool) -> None:
+        with self._updates_lock:
+            self.updates.append((resource_id, pcode_value))
+
+
+class RecordingSlackClient(slack.SlackClientWrapper):
+    """Slack client that records the posts instead of sending them"""
+
+    def __init__(self) -> None:
+        self.slack_channel = None
+        self.slack_client = None
+        self.posts = list()
+
+    def post_to_slack_channel(self, message: str, retries: int = 0, backoff: float = 1.0) -> bool:
+        self.posts.append(message)
+        return True
+
+
+def read_events(path: str) -> List[Dict]:
+    with open(path) as f:
+        return [loads(line) for line in f if line.strip()]
+
+
+def dispatch_offsets(events: List[Dict], rate: float = 0, speed: float = 0) -> List[float]:
+    """Seconds after the start of the replay at which each event is dispatched
+
+    Args:
+        events (List[Dict]): recorded events in order
+        rate (float): events per second, 0 to not use a fixed rate
+        speed (float): factor applied to the recorded pace, 0 to not follow the recorded times
+
+    Returns:
+        List[float]: offset of each event, all 0 when neither rate nor speed is given
+    """
+    if rate > 0:
+        return [i / rate for i in range(len(events))]
+    if speed > 0:
+        times = [datetime.fromisoformat(event["event_time"]).timestamp() for event in events]
+        return [max(t - times[0], 0) / speed for t in times]
+    return [0.0] * len(events)
+
+
+def percentile(values: List[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(int(q * len(ordered)), len(ordered) - 1)]
+
+
+def replay(events: List[Dict], event_processor: Callable[[Dict], Tuple[bool, str]], workers: int,
+           offsets: List[float]) -> Tuple[List[Dict], float]:
+    """Dispatch events at their offsets to worker threads running the event processor
+
+    Args:
+        events (List[Dict]): events to replay
+        event_processor (Callable[[Dict], Tuple[bool, str]]): processor of the listener
+        workers (int): number of worker threads, as those of the listener
+        offsets (List[float]): seconds after the start at which each event is dispatched
+
+    Returns:
+        Tuple[List[Dict], float]: outcome and timings of each event, and duration of the replay in seconds
+    """
+    pending = Queue()
+    records = list()
+    lock = Lock()
+
+    def work():
+        while True:
+            item = pending.get()
+            if item is None:
+                return
+            event, dispatched = item
+            started = monotonic()
+            try:
+                success, message = event_processor(event)
+            except Exception as exc:  # raised outside of the processing, such as while setting up the download
+                success, message = False, str(exc)
+            ended = monotonic()
+            with lock:
+                records.append({
+                    "resource_id": event.get("resource_id"),
+                    "success": success,
+                    "message": message,
+                    "wait": started - dispatched,
+                    "latency": ended - dispatched,
+                })
+
+    threads = [Thread(target=work, name=f"PCodeReplay-{i}") for i in range(workers)]
+    for thread in threads:
+        thread.start()
+    start = monotonic()
+    for event, offset in zip(events, offsets):
+        delay = start + offset - monotonic()
+        if delay > 0:
+            sleep(delay)
+        # the event is emitted now, so queue lag and coalescing behave as on the event bus
+        event = {**event, "event_time": datetime.now(timezone.utc).isoformat()}
+        pending.put((event, monotonic()))
+    for _ in threads:
+        pending.put(None)
+    for thread in threads:
+        thread.join()
+    return records, monotonic() - start
+
+
+def summarise(records: List[Dict], seconds: float, rss_before_mb: float) -> Dict:
+    latencies = [r["latency"] for r in records]
+    waits = [r["wait"] for r in records]
+    outcomes = dict()
+    for record in records:
+        outcome = "failure" if not record["success"] else record["message"].lower()
+        outcomes[outcome] = outcomes.get(outcome, 0) + 1
+    peak_rss_mb = getrusage(RUSAGE_SELF).ru_maxrss / 1024
+    return {
+        "events": len(records),
+        "outcomes": outcomes,
+        "seconds": round(seconds, 3),
+        "events_per_second": round(len(records) / seconds, 3) if seconds else 0.0,
+        "latency_p50": round(percentile(latencies, 0.5), 3),
+        "latency_p90": round(percentile(latencies, 0.9), 3),
+        "latency_p99": round(percentile(latencies, 0.99), 3),
+        "latency_max": round(max(latencies, default=0.0), 3),
+        "wait_p50": round(percentile(waits, 0.5), 3),
+        "wait_p99": round(percentile(waits, 0.99), 3),
+        "peak_rss_mb": round(peak_rss_mb, 1),
+        "rss_growth_mb": round(peak_rss_mb - rss_before_mb, 1),
+    }
+
+
+def main(events_path: str, fixtures: str, rate: float = 0, speed: float = 0, workers: Optional[int] = None,
+         pcodes_folder: Optional[str] = None, coalesce_window: Optional[float] = None,
+         output: Optional[str] = None) -> Dict:
+    """Replay recorded events through the event processor of the listener and report how it performed
+
+    Args:
+        events_path (str): JSONL file of events
+        fixtures (str): folder of dataset JSON files and saved resource files
+        rate (float): events per second, 0 for the recorded pace or all at once
+        speed (float): factor applied to the recorded pace
+        workers (Optional[int]): number of worker threads, defaults to those of the listener
+        pcodes_folder (Optional[str]): p-code snapshot folder, defaults to the configured one
+        coalesce_window (Optional[float]): overrides the configured coalescing window
+        output (Optional[str]): JSON file to write the report to
+
+    Returns:
+        Dict: report with the outcomes, rate, latency percentiles and peak RSS, p_coded updates and Slack posts
+    """
+    from check_pcodes import GlobalPcodes
+    from helper.storage import DiskQuota
+    from run import listener_consumers, make_event_processor
+
+    Configuration._create(  # no request is made to HDX
+        hdx_read_only=True,
+        hdx_site="prod",
+        user_agent="PCodesDetectorReplay",
+        project_config_yaml=join("config", "project_configuration.yml"),
+    )
+    configuration = Configuration.read()
+    if isfile(join(fixtures, FORMATS_FILE)):  # otherwise the format mappings are downloaded
+        Resource.read_formats_mappings(configuration, join(fixtures, FORMATS_FILE))
+    if coalesce_window is not None:
+        configuration["coalesce_window"] = coalesce_window
+    workers = workers or listener_consumers(configuration)
+
+    catalogue = FixtureCatalogue(fixtures)
+    events = read_events(events_path)
+    hdx_client = RecordingUpdateClient()
+    slack_client = RecordingSlackClient()
+    live_slack_client, slack.SLACK_CLIENT = slack.SLACK_CLIENT, slack_client
+    notifier = slack.configure_slack_notifier(**configuration["slack"])
+    global_pcodes = GlobalPcodes({
+        **configuration["global_pcodes"],
+        "snapshot_folder": pcodes_folder or configuration["global_pcodes"]["snapshot_folder"],
+        "refresh_interval": 0,
+    })
+    global_pcodes.load()
+
+    with temp_dir(folder=f"PCodeReplay-{get_uuid()}") as folder:
+        configuration["result_cache"] = {**configuration["result_cache"], "path": join(folder, "results.sqlite")}
+
+        @contextmanager
+        def open_retriever():
+            with temp_dir(folder=f"TempPCodeDetector-{get_uuid()}") as temp_folder:
+                with Download(user_agent="PCodesDetectorReplay") as downloader:
+                    yield Retrieve(downloader, temp_folder, fixtures, temp_folder, save=False, use_saved=True)
+
+        event_processor = make_event_processor(
+            configuration, global_pcodes, hdx_client, open_retriever, catalogue.read_dataset, catalogue.read_resource,
+            DiskQuota(configuration["temp_storage"]["quota"]),
+        )
+        rss_before_mb = getrusage(RUSAGE_SELF).ru_maxrss / 1024
+        records, seconds = replay(events, event_processor, workers, dispatch_offsets(events, rate, speed))
+    notifier.stop()
+    slack.SLACK_CLIENT = live_slack_client
+
+    report = summarise(records, seconds, rss_before_mb)
+    report["updates"] = len(hdx_client.updates)
+    report["slack_posts"] = len(slack_client.posts)
+    if output:
+        with open(output, "w") as f:
+            dump(report, f, indent=2)
+    return report
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Replay recorded HDX events through the p-code detector listener")
+    parser.add_argument("events", help="JSONL file of events")
+    parser.add_argument("--fixtures", default=join("tests", "fixtures", "input"), help="folder of datasets and files")
+    parser.add_argument("--rate", type=float, default=0, help="events per second")
+    parser.add_argument("--speed", type=float, default=0, help="factor applied to the recorded pace of the events")
+    parser.add_argument("--workers", type=int, help="number of listener workers")
+    parser.add_argument("--pcodes", help="p-code snapshot folder")
+    parser.add_argument("--coalesce-window", type=float, help="seconds events are held to coalesce bursts")
+    parser.add_argument("--output", help="JSON file to write the report to")
+    args = parser.parse_args()
+    result = main(args.events, args.fixtures, args.rate, args.speed, args.workers, args.pcodes, args.coalesce_window,
+                  args.output)
+    for key, value in result.items():
+        print(f"{key:<18} {value}")
+    sys.exit(0 if "failure" not in result["outcomes"] else 1)
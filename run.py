@@ -1,108 +1,247 @@
 import logging
 import logging.config
+import time
+
+STARTED = time.monotonic()
 
 logging.config.fileConfig("logging.conf")
 
+import argparse
 import datetime
+from contextlib import contextmanager
+from functools import partial
 from json import dumps
 from os import getenv
 from os.path import join
+from threading import Thread
 
-from hdx.api.configuration import Configuration
-from hdx.data.dataset import Dataset
-from hdx.data.resource import Resource
-from hdx.utilities.downloader import Download
-from hdx.utilities.path import temp_dir
-from hdx.utilities.retriever import Retrieve
-from hdx_redis_lib import connect_to_hdx_event_bus_with_env_vars
-
-from check_pcodes import get_global_pcodes, process_resource
-from helper.facade import facade
+from helper.startup import startup_report
 from helper.util import do_nothing_for_ever
 
+# The hdx stack, pandas and GDAL are imported by the modes that use them, so an idle container stays small.
+# The listener and batch modes still load pandas, numpy and the hdx stack with check_pcodes when they start,
+# which every resource needs; only the GDAL and spreadsheet readers wait for the first resource of their format.
+
 logger = logging.getLogger(__name__)
 
 
-def listener_main(**ignore):
+def listener_consumers(configuration):
     """
-    Function to run when p-code detector is run in listener mode. 
-    Basically this waits for 'resource-created' OR 'resource-data-changed' events and runs the p-code checking logic.
+    Number of threads taking events from the event bus. An event is only acknowledged once its resource is processed,
+    so a thread waits for a resource of the slow lane; one more thread per slot of the slow lane keeps listener_workers
+    threads for the other events while the slow lane is busy.
     """
+    from helper.scheduler import SLOW
 
-    # Connect to Redis
-    event_bus = connect_to_hdx_event_bus_with_env_vars()
+    workers = configuration["listener_workers"]
+    if workers <= 1:
+        return workers
+    return workers + configuration["scheduler"]["lanes"][SLOW]
 
-    configuration = Configuration.read()
 
-    with temp_dir(folder="TempPCodeDetector") as temp_folder:
-        with Download(rate_limit={"calls": 1, "period": 0.1}) as downloader:
-            retriever = Retrieve(
-                downloader, temp_folder, "saved_data", temp_folder, save=False, use_saved=False
-            )
-            global_pcodes = get_global_pcodes(
-                configuration["global_pcodes"],
+def make_event_processor(configuration, global_pcodes, hdx_client, open_retriever, read_dataset, read_resource, quota):
+    """
+    Build the function that processes one event of the HDX event bus, returning whether it succeeded and a message.
+    Where retrievers, datasets and resources come from is passed in, so events can also be replayed from local files.
+    """
+    from check_pcodes import check_dataset, process_resource
+    from helper.coalesce import EventCoalescer, SharedDatasets, get_event_timestamp
+    from helper.metrics import get_metrics
+    from helper.result_cache import ResultCache
+    from helper.scheduler import get_lane_scheduler
+
+    result_cache = ResultCache(**configuration["result_cache"])
+    coalescer = EventCoalescer(configuration["coalesce_window"])
+    shared_datasets = SharedDatasets(configuration["shared_dataset_age"])
+    scheduler = get_lane_scheduler(configuration)
+    metrics = get_metrics()
+
+    def process(resource, dataset, gates, start_time):
+        with open_retriever() as retriever:
+            process_resource(
+                resource,
+                dataset,
+                global_pcodes.index,
                 retriever,
+                configuration,
+                update=True,
+                flag=True,
+                result_cache=result_cache,
+                hdx_client=hdx_client,
+                quota=quota,
+                gates=gates,
             )
+        elapsed_time = datetime.datetime.now() - start_time
+        logger.info(f"Finished processing resource {resource['name']}, {resource['id']} in {str(elapsed_time)}")
 
     def event_processor(event):
         start_time = datetime.datetime.now()
-        with temp_dir(folder="TempPCodeDetector") as temp_folder:
-            with Download(rate_limit={"calls": 1, "period": 0.1}) as downloader:
-                retriever = Retrieve(
-                    downloader, temp_folder, "saved_data", temp_folder, save=False, use_saved=False
-                )
+        try:
+            logger.info(f"Received event: {dumps(event, ensure_ascii=False, indent=4)}")
+            arrived = time.monotonic()
+            emitted = get_event_timestamp(event)
+            if emitted is not None:  # time the event waited on the queue before a worker took it
+                lag = time.time() - emitted
+                metrics.observe("queue_lag", lag)
+                metrics.set("queue_lag_seconds", lag)
+                arrived -= max(lag, 0)
+            dataset_id = event.get("dataset_id")
+            resource_id = event.get("resource_id")
+            if dataset_id and resource_id:
+                held = time.monotonic()
+                if not coalescer.claim(event):
+                    logger.info(f"Skipped {coalescer.skipped} of {coalescer.skipped + coalescer.processed} events")
+                    metrics.increment("events", outcome="superseded")
+                    return True, "Superseded"
+                arrived += time.monotonic() - held  # holding a burst is by choice, so it is left out of the latency
+
+                def load_dataset():
+                    dataset = read_dataset(dataset_id)
+                    return dataset, check_dataset(dataset, global_pcodes.index, configuration)
+
+                succeeded = False
                 try:
-                    logger.info(f"Received event: {dumps(event, ensure_ascii=False, indent=4)}")
-                    dataset_id = event.get("dataset_id")
-                    resource_id = event.get("resource_id")
-                    if dataset_id and resource_id:
-                        dataset = Dataset.read_from_hdx(dataset_id)
-                        resource = Resource.read_from_hdx(resource_id)
-                        process_resource(resource, dataset, global_pcodes, retriever, configuration, update=True, flag=True)
-                        end_time = datetime.datetime.now()
-                        elapsed_time = end_time - start_time
-                        logger.info(f"Finished processing resource {resource['name']}, {resource['id']} in {str(elapsed_time)}")
-                    return True, "Success"
-                except Exception as exc:
-                    logger.error(f"Exception of type {type(exc).__name__} while processing dataset {dataset_id}: {str(exc)}")
-                    return False, str(exc)
-
-    event_bus.hdx_listen(event_processor, allowed_event_types=["resource-created", "resource-data-changed"], max_iterations=10_000)
-
-
-def main(**ignore):
+                    # sibling resources of the same publish share one read of the dataset and its gates
+                    dataset, gates = shared_datasets.get(dataset_id, load_dataset, emitted)
+                    resources = [r for r in dataset.get_resources() if r["id"] == resource_id]
+                    resource = resources[0] if resources else read_resource(resource_id)
+                    # large resources wait for a slot of their own lane, small and new ones go ahead of them
+                    lane = scheduler.classify(resource.data, created=event.get("event_type") == "resource-created")
+                    scheduler.run(lane, process, resource, dataset, gates, start_time, arrived=arrived)
+                    succeeded = True
+                finally:  # only a success covers this event and earlier ones
+                    coalescer.finished(event, succeeded)
+            metrics.increment("events", outcome="success")
+            return True, "Success"
+        except Exception as exc:
+            logger.error(f"Exception of type {type(exc).__name__} while processing dataset {dataset_id}: {str(exc)}")
+            metrics.increment("events", outcome="failure")
+            return False, str(exc)
+
+    return event_processor
+
+
+def listener_main(**ignore):
+    """
+    Function to run when p-code detector is run in listener mode. 
+    Basically this waits for 'resource-created' OR 'resource-data-changed' events and runs the p-code checking logic.
+    """
+    from hdx.api.configuration import Configuration
+    from hdx.data.dataset import Dataset
+    from hdx.data.resource import Resource
+    from hdx.utilities.downloader import Download
+    from hdx.utilities.path import temp_dir
+    from hdx.utilities.retriever import Retrieve
+    from hdx.utilities.uuid import get_uuid
+    from hdx_redis_lib import connect_to_hdx_event_bus
+
+    from check_pcodes import GlobalPcodes
+    from helper.ckan import PcodeUpdateClient
+    from helper.isolation import get_isolation_pool
+    from helper.metrics import MetricsWriter
+    from helper.ratelimit import HostRateLimiter
+    from helper.storage import DiskQuota
+    from slack import configure_slack_notifier
+
+    configuration = Configuration.read()
+    configure_slack_notifier(**configuration["slack"])
+
+    global_pcodes = GlobalPcodes(configuration["global_pcodes"])
+    global_pcodes.load()
+    global_pcodes.start()
+
+    rate_limiter = HostRateLimiter(**configuration["rate_limit"])
+    quota = DiskQuota(configuration["temp_storage"]["quota"])
+    metrics_writer = MetricsWriter(
+        configuration["metrics"]["path"].format(process="listener"), configuration["metrics"]["interval"], "events"
+    )
+    metrics_writer.start()
+    # events are only acknowledged once processed, so updates are written straight away and failures raised
+    hdx_client = PcodeUpdateClient(**{**configuration["hdx_updates"], "batch_size": 1})
+
+    @contextmanager
+    def open_retriever():
+        with temp_dir(folder=f"TempPCodeDetector-{get_uuid()}") as temp_folder:
+            with Download(rate_limit=configuration["rate_limit"]) as downloader:
+                rate_limiter.wrap(downloader)
+                yield Retrieve(downloader, temp_folder, "saved_data", temp_folder, save=False, use_saved=False)
+
+    event_processor = make_event_processor(
+        configuration, global_pcodes, hdx_client, open_retriever, Dataset.read_from_hdx, Resource.read_from_hdx, quota
+    )
+
+    def listen(consumer_name):
+        # Connect to Redis. Pending events are tracked per consumer name in the group, so each worker
+        # has a name of its own and an event it took is only acknowledged by it once processed
+        event_bus = connect_to_hdx_event_bus(
+            stream_name=getenv("REDIS_STREAM_STREAM_NAME", "hdx_event_stream"),
+            group_name=getenv("REDIS_STREAM_GROUP_NAME", "default_group"),
+            consumer_name=consumer_name,
+            host=getenv("REDIS_STREAM_HOST", "redis"),
+            port=int(getenv("REDIS_STREAM_PORT", 6379)),
+            db=int(getenv("REDIS_STREAM_DB", 0)),
+        )
+        event_bus.hdx_listen(event_processor, allowed_event_types=["resource-created", "resource-data-changed"], max_iterations=10_000)
+
+    startup_report("listener", STARTED)
+    workers = listener_consumers(configuration)
+    consumer_name = getenv("REDIS_STREAM_CONSUMER_NAME", "default_consumer")
+    try:
+        if workers <= 1:
+            listen(consumer_name)
+        else:
+            threads = [
+                Thread(target=listen, args=(f"{consumer_name}-{i}",), name=f"PCodeListener-{i}") for i in range(workers)
+            ]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+    finally:
+        isolation = get_isolation_pool(configuration["isolation"])
+        if isolation is not None:
+            isolation.close()
+        metrics_writer.stop()
+
+
+def main(shard=None, workers=None, restart=False, update=False, **ignore):
+    from hdx.api.configuration import Configuration
+
+    from check_pcodes import GlobalPcodes
+    from crawl import crawl
+    from slack import configure_slack_notifier
 
     configuration = Configuration.read()
+    notifier = configure_slack_notifier(**configuration["slack"])
 
-    with temp_dir(folder="TempPCodeDetector") as temp_folder:
-        with Download(rate_limit={"calls": 1, "period": 0.1}) as downloader:
-            retriever = Retrieve(
-                downloader, temp_folder, "saved_data", temp_folder, save=False, use_saved=False
-            )
-            global_pcodes = get_global_pcodes(
-                configuration["global_pcodes"],
-                retriever,
-            )
-            datasets = Dataset.get_all_datasets(rows=1000)
-            for dataset in datasets:
-                resources = dataset.get_resources()
-                for resource in resources:
-                    pcoded = process_resource(
-                        resource,
-                        dataset,
-                        global_pcodes,
-                        retriever,
-                        configuration,
-                        cleanup=True,
-                    )
-                    logger.info(f"{dataset['name']}: {resource['name']}: {pcoded}")
+    global_pcodes = GlobalPcodes(configuration["global_pcodes"])
+    global_pcodes.load()
+
+    startup_report("batch", STARTED)
+    try:
+        processed = crawl(global_pcodes.index, configuration, shard=shard, workers=workers, restart=restart, update=update)
+        logger.info(f"Finished crawl of {processed} datasets")
+    finally:  # the queued digest is posted even if the crawl fails
+        notifier.stop()
 
 
 if __name__ == "__main__":
     if getenv("WORKER_ENABLED") != "true" and getenv("LISTENER_MODE") == "true":
+        startup_report("idle", STARTED)
         do_nothing_for_ever()
     else:
-        main_function = listener_main if getenv("LISTENER_MODE") == "true" else main
+        from helper.facade import facade
+
+        parser = argparse.ArgumentParser(description="P-code detector")
+        parser.add_argument("--shard", help="part of the datasets to crawl in batch mode, as i/N")
+        parser.add_argument("--workers", type=int, help="number of worker processes in batch mode")
+        parser.add_argument("--restart", action="store_true", help="ignore the checkpoint of a previous batch crawl")
+        parser.add_argument("--update", action="store_true", help="write changed p_coded values to HDX in batch mode")
+        args = parser.parse_args()
+        if getenv("LISTENER_MODE") == "true":
+            main_function = listener_main
+        else:
+            main_function = partial(main, shard=args.shard, workers=args.workers, restart=args.restart, update=args.update)
         facade(
             main_function,
             # hdx_site="feature", # passing HDX server via the env variable HDX_URL
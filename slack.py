@@ -1,11 +1,21 @@
+import atexit
 import os
 import logging
+import queue
+import random
+import threading
+import time
+import weakref
+from collections import Counter
+from typing import Optional
+
 import slack_sdk
 import slack_sdk.errors as slack_errors
 
 logger = logging.getLogger(__name__)
 
 SLACK_CLIENT: "SlackClientWrapper" = None
+SLACK_NOTIFIER: "SlackNotifier" = None
 
 
 class SlackClientWrapper():
@@ -20,21 +30,137 @@ class SlackClientWrapper():
             self.slack_client = slack_sdk.WebClient(token=token)
             logger.debug('Slack client initialized')
 
-    def post_to_slack_channel(self, message: str):
+    def post_to_slack_channel(self, message: str, retries: int = 0, backoff: float = 1.0) -> bool:
         if self.slack_client:
-            try:
-                text = f'[PCode BOT] {message}'
-                response = self.slack_client.chat_postMessage(channel=self.slack_channel, text=text)
-            except slack_errors.SlackApiError as e:
-                # You will get a SlackApiError if "ok" is False
-                # assert e.response["ok"] is False
-                logger.error(f"Got an error: {e.response['error']}")
+            text = f'[PCode BOT] {message}'
+            for attempt in range(retries + 1):
+                try:
+                    self.slack_client.chat_postMessage(channel=self.slack_channel, text=text)
+                    return True
+                except slack_errors.SlackApiError as e:
+                    # You will get a SlackApiError if "ok" is False
+                    # assert e.response["ok"] is False
+                    logger.error(f"Got an error: {e.response['error']}")
+                    if attempt == retries:
+                        break
+                    if e.response.status_code == 429:  # rate limited, Slack says how long to wait
+                        delay = float(e.response.headers.get('Retry-After', backoff))
+                    else:
+                        delay = backoff * 2 ** attempt
+                    time.sleep(delay)
+            return False
         else:
             logger.info(f'[instead of slack] {message}')
+            return True
 
 
 def get_slack_client():
     global SLACK_CLIENT
     if not SLACK_CLIENT:
         SLACK_CLIENT = SlackClientWrapper()
-    return SLACK_CLIENT
\ No newline at end of file
+    return SLACK_CLIENT
+
+
+class SlackNotifier:
+    """Collects messages on a bounded queue and posts them from a background thread as periodic digests.
+
+    notify never blocks: when the queue is full the message is dropped and only counted. Every
+    interval seconds the messages received are summarised in one Slack post with their counts,
+    the most frequent errors and a random sample of the messages. Posting retries with backoff,
+    waiting as long as Slack asks when rate limited. Pending messages are flushed on shutdown.
+    A forked process starts with an empty queue, as the messages queued before the fork are
+    posted by the parent.
+    """
+
+    def __init__(self, interval: float = 60, max_queue: int = 10000, samples: int = 5, top_errors: int = 5,
+                 retries: int = 5) -> None:
+        self.interval = interval
+        self.samples = samples
+        self.top_errors = top_errors
+        self.retries = retries
+        self.max_queue = max_queue
+        self._reset()
+        notifier = weakref.ref(self)
+        os.register_at_fork(after_in_child=lambda: notifier() and notifier()._reset())
+
+    def _reset(self) -> None:
+        # also run in a forked child, which must not post the parent's messages or use its locks
+        self.dropped = 0
+        self._queue = queue.Queue(maxsize=self.max_queue)
+        self._stop = threading.Event()
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def notify(self, message: str, error: Optional[str] = None) -> None:
+        self._start()
+        try:
+            self._queue.put_nowait((message, error))
+        except queue.Full:
+            with self._lock:
+                self.dropped += 1
+
+    def _start(self) -> None:
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            # not started yet in this process
+            self._pid = os.getpid()
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='SlackNotifier', daemon=True)
+            self._thread.start()
+        atexit.register(self.stop)
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            self.flush()
+        self.flush()
+
+    def flush(self) -> None:
+        messages = []
+        while True:
+            try:
+                messages.append(self._queue.get_nowait())
+            except queue.Empty:
+                break
+        with self._lock:
+            dropped, self.dropped = self.dropped, 0
+        if not messages and not dropped:
+            return
+        get_slack_client().post_to_slack_channel(self.digest(messages, dropped), retries=self.retries)
+
+    def digest(self, messages: list, dropped: int = 0) -> str:
+        errors = Counter([error for _, error in messages if error])
+        lines = [f'{len(messages)} messages, {sum(errors.values())} errors']
+        if dropped:
+            lines[0] += f', {dropped} messages dropped because the queue was full'
+        if errors:
+            lines.append('Top errors:')
+            lines.extend([f'  {count} x {error}' for error, count in errors.most_common(self.top_errors)])
+        if len(messages) <= self.samples:
+            sample = messages
+        else:
+            sample = random.sample(messages, self.samples)
+            lines.append(f'Sample of {self.samples} messages:')
+        lines.extend([f'  {message}' for message, _ in sample])
+        return '\n'.join(lines)
+
+    def stop(self) -> None:
+        if self._thread is not None and self._pid == os.getpid():
+            self._stop.set()
+            self._thread.join()
+            self._thread = None
+            self._pid = None
+
+
+def configure_slack_notifier(**settings) -> "SlackNotifier":
+    global SLACK_NOTIFIER
+    SLACK_NOTIFIER = SlackNotifier(**settings)
+    return SLACK_NOTIFIER
+
+
+def get_slack_notifier() -> "SlackNotifier":
+    global SLACK_NOTIFIER
+    if not SLACK_NOTIFIER:
+        SLACK_NOTIFIER = SlackNotifier()
+    return SLACK_NOTIFIER
@@ -1,16 +1,65 @@
-from json import load
-from os.path import join
+import gzip
+import os
+import subprocess
+import sys
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+from functools import partial
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from glob import glob
+from json import dumps, load, loads
+from os.path import exists, getsize, join
+from threading import Event, Thread
+from zipfile import ZIP_DEFLATED, ZipFile
+from time import monotonic, sleep
 
 import pytest
+from openpyxl import Workbook as OpenpyxlWorkbook
+from pandas import DataFrame, ExcelFile
+from xlrd import open_workbook
 from hdx.api.configuration import Configuration
 from hdx.api.locations import Locations
 from hdx.data.dataset import Dataset
+from hdx.data.resource import Resource
 from hdx.utilities.downloader import Download
 from hdx.utilities.path import temp_dir
 from hdx.utilities.retriever import Retrieve
 from hdx.utilities.useragent import UserAgent
 
-from check_pcodes import get_global_pcodes, process_resource
+from check_pcodes import (
+    HEADER_ROWS,
+    check_dataset,
+    check_pcoded,
+    column_match_counts,
+    download_resource,
+    get_global_pcodes,
+    match_incrementally,
+    is_pcode_header,
+    parse_tabular,
+    pcode_header_positions,
+    process_resource,
+    read_attributes,
+    read_csv_contents,
+    read_tabular,
+    read_csv_text,
+    stream_csv_text,
+)
+import crawl as crawl_module
+from crawl import CrawlCheckpoint, catalogue_filter, crawl, in_shard, parse_shard, split_dataset
+from helper.archives import select_members
+from helper.ckan import PcodeUpdateClient
+from helper.metrics import Metrics, count, get_metrics, set_format, timed, trace_resource
+from helper.isolation import IsolationPool, MemoryLimitExceeded, WorkerDied, get_shared
+from helper.coalesce import EventCoalescer, SharedDatasets
+from helper.pcodes import PcodeIndex, PcodeSnapshot
+from helper.ratelimit import HostRateLimiter
+from helper.result_cache import ResultCache
+from helper.scheduler import FAST, SLOW, LaneScheduler
+from helper.spreadsheets import Workbook, xls_visibility
+from helper.storage import DiskQuota, SizeLimitExceeded, Workspace
+from replay import dispatch_offsets, main as replay_main
+from slack import SlackNotifier
+from helper.streaming import StreamedText
 
 
 class TestCheckPcodes:
@@ -55,7 +104,752 @@ class TestCheckPcodes:
                     retriever,
                     locations=["AFG", "COL"],
                 )
-                assert global_pcodes == load(open(join(fixtures, "afg_col_pcodes.txt")))
+                assert global_pcodes.to_dict() == load(open(join(fixtures, "afg_col_pcodes.txt")))
+
+    def test_pcode_index(self):
+        global_pcodes = PcodeIndex({"WORLD": ["AF01", "AF0101", "CO05"], "AFG": ["AF01", "AF0101"], "COL": ["CO05"]})
+        assert len(global_pcodes) == 3
+        assert global_pcodes["AFG"] == frozenset(["AF01", "AF0101"])
+        assert global_pcodes.countries("CO05") == ("COL",)
+        assert global_pcodes.countries("XX01") == tuple()
+        pcodes = global_pcodes.lookup(["COL", "AFG", "YEM"])
+        assert list(pcodes) == ["AF01", "AF0101", "CO05"]
+        assert global_pcodes.lookup(["AFG", "COL"]) is pcodes
+        assert len(global_pcodes.lookup(["YEM"])) == 0
+
+        df = DataFrame({"adm1_pcode": ["af01", "AF0101", None, "CO05"], "name": ["a", "b", "c", "d"]})
+        assert check_pcoded(df, pcodes, 0.9)
+        assert not check_pcoded(df, global_pcodes.lookup(["AFG"]), 0.9)
+
+    def test_match_incrementally(self):
+        pcodes = PcodeIndex({"AFG": [f"AF{i:02d}" for i in range(1, 35)]}).lookup(["AFG"])
+        requested = []
+
+        def read_contents(values, nrows):
+            requested.append(nrows)
+            return {"table": DataFrame({"adm1_pcode": values[:nrows]})}, None
+
+        pcoded = [f"AF{i % 34 + 1:02d}" for i in range(1000)]
+        match = match_incrementally(partial(read_contents, pcoded), pcodes, 0.9, 20, 1000, 0.99)
+        assert match.column == "adm1_pcode"
+        assert requested == [20, 80]
+        requested.clear()
+        match = match_incrementally(partial(read_contents, ["XX01"] * 1000), pcodes, 0.9, 20, 1000, 0.99)
+        assert match.column is None
+        assert requested == [20]
+        requested.clear()
+        borderline = ["XX01" if i % 10 == 0 else pcoded[i] for i in range(1000)]
+        with trace_resource("borderline") as trace:
+            match = match_incrementally(partial(read_contents, borderline), pcodes, 0.9, 20, 1000, 0.99)
+        assert match.column == "adm1_pcode"
+        assert requested == [20, 80, 320, 1000]
+        assert trace.counts["rows_parsed"] == 1000
+        requested.clear()
+        match = match_incrementally(partial(read_contents, borderline[:50]), pcodes, 0.9, 20, 1000, 0.99)
+        assert requested == [20, 80, 320]  # stops once a read brings no new rows
+
+    def test_column_match_counts(self):
+        rows = [("AFG", "AF01", "1"), ("AFG", "AF02", "1"), ("AFG", "AF0101", "2"), ("AFG", "AF0201", "2"), ("COL", "CO05", "")]
+        global_pcodes = PcodeIndex.from_rows(rows)
+        assert global_pcodes.level("AF0101") == 2
+        assert global_pcodes.level("CO05") is None
+        pcodes = global_pcodes.lookup(["AFG", "COL"])
+        levels = global_pcodes.lookup_levels(["AFG", "COL"])
+        assert dict(zip(pcodes, levels.tolist())) == {"AF01": 1, "AF0101": 2, "AF02": 1, "AF0201": 2, "CO05": -1}
+        assert PcodeIndex.from_rows(rows[:2]).lookup_levels(["AFG"]) is not None
+        assert PcodeIndex.from_rows([r[:2] for r in rows]).lookup_levels(["AFG"]) is None
+
+        df = DataFrame({
+            "adm1_pcode": ["af01", "AF02", "AF01", None],
+            "name": ["a", "b", "c", "d"],
+            "adm2_pcode": ["AF0101", "AF0201", "XX01", "NULL"],
+            "adm3_pcode": [None, "", "nan", None],
+            "admin_pcode": ["CO05", "AF0101", "AF02", "AF0201"],
+        })
+        counts = column_match_counts(df, pcodes, levels)
+        assert list(counts) == ["adm1_pcode", "adm2_pcode", "admin_pcode"]
+        assert counts["adm1_pcode"] == (3, 3, 1)
+        assert counts["adm2_pcode"] == (2, 3, 2)
+        assert counts["admin_pcode"] == (4, 4, 2)
+        assert column_match_counts(df, pcodes)["adm2_pcode"] == (2, 3, None)
+        assert column_match_counts(df.iloc[:0], pcodes, levels) == {}
+
+        def read_contents(nrows):
+            return {"table": df}, None
+
+        match = match_incrementally(read_contents, pcodes, 0.9, 20, 20, 0, levels)
+        assert (match.column, match.level) == ("adm1_pcode", 1)
+        assert match.ratios == {"adm1_pcode": 1.0, "adm2_pcode": 0.6667, "admin_pcode": 1.0}
+
+    def test_stream_csv(self, configuration):
+        rows = "\n".join(["adm1_pcode,value"] + [f"AF{i:02d},{i}" for i in range(1, 35)] * 100) + "\n"
+        with temp_dir(folder="TestPcodeStream") as folder:
+            with Download() as downloader:
+                retriever = Retrieve(downloader, folder, folder, folder, False, False)
+                for file_name, opener in [("pcodes.csv", open), ("pcodes.csv.gz", gzip.open)]:
+                    path = join(folder, file_name)
+                    with opener(path, "wt") as f:
+                        f.write(rows)
+                    text, error = stream_csv_text(path, retriever, 200)
+                    assert error is None
+                    contents, error = read_csv_text(text, 200)
+                    assert error is None
+                    df = list(contents.values())[0]
+                    assert list(df.columns) == ["adm1_pcode"]
+                    assert len(df) == 200
+                path = join(folder, "pcodes.csv")
+                with StreamedText(downloader, path, chunk_size=1024) as stream:
+                    stream.read_lines(201)
+                    assert not stream.exhausted
+                    assert stream.bytes_read < getsize(path)
+
+    def test_pcode_header_positions(self):
+        headers = ["name", "ADM1_PCODE", "P-Code", "value||#adm1+code", "#adm 2", "x||# ADM", "x#adm", "Unnamed: 3", ""]
+        assert pcode_header_positions(headers) == [1, 2, 3, 4, 5]
+        assert pcode_header_positions(headers) == [i for i, h in enumerate(headers) if is_pcode_header(h)]
+        assert pcode_header_positions([]) == []
+
+    def test_read_tabular(self):
+        header = ",".join(["adm2_pcode"] + [f"indicator_{i}" for i in range(50)])
+        hxl = ",".join(["#adm2+code"] + [f"#indicator+num+i{i}" for i in range(50)])
+        data = "\n".join([",".join([f"AF01{i:02d}"] + [str(i)] * 50) for i in range(1, 300)])
+        contents = f"{header}\n{hxl}\n{data}\n".encode()
+        read_frame = partial(read_csv_contents, contents)
+        df = read_tabular(read_frame, "csv", 200)
+        assert list(df.columns) == ["adm2_pcode||#adm2+code"]
+        assert len(df) == 199
+        assert df.equals(parse_tabular(read_frame(nrows=200), "csv")[["adm2_pcode||#adm2+code"]])
+        assert read_tabular(partial(read_csv_contents, data.encode()), "csv", 200).empty
+
+    def test_read_tabular_blank_top(self, input_folder):
+        # a p-code column that is blank in the rows the header is worked out from is still matched
+        expected = ExcelFile(join(input_folder, "download-afg-adminboundaries-tabulardata.xlsx")).parse("ADM2")
+        pcodes = PcodeIndex({"AFG": expected["ADM2_PCODE"]}).lookup(["AFG"])
+        expected = expected[["ADM2_EN", "ADM2_PCODE", "AREA_SQKM"]]
+        expected.loc[: HEADER_ROWS + 4, "ADM2_PCODE"] = None
+        with temp_dir(folder="TestReadTabular") as folder:
+            path = join(folder, "blank.xlsx")
+            expected.to_excel(path, index=False)
+            with Workbook(path) as workbook:
+                read_frame = partial(workbook.parse, "Sheet1")
+                df = read_tabular(read_frame, "xlsx", 200)
+                counts = column_match_counts(parse_tabular(read_frame(nrows=200), "xlsx"), pcodes)
+            assert counts["ADM2_PCODE"].matches > 0
+            assert column_match_counts(df, pcodes) == counts
+            contents = expected.to_csv(index=False).encode()
+            df = read_tabular(partial(read_csv_contents, contents), "csv", 200)
+            assert column_match_counts(df, pcodes) == column_match_counts(
+                parse_tabular(read_csv_contents(contents, 200), "csv"), pcodes
+            )
+            assert list(df.columns) == ["ADM2_PCODE"]
+
+    def test_workbook(self, input_folder):
+        path = join(input_folder, "download-afg-adminboundaries-tabulardata.xlsx")
+        with ExcelFile(path) as expected, Workbook(path) as workbook:
+            assert workbook.sheet_names == expected.sheet_names
+            for sheet_name in workbook.sheet_names:
+                for nrows in [20, 200]:
+                    assert workbook.parse(sheet_name, nrows=nrows).equals(expected.parse(sheet_name, nrows=nrows))
+                assert workbook.parse(sheet_name, nrows=20, usecols=[1]).equals(
+                    expected.parse(sheet_name, nrows=20, usecols=[1])
+                )
+        with temp_dir(folder="TestWorkbook") as folder:
+            path = join(folder, "hidden.xlsx")
+            book = OpenpyxlWorkbook()
+            book.active.append(["adm1_pcode", "date"])
+            book.active.append(["AF01", datetime(2023, 1, 1)])
+            book.create_sheet("hidden").sheet_state = "hidden"
+            book.save(path)
+            with Workbook(path) as workbook:
+                assert workbook.sheet_names == ["Sheet"]
+                df = workbook.parse("Sheet", nrows=10)
+                assert df.to_dict("records") == [{"adm1_pcode": "AF01", "date": datetime(2023, 1, 1)}]
+            # strict OOXML uses another namespace for the relationship ids of the sheets
+            strict_path = join(folder, "strict.xlsx")
+            with ZipFile(path) as source, ZipFile(strict_path, "w") as target:
+                for item in source.infolist():
+                    data = source.read(item.filename)
+                    if item.filename == "xl/workbook.xml":
+                        data = data.replace(
+                            b"http://schemas.openxmlformats.org/officeDocument/2006/relationships",
+                            b"http://purl.oclc.org/ooxml/officeDocument/relationships",
+                        )
+                    target.writestr(item, data)
+            with Workbook(strict_path) as workbook:
+                assert workbook.sheet_names == ["Sheet"]
+                assert workbook.parse("Sheet", nrows=10).equals(df)
+
+    def test_workbook_xls(self):
+        xlwt = pytest.importorskip("xlwt")
+        with temp_dir(folder="TestWorkbookXls") as folder:
+            path = join(folder, "sheets.xls")
+            book = xlwt.Workbook()
+            sheet = book.add_sheet("Sheet")
+            for column, value in enumerate(["adm1_pcode", "value"]):
+                sheet.write(0, column, value)
+            sheet.write(1, 0, "AF01")
+            sheet.write(1, 1, 1)
+            book.add_sheet("hidden").visibility = 1
+            book.add_sheet("empty")
+            book.save(path)
+            with Workbook(path) as workbook:
+                assert workbook.sheet_names == ["Sheet", "empty"]
+                xls = workbook._excel.book
+                assert not any([xls.sheet_loaded(name) for name in xls.sheet_names()])
+                assert workbook.parse("Sheet", nrows=10).to_dict("records") == [{"adm1_pcode": "AF01", "value": 1}]
+                assert workbook.parse("empty", nrows=10).empty
+            book = open_workbook(path, on_demand=True)
+
+            class PublicBook:  # the book as a version of xlrd without the private visibility list shows it
+                nsheets = book.nsheets
+                sheet_by_index = book.sheet_by_index
+                unload_sheet = book.unload_sheet
+
+            assert xls_visibility(PublicBook()) == [0, 1, 0]
+            assert not any([book.sheet_loaded(name) for name in book.sheet_names()])
+            book.release_resources()
+
+    def test_read_attributes(self, input_folder):
+        df = read_attributes(join(input_folder, "download-geoboundaries-afg-adm1-simplified.geojson"), 5)
+        assert list(df.columns) == ["PCode"]
+        assert len(df) == 5
+        df = read_attributes(join(input_folder, "download-geoboundaries-afg-adm1-simplified.geojson"), 5, header_filter=False)
+        assert "geometry" not in df.columns
+        assert "shapeName" in df.columns
+
+    def test_select_members(self):
+        names = [
+            "admin/", "admin/afg_adm1.shp", "admin/afg_adm1.dbf", "admin/afg_adm1.shx", "admin/afg_adm1.shp.xml",
+            "admin/afg_adm1.prj", "admin/afg.gdb/a00000001.gdbtable", "admin/afg.gdb/gdb", "raster.tif",
+            "report.pdf", "__MACOSX/admin/._afg_adm1.shp",
+        ]
+        assert select_members(names, "shp") == [
+            "admin/afg_adm1.shp", "admin/afg_adm1.dbf", "admin/afg_adm1.shx", "admin/afg_adm1.prj",
+        ]
+        assert select_members(names, "gdb") == ["admin/afg.gdb/a00000001.gdbtable", "admin/afg.gdb/gdb"]
+        assert select_members(names, "gpkg") == []
+
+    def test_host_rate_limiter(self):
+        rate_limiter = HostRateLimiter(calls=1, period=0.05)
+        start_time = monotonic()
+        threads = [Thread(target=rate_limiter.wait, args=("https://data.humdata.org/dataset/a",)) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        rate_limiter.wait("https://example.org/other-host")
+        assert 0.15 <= monotonic() - start_time < 0.5
+
+    def test_event_coalescer(self):
+        coalescer = EventCoalescer(window=0.2)
+        now = datetime.now(timezone.utc)
+
+        def event(resource_id, seconds):
+            return {"resource_id": resource_id, "event_time": (now + timedelta(seconds=seconds)).isoformat()}
+
+        start_time = monotonic()
+        assert coalescer.claim(event("a", 0))  # the first event of a resource is not held
+        assert monotonic() - start_time < 0.1
+        coalescer.finished(event("a", 0), succeeded=False)
+        assert coalescer.claim(event("a", 0))  # redelivered as its processing failed
+        coalescer.finished(event("a", 0))
+        assert not coalescer.claim(event("a", -5))  # covered by the event processed
+        assert coalescer.claim({"resource_id": "a"})
+        coalescer.finished({"resource_id": "a"})
+        future = {"resource_id": "b", "event_time": (now + timedelta(hours=1)).replace(tzinfo=None).isoformat()}
+        start_time = monotonic()
+        assert coalescer.claim(future)  # not held whatever the clock of the event bus
+        assert monotonic() - start_time < 0.1
+        coalescer.finished(future)
+        assert (coalescer.processed, coalescer.skipped) == (4, 1)
+
+        claimed = dict()
+
+        def claim(seconds):
+            claimed[seconds] = coalescer.claim(event("c", seconds))
+
+        assert coalescer.claim(event("c", 1))
+        threads = [Thread(target=claim, args=(seconds,)) for seconds in (2, 3)]
+        for thread in threads:
+            thread.start()
+            sleep(0.05)
+        sleep(0.3)
+        assert claimed == {2: False}  # the rest of the burst arrived while it was held
+        coalescer.finished(event("c", 1))  # the last event of the burst waited for the first
+        for thread in threads:
+            thread.join()
+        assert claimed == {2: False, 3: True}
+
+    def test_check_dataset(self, configuration):
+        global_pcodes = PcodeIndex({"AFG": ["AF01", "AF0101"]})
+        data = {"name": "test", "archived": False, "groups": [{"name": "afg"}], "organization": {"name": "unocha"}}
+        gates = check_dataset(Dataset(data), global_pcodes, configuration)
+        assert gates.eligible and gates.result is None
+        assert sorted(gates.pcodes) == ["AF01", "AF0101"]
+        gates = check_dataset(Dataset({**data, "archived": True}), global_pcodes, configuration)
+        assert not gates.eligible and gates.result is None and gates.reason == "archived"
+        gates = check_dataset(Dataset({**data, "groups": [{"name": "col"}]}), global_pcodes, configuration)
+        assert not gates.eligible and gates.result is None
+        gates = check_dataset(Dataset({**data, "organization": {"name": "hot"}}), global_pcodes, configuration)
+        assert not gates.eligible and gates.result is False
+
+    def test_shared_datasets(self):
+        shared = SharedDatasets(max_age=60)
+        loads = []
+
+        def load():
+            loads.append(1)
+            return len(loads)
+
+        emitted = datetime.now(timezone.utc).timestamp() - 1
+        assert shared.get("a", load, emitted) == 1
+        assert shared.get("a", load, emitted) == 1  # sibling event of the same publish
+        assert shared.get("a", load, emitted + 3600) == 2  # emitted after the load
+        assert shared.get("a", load) == 3  # time of the event unknown
+        assert shared.get("b", load, emitted) == 4
+        assert (shared.loads, shared.reuses) == (4, 1)
+
+    def test_result_cache(self):
+        resource = {"url": "https://example.org/a.csv", "last_modified": "2023-08-17T18:53:44", "hash": "", "size": 10}
+        with temp_dir(folder="TestPcodeResultCache") as folder:
+            result_cache = ResultCache(join(folder, "results.sqlite"), max_entries=2)
+            key = result_cache.metadata_key(resource)
+            assert result_cache.metadata_key({"url": "https://example.org/a.csv", "size": 10}) is None
+            assert result_cache.get(key, "1") is None
+            result_cache.put([key, "content:abc", None], "1", True, "adm1_pcode", 0.5)
+            assert result_cache.get(key, "1") == (True, "adm1_pcode")
+            assert result_cache.get("content:abc", "1") == (True, "adm1_pcode")
+            result_cache.put(["content:def"], "1", False, None, 0.1)
+            result_cache.evict()  # the least recently used entry goes
+            assert result_cache.get(key, "1") is None
+            assert result_cache.get("content:def", "1") == (False, None)
+            assert result_cache.get("content:def", "2") is None  # a new version invalidates older entries
+            assert result_cache.get("content:abc", "1") is None
+            result_cache.close()
+
+    def test_pcode_snapshot(self):
+        rows = [("AFG", "AF01"), ("AFG", "AF0101"), ("COL", "CO05")]
+        with temp_dir(folder="TestPcodeSnapshot") as folder:
+            snapshot = PcodeSnapshot(join(folder, "global_pcodes"))
+            assert snapshot.version() is None
+            assert snapshot.load() is None
+            snapshot.save("1|2023-06-21|", rows)
+            snapshot.save("2|2023-06-22|", rows[:2])
+            assert snapshot.version() == "2|2023-06-22|"
+            global_pcodes = snapshot.load()
+            assert global_pcodes.to_dict() == {"WORLD": ["AF01", "AF0101"], "AFG": ["AF01", "AF0101"]}
+            assert len(glob(join(folder, "global_pcodes", "*.npy"))) == 1
+            snapshot.save("3|2023-06-23|", [("AFG", "AF01", "1"), ("AFG", "AF0101", "2"), ("COL", "CO05", None)])
+            global_pcodes = snapshot.load()
+            assert global_pcodes.level("AF0101") == 2
+            assert global_pcodes.level("CO05") is None
+            assert global_pcodes.lookup_levels(["AFG", "COL"]).tolist() == [1, 2, -1]
+            assert global_pcodes.countries("CO05") == ("COL",)
+            assert snapshot.load(["COL"]).to_dict() == {"COL": ["CO05"], "WORLD": ["CO05"]}
+            with_levels = PcodeSnapshot(join(folder, "global_pcodes"), "Admin Level")
+            assert with_levels.version() is None  # saved without the level column configured
+            assert with_levels.load() is None
+
+    def test_result_cache_locations(self, configuration, input_folder):
+        Resource.read_formats_mappings(configuration, join(input_folder, "resource_formats.json"))
+        global_pcodes = PcodeIndex.from_rows([("AFG", f"AF{i:02d}") for i in range(1, 35)] + [("COL", "CO05")])
+        rows = "\n".join(["adm1_pcode,value"] + [f"AF{i:02d},{i}" for i in range(1, 35)]) + "\n"
+        results = []
+        with temp_dir(folder="TestPcodeCacheLocations") as folder:
+            with open(join(folder, "pcodes.csv"), "w") as f:
+                f.write(rows)
+            result_cache = ResultCache(join(folder, "results.sqlite"))
+            with Download(user_agent="test") as downloader:
+                retriever = Retrieve(downloader, folder, folder, folder, save=False, use_saved=True)
+                # the same file mirrored in datasets of different countries
+                for name, group in [("afg", "afg"), ("col", "col"), ("afg-mirror", "afg")]:
+                    dataset = Dataset({
+                        "name": name, "archived": False, "groups": [{"name": group}], "organization": {"name": "unocha"}
+                    })
+                    resource = Resource({
+                        "id": name, "name": "pcodes.csv", "format": "CSV", "url": "https://example.org/pcodes.csv",
+                        "size": len(rows), "resource_type": "file.upload", "last_modified": "2024-01-01T00:00:00",
+                    })
+                    results.append(
+                        process_resource(resource, dataset, global_pcodes, retriever, configuration, result_cache=result_cache)
+                    )
+            assert result_cache.hits == 1
+            result_cache.close()
+        assert results == [True, False, True]
+
+    def test_catalogue_filter(self, configuration):
+        fq = catalogue_filter(configuration, ["WORLD", "COL", "AFG"])
+        assert fq.startswith("-archived:true AND -organization:(hot) AND groups:(afg OR col OR world) AND res_format:(")
+        assert '"XLSX"' in fq
+
+    def test_crawl_shards(self):
+        assert parse_shard(None) == (0, 1)
+        assert parse_shard("2/4") == (2, 4)
+        with pytest.raises(ValueError):
+            parse_shard("4/4")
+        dataset_ids = [f"dataset-{i}" for i in range(100)]
+        shards = [[d for d in dataset_ids if in_shard(d, i, 4)] for i in range(4)]
+        assert sorted(sum(shards, [])) == sorted(dataset_ids)
+        assert all(shards)
+        with temp_dir(folder="TestCrawlCheckpoint") as folder:
+            checkpoint = CrawlCheckpoint(join(folder, "state", "checkpoint.json"), "groups:(afg)")
+            assert checkpoint.load() == 0
+            checkpoint.save(2000)
+            assert CrawlCheckpoint(checkpoint.path, "groups:(afg)").load() == 2000
+            assert CrawlCheckpoint(checkpoint.path, "groups:(afg OR col)").load() == 0
+            checkpoint.clear()
+            assert checkpoint.load() == 0
+
+    def test_crawl_pipeline(self, configuration, input_folder, monkeypatch):
+        Resource.read_formats_mappings(configuration, join(input_folder, "resource_formats.json"))
+        pages = [
+            (i, [Dataset({
+                "id": f"d{i}", "name": f"d{i}", "archived": False, "groups": [{"name": "afg"}],
+                "organization": {"name": "test"}, "resources": [
+                    {"id": f"r{i}a", "name": "a", "format": "CSV", "size": 10, "url": "https://test.org/a.csv"},
+                    {"id": f"r{i}b", "name": "b", "format": "Geodatabase", "size": 10, "url": "https://test.org/b.zip"},
+                ],
+            })])
+            for i in range(3)
+        ]
+        pages[2] = (3, pages[2][1])
+        pages[1][1].append(Dataset({  # the gates are evaluated before the dataset is sent to a lane
+            "id": "x", "name": "x", "archived": False, "groups": [{"name": "yem"}], "organization": {"name": "test"},
+            "resources": [{"id": "rx", "name": "x", "format": "CSV", "size": 10, "url": "https://test.org/x.csv"}],
+        }))
+        monkeypatch.setattr("crawl.iter_dataset_pages", lambda page_size, start, **kwargs: iter(pages))
+        monkeypatch.setattr("crawl.init_worker", lambda pcodes, update: None)
+        monkeypatch.setitem(crawl_module._worker, "hdx_client", None)
+        release = Event()
+        done = []
+
+        def process(dataset_data, locations):
+            assert locations == ("AFG",)
+            if dataset_data["name"] == "d0" and dataset_data["resources"][0]["name"] == "b":
+                release.wait(5)
+            done.append((dataset_data["name"], dataset_data["resources"][0]["name"]))
+            return [(dataset_data["name"], resource["name"], True) for resource in dataset_data["resources"]]
+
+        monkeypatch.setattr("crawl.process_dataset_resources", process)
+        executor = ThreadPoolExecutor(4)
+        monkeypatch.setattr("crawl.run_now", executor.submit)  # the lanes run alongside the crawl as in workers
+        saved = []
+        monkeypatch.setattr(CrawlCheckpoint, "save", lambda self, start: saved.append((start, list(done))))
+        monkeypatch.setattr(CrawlCheckpoint, "load", lambda self: 0)
+        monkeypatch.setattr(CrawlCheckpoint, "clear", lambda self: None)
+        Thread(target=lambda: sleep(0.3) or release.set()).start()
+        assert crawl(PcodeIndex({"AFG": ["AF01"]}), configuration, workers=1) == 4
+        executor.shutdown()
+        # the small resources of later pages went ahead of the large one of the first page
+        assert done[-1] == ("d0", "b")
+        assert set(done[:-1]) == {("d0", "a"), ("d1", "a"), ("d1", "b"), ("d2", "a"), ("d2", "b")}
+        # and no page was checkpointed before the first page was complete
+        assert [start for start, _ in saved] == [1, 3, 4]
+        assert ("d0", "b") in saved[0][1]
+
+    def test_lane_scheduler(self):
+        scheduler = LaneScheduler({FAST: 2, SLOW: 1}, 1000, ["csv", "xlsx"], latency_budget=0.5)
+        assert scheduler.classify({"format": "CSV", "size": 500}) == FAST
+        assert scheduler.classify({"format": "CSV", "size": 5000}) == SLOW
+        assert scheduler.classify({"format": "CSV", "size": None}) == SLOW
+        assert scheduler.classify({"format": "Geopackage", "size": 500}) == SLOW
+        assert scheduler.classify({"format": "Geopackage", "size": 500}, created=True) == FAST
+        assert scheduler.classify({"format": "CSV", "size": 5000}, created=True) == SLOW
+        dataset_data = {
+            "name": "test",
+            "resources": [
+                {"id": "a", "format": "CSV", "size": 10},
+                {"id": "b", "format": "Geodatabase", "size": 10},
+                {"id": "c", "format": "XLSX", "size": 20},
+            ],
+        }
+        lanes = split_dataset(dataset_data, scheduler)
+        assert [r["id"] for r in lanes[FAST]["resources"]] == ["a", "c"]
+        assert [r["id"] for r in lanes[SLOW]["resources"]] == ["b"]
+        assert lanes[SLOW]["name"] == "test"
+        assert scheduler.run(FAST, max, 1, 2) == 2
+        exceeded = get_metrics().counter("latency_budget_exceeded")
+        assert scheduler.run(FAST, sum, [1, 2], arrived=monotonic() - 1) == 3
+        assert get_metrics().counter("latency_budget_exceeded") == exceeded + 1
+
+    def test_slack_notifier(self, monkeypatch):
+        posted = []
+        monkeypatch.setattr("slack.get_slack_client", lambda: type("Client", (), {
+            "post_to_slack_channel": lambda self, message, retries=0: posted.append(message),
+        })())
+        notifier = SlackNotifier(interval=3600, max_queue=4, samples=2, top_errors=1)
+        notifier.notify("ok")
+        for i in range(4):
+            notifier.notify(f"failed {i}", "Unable to read resource")
+        notifier.notify("dropped", "Could not update resource")
+        assert notifier.dropped == 2
+        notifier.stop()
+        assert len(posted) == 1
+        lines = posted[0].split("\n")
+        assert lines[0] == "4 messages, 3 errors, 2 messages dropped because the queue was full"
+        assert lines[1:3] == ["Top errors:", "  3 x Unable to read resource"]
+        assert lines[3] == "Sample of 2 messages:"
+        assert len(lines) == 6
+        notifier.flush()
+        assert len(posted) == 1
+
+    def test_slack_notifier_fork(self, monkeypatch):
+        posted = []
+        monkeypatch.setattr("slack.get_slack_client", lambda: type("Client", (), {
+            "post_to_slack_channel": lambda self, message, retries=0: posted.append(message),
+        })())
+        notifier = SlackNotifier(interval=3600)
+        notifier.notify("queued before the fork")
+        read_end, write_end = os.pipe()
+        pid = os.fork()
+        if pid == 0:  # a crawl worker
+            notifier.notify("queued in the worker")
+            notifier.stop()
+            os.write(write_end, "\n".join(posted).encode())
+            os._exit(0)
+        os.close(write_end)
+        os.waitpid(pid, 0)
+        with os.fdopen(read_end) as f:
+            assert f.read() == "1 messages, 0 errors\n  queued in the worker"
+        notifier.stop()
+        assert posted == ["1 messages, 0 errors\n  queued before the fork"]
+
+    def test_pcode_update_client(self):
+        received = []
+        statuses = [503, 200, 200]
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                received.append(loads(self.rfile.read(int(self.headers["Content-Length"]))))
+                self.send_response(statuses.pop(0) if statuses else 500)
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        try:
+            url = f"http://127.0.0.1:{server.server_port}/api/action/hdx_p_coded_resource_update"
+            client = PcodeUpdateClient(url, headers={}, retries=2, backoff=0, batch_size=3)
+            assert client.update("a", True, "false") is True
+            assert client.update("b", False, False) is False
+            assert client.update("c", None) is False
+            assert client.update("a", False, True) is True
+            assert received == []
+            assert client.update("d", True) is True
+            assert client.update("e", True, "True") is False
+            client.close()
+            assert [r["id"] for r in received] == ["a", "a", "d"]
+            assert received[0] == {"id": "a", "p_coded": False, "batch_mode": "KEEP_OLD"}
+            assert (client.patched, client.skipped, client.failed) == (2, 2, 0)
+
+            client = PcodeUpdateClient(url, headers={}, retries=1, backoff=0)
+            with pytest.raises(Exception):
+                client.update("f", True)
+            assert len(received) == 5
+
+            statuses.extend([200, 200])
+            client = PcodeUpdateClient(url, headers={}, retries=0, batch_size=10, flush_interval=0.2)
+            client.update("g", True)
+            sleep(0.5)  # written without another update or a flush
+            assert [r["id"] for r in received[5:]] == ["g"]
+            client.close()
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_download_zip_url(self, input_folder):
+        with open(join(input_folder, "download-afg-adminboundaries-tabulardata.xlsx"), "rb") as f:
+            contents = f.read()
+        ranges = []
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                start, end = 0, len(contents) - 1
+                if "Range" in self.headers:
+                    first, last = self.headers["Range"].replace("bytes=", "").split("-")
+                    start, end = int(first), int(last or end)
+                    ranges.append((start, end))
+                    self.send_response(206)
+                    self.send_header("Content-Range", f"bytes {start}-{end}/{len(contents)}")
+                else:
+                    self.send_response(200)
+                self.send_header("Content-Length", str(end - start + 1))
+                self.end_headers()
+                self.wfile.write(contents[start:end + 1])
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        resource = {"url": f"http://127.0.0.1:{server.server_port}/tabulardata.zip"}
+        try:
+            with temp_dir(folder="TestPcodeDetectorZipUrl") as folder:
+                with Download(user_agent="test") as downloader:
+                    retriever = Retrieve(downloader, folder, folder, folder, save=False, use_saved=False)
+                    with Workspace(folder, DiskQuota(50_000_000), 50_000_000) as workspace:
+                        resource_files, error = download_resource(resource, "xlsx", retriever, workspace, 50_000_000)
+                        assert error is None
+                        assert len(resource_files) == 1
+                        assert getsize(resource_files[0]) == len(contents)
+            assert ranges  # the archive was looked into by range first
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_workspace(self):
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                self.send_response(200)
+                self.end_headers()  # no Content-Length so only the streamed bytes count
+                self.wfile.write(b"x" * 3_000_000)
+
+            def log_message(self, *args):
+                pass
+
+        server = HTTPServer(("127.0.0.1", 0), Handler)
+        Thread(target=server.serve_forever, daemon=True).start()
+        url = f"http://127.0.0.1:{server.server_port}/data.csv"
+        quota = DiskQuota(5_000_000)
+        try:
+            with temp_dir(folder="TestPcodeDetectorWorkspace") as folder:
+                with Download(user_agent="test") as downloader:
+                    retriever = Retrieve(downloader, folder, folder, folder, save=False, use_saved=False)
+                    with Workspace(folder, quota, 4_000_000) as workspace:
+                        path = workspace.download(retriever, url)
+                        assert getsize(path) == 3_000_000
+                        with pytest.raises(SizeLimitExceeded):
+                            workspace.download(retriever, url, max_bytes=2_000_000)
+                        with pytest.raises(SizeLimitExceeded):  # over the ceiling of the workspace
+                            workspace.download(retriever, url)
+                        other = Workspace(folder, quota, 4_000_000)
+                        with pytest.raises(SizeLimitExceeded):  # over the shared quota
+                            other.download(retriever, url)
+                        other.close()
+                    assert quota.used == 0
+                    assert not exists(workspace.folder)
+
+                bomb = join(folder, "bomb.zip")
+                with ZipFile(bomb, "w", ZIP_DEFLATED) as z:
+                    z.writestr("zeros.csv", b"0" * 20_000_000)
+                with Workspace(folder, quota, 50_000_000) as workspace:
+                    with ZipFile(bomb) as z:
+                        with pytest.raises(SizeLimitExceeded):
+                            workspace.charge_members(z.infolist())
+                    with gzip.open(join(folder, "zeros.gz"), "wb") as gz:
+                        gz.write(b"0" * 6_000_000)
+                    with gzip.open(join(folder, "zeros.gz"), "rb") as gz:
+                        with pytest.raises(SizeLimitExceeded):
+                            workspace.copy(gz, join(workspace.subfolder(), "zeros.csv"))
+                    assert quota.used <= quota.limit
+                assert quota.used == 0
+        finally:
+            server.shutdown()
+            server.server_close()
+
+    def test_isolation_pool(self):
+        pool = IsolationPool(max_rss_mb=100000, max_tasks=2, start_method="fork")
+        assert pool.run(max, 1, 2) == 2
+        assert len(pool._idle) == 1
+        pid = pool._idle[0].process.pid
+        with pytest.raises(ValueError):
+            pool.run(int, "x")  # the second task retires the worker
+        assert not pool._idle
+        assert pool.run(sorted, [2, 1]) == [1, 2]
+        assert pool._idle[0].process.pid != pid
+        with pytest.raises(WorkerDied):
+            pool.run(os._exit, 3)
+        pool.close()
+        limited = IsolationPool(max_rss_mb=1, start_method="fork")
+        with pytest.raises(MemoryLimitExceeded):
+            limited.run(sleep, 5)
+        assert not limited._idle
+        # shared values are sent to a worker once per version
+        pool = IsolationPool(max_rss_mb=100000, start_method="fork")
+        global_pcodes = PcodeIndex({"AFG": ["AF01", "AF0101"]}, "v1", {"AF01": 1, "AF0101": 2})
+        shared = pool.run(get_shared, "pcodes", shared={"pcodes": ("v1", global_pcodes)})
+        assert list(shared.lookup(["AFG"])) == ["AF01", "AF0101"]
+        assert shared.lookup_levels(["AFG"]).tolist() == [1, 2]
+        assert pool.run(get_shared, "pcodes", shared={"pcodes": ("v1", None)}) is not None  # not sent again
+        assert pool.run(get_shared, "pcodes", shared={"pcodes": ("v2", None)}) is None
+        worker = pool._idle[0]
+        with pytest.raises(TypeError):
+            pool.run(max, Event(), 1)  # cannot be pickled
+        assert not pool._idle
+        assert not worker.process.is_alive()
+        pool.close()
+
+    def test_metrics(self):
+        metrics = Metrics()
+        count("rows_parsed", 10)  # outside of a trace
+        with trace_resource("abc") as trace:
+            set_format("csv")
+            for _ in range(2):
+                with timed("read"):
+                    count("rows_parsed", 20)
+            fields = trace.finish("pcoded", metrics)
+        assert fields["format"] == "csv"
+        assert fields["rows_parsed"] == 40
+        assert fields["read_seconds"] >= 0
+        with trace_resource("def") as trace:
+            trace.finish("undetermined", metrics)
+        assert metrics.counter("resources") == 2
+        text = metrics.prometheus()
+        assert 'pcode_resources_total{format="csv",outcome="pcoded"} 1' in text
+        assert 'pcode_rows_parsed_total{format="csv"} 40' in text
+        assert 'pcode_stage_seconds_count{stage="read",format="csv"} 1' in text
+        assert 'pcode_stage_seconds_count{stage="total",format="unknown"} 1' in text
+        with temp_dir(folder="TestPcodeDetectorMetrics") as folder:
+            path = join(folder, "metrics", "test.prom")
+            metrics.write(path)
+            with open(path) as f:
+                assert f.read() == text
+
+    def test_lazy_readers(self):
+        code = (
+            "import sys; import check_pcodes; "
+            "print(sorted(m for m in ['fiona', 'openpyxl', 'pyogrio'] if m in sys.modules)); "
+            "check_pcodes.load_readers('csv'); print('pyogrio' in sys.modules); "
+            "check_pcodes.load_readers('gpkg'); print(sorted(m for m in ['fiona', 'pyogrio'] if m in sys.modules))"
+        )
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        assert output.split("\n")[:3] == ["[]", "False", "['fiona', 'pyogrio']"]
+        code = "import sys; import run; print([m for m in ['pandas', 'hdx.data.dataset'] if m in sys.modules])"
+        output = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, check=True).stdout
+        assert output.strip() == "[]"
+
+    def test_replay(self, configuration, fixtures, input_folder):
+        assert dispatch_offsets([{}, {}, {}], rate=2) == [0, 0.5, 1]
+        recorded = [{"event_time": "2024-01-01T00:00:00"}, {"event_time": "2024-01-01T00:00:10"}]
+        assert dispatch_offsets(recorded, speed=10) == [0, 1]
+        with open(join(input_folder, "test-data-for-p-code-detector.json")) as f:
+            dataset_data = load(f)
+        with open(join(fixtures, "afg_col_pcodes.txt")) as f:
+            pcodes = load(f)
+        with temp_dir(folder="TestPcodeDetectorReplay") as folder:
+            PcodeSnapshot(join(folder, "pcodes"), configuration["global_pcodes"]["level"]).save("test", [(iso3, p) for iso3, codes in pcodes.items() for p in codes])
+            events_path = join(folder, "events.jsonl")
+            with open(events_path, "w") as f:
+                for resource in dataset_data["resources"]:
+                    event = {
+                        "event_type": "resource-data-changed",
+                        "event_time": "2024-01-01T00:00:00",
+                        "dataset_id": dataset_data["id"],
+                        "resource_id": resource["id"],
+                    }
+                    f.write(f"{dumps(event)}\n")
+            report = replay_main(events_path, input_folder, workers=2, pcodes_folder=join(folder, "pcodes"),
+                                 coalesce_window=0, output=join(folder, "report.json"))
+            with open(join(folder, "report.json")) as f:
+                assert load(f) == report
+        assert report["events"] == 5
+        assert report["outcomes"] == {"success": 5}  # including the geopackage and geotiff of the slow lane
+        assert report["updates"] == 4  # p_coded None is never written
+        assert report["latency_p50"] <= report["latency_max"]
+        assert report["peak_rss_mb"] > 0
 
     def test_process_resource(self, configuration, fixtures, input_folder):
         dataset = Dataset.load_from_json(join(input_folder, "test-data-for-p-code-detector.json"))